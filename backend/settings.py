@@ -35,6 +35,38 @@ SENDFILE_BACKEND = 'sendfile.backends.simple'
 JPUSH_APP_KEY = os.getenv('JPUSH_APP_KEY', '')
 JPUSH_APP_SECRET = os.getenv('JPUSH_APP_SECRET', '')
 JPUSH_APNS_PRODUCTION = os.getenv('JPUSH_APNS_PRODUCTIONS', 'true') == 'true'
+JPUSH_URL = os.getenv('JPUSH_URL', 'https://api.jpush.cn/v3/push')
+# 推送 worker 每批领取的消息数、同时进行的推送请求数
+JPUSH_BATCH_SIZE = int(os.getenv('JPUSH_BATCH_SIZE', '500'))
+JPUSH_CONCURRENCY = int(os.getenv('JPUSH_CONCURRENCY', '4'))
+# 推送请求的超时（秒）、失败后的重试次数和第一次重试前等待的时间（秒），之后每次翻倍
+JPUSH_TIMEOUT = 5
+JPUSH_RETRIES = 3
+JPUSH_BACKOFF = 0.5
+# 领取之后超过这个时间（秒）还没有推送成功的消息可以被重新领取
+JPUSH_CLAIM_TIMEOUT = 60
+# 没有待推送的消息时，每隔多久（秒）查询一次
+JPUSH_POLL_INTERVAL = 1
+
+# 进程内 token -> profile 缓存的容量和过期时间（秒）
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '1024'))
+AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', '10'))
+
+# 图表、统计接口响应的缓存时间（秒），统计数据更新之后缓存立即失效
+STATS_CACHE_TIMEOUT = int(os.getenv('STATS_CACHE_TIMEOUT', str(3600 * 24)))
+# 统计接口缓存的命中/未命中次数每隔多少秒写入一次共享缓存
+STATS_CACHE_COUNTER_FLUSH = int(os.getenv('STATS_CACHE_COUNTER_FLUSH', '10'))
+
+# 导入 Excel 的后台线程数
+IMPORT_JOB_WORKERS = int(os.getenv('IMPORT_JOB_WORKERS', '2'))
+# 导入任务执行超过这个时间（秒）还没有结束，认为执行任务的进程已经退出，任务标记为失败
+IMPORT_JOB_TIMEOUT = int(os.getenv('IMPORT_JOB_TIMEOUT', '3600'))
+
+# 批量导出审批单的进程数，为 0 时在请求的进程里渲染；
+# 每个 web 进程第一次批量导出时各自创建进程池，总进程数是 web 进程数 × AUDIT_EXPORT_WORKERS
+AUDIT_EXPORT_WORKERS = int(os.getenv('AUDIT_EXPORT_WORKERS', '4'))
+# 批量导出时最多有多少个审批单在渲染或等待写入压缩包，限制内存占用
+AUDIT_EXPORT_MAX_PENDING = int(os.getenv('AUDIT_EXPORT_MAX_PENDING', '8'))
 
 # Application definition
 
@@ -107,12 +139,31 @@ DATABASES = {
     }
 }
 
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': '/var/tmp/django_cache',
+# 共享缓存（token、验证码、统计数据等）：file 只在单机上有效，db 保存在数据库表里（需要先执行 createcachetable），
+# 连接同一个数据库的多个节点共享
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'file')
+if CACHE_BACKEND == 'db':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'core_cache',
+            'OPTIONS': {
+                # 每次写入都会统计行数，超过之后删除过期数据和 1/CULL_FREQUENCY 的数据，登录的 token 也在里面
+                'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', '100000')),
+            }
+        }
     }
-}
+    # 缓存用单独的连接，读写不在请求的事务里
+    DATABASES['cache'] = dict(DATABASES['default'])
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': '/var/tmp/django_cache',
+        }
+    }
+
+DATABASE_ROUTERS = ['core.routers.CacheRouter']
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -1,4 +1,5 @@
 import logging
+import tempfile
 
 from backend.settings import *
 
@@ -6,7 +7,9 @@ from backend.settings import *
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3')
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # 批量导出的 worker 进程看不到内存数据库，测试数据库用临时目录里的文件
+        'TEST': {'NAME': os.getenv('TEST_DB_PATH', os.path.join(tempfile.gettempdir(), 'zyhr-test-db.sqlite3'))},
     }
 }
 
@@ -19,6 +22,9 @@ CACHES = {
 
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 
+# 默认在测试进程里渲染，进程池的测试单独打开
+AUDIT_EXPORT_WORKERS = 0
+
 if '--no-logs' in sys.argv:
     sys.argv.remove('--no-logs')
     logging.disable(logging.CRITICAL)
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 
 application = get_wsgi_application()
+
+# 审批单模板在启动时编译好，导出时直接复制
+from core.views.auditExport import compileTemplates
+
+compileTemplates()
@@ -1,4 +1,11 @@
+import copy
+import time
 import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
 from django.http import JsonResponse
 from django.core.cache import cache
 
@@ -7,6 +14,83 @@ from core.models import *
 logger = logging.getLogger('app.core.auth')
 
 
+class ProfileCache(object):
+    '''
+    进程内的 token -> profile 缓存，容量为 AUTH_CACHE_SIZE，最久没有使用的先淘汰；
+    缓存 AUTH_CACHE_TTL 秒后过期，其他进程修改 profile 之后最多延迟这么久生效
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token, None)
+            if entry is None:
+                return None
+            profile, expires = entry
+            if expires < time.monotonic():
+                del self.entries[token]
+                return None
+            self.entries.move_to_end(token)
+            return profile
+
+    def set(self, token, profile):
+        with self.lock:
+            self.entries[token] = (profile, time.monotonic() + settings.AUTH_CACHE_TTL)
+            self.entries.move_to_end(token)
+            while len(self.entries) > settings.AUTH_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def evict(self, token=None, profileIds=None):
+        '''
+        token 和 profileIds 都为 None 时清空缓存
+        '''
+        with self.lock:
+            if token is None and profileIds is None:
+                self.entries.clear()
+                return
+            if token is not None:
+                self.entries.pop(token, None)
+            if profileIds is not None:
+                profileIds = set(str(pk) for pk in profileIds)
+                for key in [key for key, (profile, _) in self.entries.items() if str(profile.pk) in profileIds]:
+                    del self.entries[key]
+
+
+profileCache = ProfileCache()
+
+
+def evictProfiles(profileIds=None):
+    '''
+    profile（包括部门、职位、角色）修改之后调用，profileIds 为 None 时清空本进程的缓存；
+    事务提交之前其他请求可能又缓存了旧的数据，所以提交之后再清理一次
+    '''
+    profileCache.evict(profileIds=profileIds)
+    transaction.on_commit(lambda: profileCache.evict(profileIds=profileIds))
+
+
+def loadProfile(token):
+    profile = profileCache.get(token)
+    if profile is None:
+        profileId = cache.get('token-' + token)
+        if profileId is None:
+            return None
+
+        profile = Profile.objects \
+            .select_related('department', 'position', 'role') \
+            .filter(pk=profileId) \
+            .first()
+        # 禁用的员工已经登录的 token 也不能再使用
+        if profile is None or profile.blocked:
+            return None
+        profileCache.set(token, profile)
+
+    # 请求里可能会修改 request.profile，缓存里的 profile 不能直接给请求使用
+    return copy.deepcopy(profile)
+
+
 def validateToken(fn):
     def wrapper(request, *args, **kwargs):
         token = request.META.get('HTTP_AUTHORIZATION', None)
@@ -16,8 +100,9 @@ def validateToken(fn):
             }, status=401)
 
         try:
-            profileId = cache.get('token-' + token)
-            profile = Profile.objects.get(pk=profileId)
+            profile = loadProfile(token)
+            if profile is None:
+                raise Exception('profile not found')
             request.profile = profile
         except:
             logger.exception("Token is invalid")
@@ -34,3 +119,11 @@ def generateToken(profile):
     token = str(uuid.uuid4())
     cache.set('token-' + token, profile.pk, 3600 * 24 * 7)
     return token
+
+
+def revokeToken(token):
+    '''
+    退出登录时调用，token 立即失效
+    '''
+    cache.delete('token-' + token)
+    profileCache.evict(token=token)
@@ -1,4 +1,18 @@
+import json
+import time
+import hashlib
+import datetime
+import threading
+import functools
+import collections
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.db import transaction
 from django.utils import timezone
+from django.db.models import Count, Max
+from django.db.models.query import QuerySet, prefetch_related_objects
 
 from core.models import *
 
@@ -11,12 +25,13 @@ def resolve_config(config):
     }
 
 
-def resolve_department(dep):
+def resolve_department(dep, positions=None):
     if dep is None:
         return None
 
-    dps = DepPos.objects.filter(dep=dep)
-    positions = [i.pos for i in dps]
+    if positions is None:
+        dps = DepPos.objects.filter(dep=dep)
+        positions = [i.pos for i in dps]
 
     return {
         'id': str(dep.pk),
@@ -40,10 +55,322 @@ def resolve_position(pos):
     }
 
 
+def preload_positions(depIds):
+    '''
+    批量加载部门的职位，返回 department_id -> [position]
+    '''
+    positions = {pk: [] for pk in depIds}
+    if len(depIds) > 0:
+        dps = DepPos.objects \
+            .select_related('pos') \
+            .filter(dep__in=depIds) \
+            .order_by('pk')
+        for dp in dps:
+            positions[dp.dep_id].append(dp.pos)
+    return positions
+
+
+def preload_profiles(profiles):
+    '''
+    批量加载 profile 序列化时需要的部门职位和角色人数，
+    profile 的 department/position/role 需要提前 select_related
+    '''
+    profiles = [p for p in profiles if p is not None]
+
+    positions = preload_positions(set(p.department_id for p in profiles if p.department_id is not None))
+
+    roleIds = set(p.role_id for p in profiles if p.role_id is not None)
+    roleProfiles = {pk: 0 for pk in roleIds}
+    if len(roleIds) > 0:
+        counts = Profile.objects \
+            .filter(role__in=roleIds, archived=False) \
+            .values('role') \
+            .annotate(count=Count('pk'))
+        for c in counts:
+            roleProfiles[c['role']] = c['count']
+
+    return {
+        'positions': positions,
+        'roleProfiles': roleProfiles
+    }
+
+
+MEMO_MODELS = [BankAccount, Company, Memo]
+
+
+def _loadMemoVersion():
+    # 缓存丢失之后从数据库恢复，新的版本号比已经返回给客户端的都大
+    versions = [model.objects.aggregate(version=Max('memoVersion'))['version'] or 0 for model in MEMO_MODELS]
+    return max(versions) + 1
+
+
+def _memoVersion():
+    version = cache.get('memo-version')
+    if version is None:
+        cache.add('memo-version', _loadMemoVersion(), None)
+        version = cache.get('memo-version', 1)
+    return version
+
+
+def _bumpMemoVersion():
+    try:
+        cache.incr('memo-version')
+    except ValueError:
+        cache.set('memo-version', _loadMemoVersion(), None)
+
+
+def invalidateMemo():
+    '''
+    账户/公司/记忆数据有新增时调用，事务提交后缓存失效
+    '''
+    transaction.on_commit(_bumpMemoVersion)
+
+
+def _loadMemo(version):
+    # 新增的数据第一次加载时记录加载时的版本号，晚提交的数据会在之后的版本里加载，
+    # 不会因为 created_at 比客户端的 cursor 早而漏掉
+    for model in MEMO_MODELS:
+        model.objects.filter(memoVersion__isnull=True).update(memoVersion=version)
+
+    accounts = BankAccount.objects.order_by('created_at')
+    companies = Company.objects.order_by('created_at')
+    memo = Memo.objects.order_by('created_at')
+
+    # 更新版本号之后才提交的数据还没有版本号，当作这个版本新增的
+    return {
+        'accounts': [(account.memoVersion or version, {
+            'name': account.name,
+            'bank': account.bank,
+            'number': account.number
+        }) for account in accounts],
+        'companies': [(c.memoVersion or version, {
+            'name': c.name,
+        }) for c in companies],
+        'memo': [(m.memoVersion or version, {
+            'category': m.category,
+            'value': m.value
+        }) for m in memo],
+    }
+
+
+def resolve_memo(since=None):
+    '''
+    since 为上次返回的 memoCursor（记忆数据的版本号），传入时只返回之后的版本新增的数据
+    '''
+    version = _memoVersion()
+    key = 'memo-{}'.format(version)
+    memo = cache.get(key)
+    if memo is None:
+        memo = _loadMemo(version)
+        cache.set(key, memo, 3600 * 24)
+
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        # 之前按 created_at 返回的 cursor
+        since = None
+    if since is not None and since > version:
+        since = None
+
+    result = {}
+    for name, items in memo.items():
+        result[name] = [item for itemVersion, item in items
+                        if since is None or itemVersion > since]
+
+    result['memoCursor'] = str(version)
+    return result
+
+
+def _assigneesVersion():
+    version = cache.get('assignees-version')
+    if version is None:
+        cache.add('assignees-version', 1, None)
+        version = cache.get('assignees-version', 1)
+    return version
+
+
+def _bumpAssigneesVersion():
+    try:
+        cache.incr('assignees-version')
+    except ValueError:
+        cache.set('assignees-version', 1, None)
+
+
+def invalidateAssignees():
+    '''
+    人员新增、删除或者调整部门职位时调用。立即失效一次，事务提交后再失效一次，
+    避免其他请求在事务提交之前用旧数据重新加载
+    '''
+    _bumpAssigneesVersion()
+    transaction.on_commit(_bumpAssigneesVersion)
+
+
+def _loadAssignees():
+    # (部门, 职位) -> 第一个在职人员，和 Profile.objects.filter(...)[0] 一致
+    assignees = {}
+    profiles = Profile.objects \
+        .filter(archived=False) \
+        .values_list('department_id', 'position_id', 'pk')
+    for dep, pos, pk in profiles:
+        assignees.setdefault((str(dep), str(pos)), pk)
+    return assignees
+
+
+def resolveAssignees(keys):
+    '''
+    keys: [(department_id, position_id)]，返回 key -> profile，没有人员的 key 不在结果里
+
+    缓存里的人员不存在、已被删除、已经调走或者找不到人员时，重新加载一次：
+    不经过 emps 接口新增或调整的人员（admin、数据迁移、管理命令）不会让缓存失效
+    '''
+    key = 'assignees-{}'.format(_assigneesVersion())
+    assignees = cache.get(key)
+    refreshed = assignees is None
+    if refreshed:
+        assignees = _loadAssignees()
+        cache.set(key, assignees, 3600 * 24)
+
+    while True:
+        ids = [assignees[(str(dep), str(pos))] for dep, pos in keys if (str(dep), str(pos)) in assignees]
+        profiles = Profile.objects.in_bulk(ids)
+
+        result, stale = {}, False
+        for dep, pos in keys:
+            profile = profiles.get(assignees.get((str(dep), str(pos))))
+            if profile is None or profile.archived or \
+                    str(profile.department_id) != str(dep) or str(profile.position_id) != str(pos):
+                stale = True
+                continue
+            result[(dep, pos)] = profile
+
+        if not stale or refreshed:
+            return result
+
+        assignees = _loadAssignees()
+        cache.set(key, assignees, 3600 * 24)
+        refreshed = True
+
+
+STATS_SOURCES = ['taizhang', 'funds', 'customer']
+
+
+def _statsVersion(source):
+    key = 'stats-version-' + source
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def _bumpStatsVersion(source):
+    key = 'stats-version-' + source
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+def invalidateStats(source):
+    '''
+    统计数据重新计算，或者统计接口用到的数据有修改时调用，source 为 taizhang/funds/customer；
+    立即失效一次，事务提交后再失效一次
+    '''
+    _bumpStatsVersion(source)
+    transaction.on_commit(lambda: _bumpStatsVersion(source))
+
+
+def createStatsEvent(source, extra=None):
+    '''
+    记录需要重新计算的统计数据，同时让对应的接口缓存失效
+    '''
+    event = StatsEvent.objects.create(source=source, event='invalidate', extra=extra)
+    invalidateStats(source)
+    return event
+
+
+# 命中/未命中次数先在进程里累加，每 STATS_CACHE_COUNTER_FLUSH 秒写入一次共享缓存，
+# 命中缓存的请求不需要每次都写共享缓存
+_statsCacheCounts = collections.Counter()
+_statsCacheCountsLock = threading.Lock()
+_statsCacheFlushedAt = time.monotonic()
+
+
+def _flushStatsCacheCounts():
+    global _statsCacheFlushedAt
+    with _statsCacheCountsLock:
+        counts = dict(_statsCacheCounts)
+        _statsCacheCounts.clear()
+        _statsCacheFlushedAt = time.monotonic()
+
+    for key, count in counts.items():
+        if not cache.add(key, count, None):
+            cache.incr(key, count)
+
+
+def _countStatsCache(source, result):
+    with _statsCacheCountsLock:
+        _statsCacheCounts['stats-cache-{}-{}'.format(result, source)] += 1
+        due = time.monotonic() - _statsCacheFlushedAt >= settings.STATS_CACHE_COUNTER_FLUSH
+    if due:
+        _flushStatsCacheCounts()
+
+
+def statsCacheCounters():
+    '''
+    source -> 当前版本和接口缓存的命中/未命中次数；
+    其他进程的次数最多延迟 STATS_CACHE_COUNTER_FLUSH 秒
+    '''
+    _flushStatsCacheCounts()
+    return {source: {
+        'version': _statsVersion(source),
+        'hits': cache.get('stats-cache-hits-' + source, 0),
+        'misses': cache.get('stats-cache-misses-' + source, 0)
+    } for source in STATS_SOURCES}
+
+
+def cacheStats(source):
+    '''
+    缓存统计接口 GET 请求的响应，key 由请求路径、参数和 source 的版本组成，
+    版本变化之后旧的缓存不会再被读到，等过期之后清理
+    '''
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET':
+                return fn(request, *args, **kwargs)
+
+            # 先取版本再计算，计算过程中版本变化的话结果只会存到旧版本下面
+            raw = json.dumps([request.path, sorted(request.GET.lists()), _statsVersion(source)])
+            key = 'stats-response-' + hashlib.md5(raw.encode('utf-8')).hexdigest()
+            content = cache.get(key)
+            if content is not None:
+                _countStatsCache(source, 'hits')
+                return HttpResponse(content, content_type='application/json')
+
+            _countStatsCache(source, 'misses')
+            response = fn(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.content, settings.STATS_CACHE_TIMEOUT)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
 def resolve_profile(profile,
                     include_messages=True,
                     include_pending_tasks=True,
-                    include_memo=True):
+                    include_memo=True,
+                    memo_since=None,
+                    preloaded=None):
+    positions, roleProfiles = None, None
+    if preloaded is not None:
+        positions = preloaded['positions'].get(profile.department_id)
+        roleProfiles = preloaded['roleProfiles'].get(profile.role_id)
+
     result = {
         'id': str(profile.pk),
         'name': profile.name,
@@ -51,8 +378,8 @@ def resolve_profile(profile,
         'phone': profile.phone,
         'desc': profile.desc,
         'blocked': profile.blocked,
-        'role': resolve_role(profile.role),
-        'department': resolve_department(profile.department),
+        'role': resolve_role(profile.role, profiles=roleProfiles),
+        'department': resolve_department(profile.department, positions=positions),
         'position': resolve_position(profile.position),
 
         'created_at': profile.created_at.isoformat(),
@@ -61,6 +388,7 @@ def resolve_profile(profile,
 
     if include_messages:
         messages = Message.objects \
+            .select_related('activity__config', 'activity__creator') \
             .filter(profile=profile, read=False) \
             .order_by('-updated_at')
         messages = messages[0:20]
@@ -94,61 +422,107 @@ def resolve_profile(profile,
         result['pendingTasks'] = pendingTasks
 
     if include_memo:
-        accounts = BankAccount.objects.all()
-        companies = Company.objects.all()
-        memo = Memo.objects.all()
-
-        result['accounts'] = [{
-            'name': account.name,
-            'bank': account.bank,
-            'number': account.number
-        } for account in accounts]
-
-        result['companies'] = [{
-            'name': c.name,
-        } for c in companies]
-
-        result['memo'] = [{
-            'category': m.category,
-            'value': m.value
-        } for m in memo]
+        result.update(resolve_memo(since=memo_since))
 
     return result
 
 
-def resolve_activity(activity, include_steps=True):
+def resolve_activity(activity,
+                     include_steps=True,
+                     cancellable=None,
+                     canHurryup=None,
+                     preloaded=None):
+    if cancellable is None:
+        cancellable = activity.isCancellable()
+    if canHurryup is None:
+        canHurryup = activity.canHurryup
+    if preloaded is None:
+        preloaded = preload_profiles([activity.creator])
+
     result = {
         'id': str(activity.pk),
         'sn': activity.sn,
         'creator': resolve_profile(activity.creator,
                                    include_memo=False,
                                    include_messages=False,
-                                   include_pending_tasks=False),
-        'cancellable': activity.isCancellable(),
+                                   include_pending_tasks=False,
+                                   preloaded=preloaded),
+        'cancellable': cancellable,
         'amount': activity.amount,
         'type': activity.config.subtype,
         'state': activity.state,
         'taskState': activity.taskState,
         'extra': activity.extra,
-        'canHurryup': activity.canHurryup,
+        'canHurryup': canHurryup,
         'created_at': activity.created_at.isoformat(),
         'updated_at': activity.updated_at.isoformat()
     }
 
     if include_steps:
-        steps = AuditStep.objects.filter(activity=activity).order_by('position')
-        result['steps'] = [resolve_step(step) for step in steps]
+        steps = list(AuditStep.objects
+                     .select_related('assignee__department',
+                                     'assignee__position',
+                                     'assigneeDepartment',
+                                     'assigneePosition')
+                     .filter(activity=activity)
+                     .order_by('position'))
+        positions = preload_positions(set(step.assigneeDepartment_id for step in steps
+                                          if step.assigneeDepartment_id is not None))
+        result['steps'] = [resolve_step(step, positions=positions.get(step.assigneeDepartment_id))
+                           for step in steps]
 
     return result
 
 
-def resolve_step(step):
+def resolve_activities(activities):
+    '''
+    批量序列化审批列表（不包含审批步骤），结果和逐条调用
+    resolve_activity(activity, include_steps=False) 一致，查询次数与条数无关
+    '''
+    related = ['config', 'creator__department', 'creator__position', 'creator__role']
+    if isinstance(activities, QuerySet):
+        activities = list(activities.select_related(*related))
+    else:
+        activities = list(activities)
+        prefetch_related_objects(activities, *related)
+
+    if len(activities) == 0:
+        return []
+
+    # 是否可以撤回、催办直接由审批单上的冗余字段判断
+    preloaded = preload_profiles([a.creator for a in activities])
+    return [resolve_activity(a,
+                             include_steps=False,
+                             preloaded=preloaded) for a in activities]
+
+
+def resolve_profile_brief(profile):
+    '''
+    只包含基本信息的 profile，用于审批步骤的审批人、列表里的创建人，
+    department/position 需要提前 select_related
+    '''
+    department = profile.department
+    return {
+        'id': str(profile.pk),
+        'name': profile.name,
+        'phone': profile.phone,
+        'email': profile.email,
+        'department': {
+            'id': str(department.pk),
+            'code': department.code,
+            'name': department.name
+        } if department is not None else None,
+        'position': resolve_position(profile.position)
+    }
+
+
+def resolve_step(step, positions=None):
     return {
         'id': str(step.pk),
         'active': step.active,
         'state': step.state,
-        'assignee': resolve_profile(step.assignee),
-        'assigneeDepartment': resolve_department(step.assigneeDepartment),
+        'assignee': resolve_profile_brief(step.assignee),
+        'assigneeDepartment': resolve_department(step.assigneeDepartment, positions=positions),
         'assigneePosition': resolve_position(step.assigneePosition),
         'position': step.position,
         'desc': step.desc,
@@ -161,14 +535,14 @@ def resolve_step(step):
     }
 
 
-def resolve_role(r):
+def resolve_role(r, profiles=None):
     if r is None:
         return None
 
     return {
         'id': str(r.pk),
         'name': r.name,
-        'profiles': r.profiles,
+        'profiles': r.profiles if profiles is None else profiles,
         'version': r.version,
         'desc': r.desc,
         'extra': r.extra
@@ -189,7 +563,7 @@ def resolve_customer(c):
         'address': c.address,
         'desc': c.desc,
 
-        'creator': resolve_profile(c.creator) if c.creator is not None else None,
+        'creator': resolve_profile_brief(c.creator) if c.creator is not None else None,
 
         'created_at': c.created_at.isoformat(),
         'updated_at': c.updated_at.isoformat()
@@ -204,7 +578,7 @@ def resolve_account(a):
         'number': a.number,
         'currency': a.currency,
 
-        'creator': resolve_profile(a.creator) if a.creator is not None else None,
+        'creator': resolve_profile_brief(a.creator) if a.creator is not None else None,
 
         'created_at': a.created_at.isoformat(),
         'updated_at': a.updated_at.isoformat()
@@ -0,0 +1,17 @@
+import django
+from django.conf import settings
+
+# 批量导出审批单的 worker 进程用 spawn 启动，不会复制父进程的线程和数据库连接；
+# 这个模块在 django.setup() 之前导入，不能在模块级别导入 model
+
+
+def initExportWorker(databases):
+    '''
+    databases: alias -> 父进程使用的数据库名（测试时是测试数据库）
+    '''
+    django.setup()
+    for alias, name in databases.items():
+        settings.DATABASES[alias]['NAME'] = name
+
+    from core.views.auditExport import compileTemplates
+    compileTemplates()
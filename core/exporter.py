@@ -0,0 +1,97 @@
+import csv
+import uuid
+import tempfile
+
+import xlwt
+import openpyxl
+from django.http import StreamingHttpResponse, FileResponse
+from sendfile import sendfile
+
+# 每次从数据库读取的行数
+CHUNK_SIZE = 2000
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def iterateRows(queryset, props):
+    '''
+    按 id 倒序、props 的顺序逐行读取；每次按 id 翻页查询 CHUNK_SIZE 行，
+    不依赖数据库游标（mysqlclient 会把整个结果集读到客户端），不会一次加载全部数据
+    '''
+    queryset = queryset.order_by('-id')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(id__lt=last)
+        rows = list(chunk.values_list('id', *props)[:CHUNK_SIZE])
+        for row in rows:
+            yield row[1:]
+
+        if len(rows) < CHUNK_SIZE:
+            return
+        last = rows[-1][0]
+
+
+def exportRows(request, titles, rows, filename='export'):
+    '''
+    format=csv: 流式返回 CSV
+    format=xlsx: 用 openpyxl 的 write_only 模式逐行写入临时文件，写完之后再返回文件
+                 （xlsx 是 zip 格式，要整个文件写完才能发送，不是边查边发）
+    默认仍然是 xls（最多 65535 行）
+    '''
+    format = request.GET.get('format', 'xls')
+    if format == 'csv':
+        return exportCSV(titles, rows, filename)
+    elif format == 'xlsx':
+        return exportXLSX(titles, rows, filename)
+    else:
+        return exportXLS(request, titles, rows, filename)
+
+
+def exportCSV(titles, rows, filename):
+    writer = csv.writer(Echo())
+
+    def lines():
+        # 带上 BOM，Excel 打开时才能正确识别中文
+        yield '﻿' + writer.writerow(titles)
+        for row in rows:
+            yield writer.writerow(row)
+
+    response = StreamingHttpResponse(lines(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(filename)
+    return response
+
+
+def exportXLSX(titles, rows, filename):
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet('sheet1')
+    sheet.append(titles)
+    for row in rows:
+        sheet.append(row)
+
+    # 临时文件关闭之后自动删除
+    f = tempfile.TemporaryFile()
+    wb.save(f)
+    f.seek(0)
+
+    response = FileResponse(f, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    response['Content-Disposition'] = 'attachment; filename="{}.xlsx"'.format(filename)
+    return response
+
+
+def exportXLS(request, titles, rows, filename):
+    f = '/tmp/{}.xls'.format(str(uuid.uuid4()))
+    xf = xlwt.Workbook()
+    sheet = xf.add_sheet('sheet1')
+
+    for index, title in enumerate(titles):
+        sheet.write(0, index, title)
+
+    for row, values in enumerate(rows):
+        for col, value in enumerate(values):
+            sheet.write(row + 1, col, value)
+
+    xf.save(f)
+    return sendfile(request, f, attachment=True, attachment_filename='{}.xls'.format(filename))
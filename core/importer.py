@@ -0,0 +1,197 @@
+import logging
+import datetime
+import pandas
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import *
+
+logger = logging.getLogger('app.core.importer')
+
+# 批量写入时每批的行数
+BATCH_SIZE = 500
+
+# category -> (columns, fn)
+importers = {}
+
+executor = None
+
+
+def registerImporter(category, columns):
+    '''
+    注册导入的处理函数 fn(df, profile, progress)，返回成功的行数和错误列表
+    '''
+
+    def decorator(fn):
+        importers[category] = (columns, fn)
+        return fn
+
+    return decorator
+
+
+def readImportFile(fileId, columns):
+    '''
+    读取上传的 Excel，按模板的列顺序重新命名列
+    '''
+    f = File.objects.get(pk=fileId)
+    df = pandas.read_excel('{}/{}'.format(settings.DATA_DIR, f.path))
+    df = df.iloc[:, :len(columns)].copy()
+    if len(df.columns) < len(columns):
+        for column in columns[len(df.columns):]:
+            df[column] = None
+    df.columns = columns
+    return df
+
+
+def textColumn(series):
+    '''
+    空单元格当作空字符串
+    '''
+    return series.where(series.notnull(), '').astype(str)
+
+
+def numberColumn(series):
+    '''
+    不是数字的单元格当作空值
+    '''
+    return pandas.to_numeric(series, errors='coerce')
+
+
+def choiceColumn(series, choices):
+    '''
+    choices 为 model 的 choices，把显示的名称转换成保存的值，无效的值为空
+    '''
+    return series.map(dict([(c[1], c[0]) for c in choices]))
+
+
+def validateRows(df, checks):
+    '''
+    checks: [(valid, errorId)]，valid 为 False 的行记录第一个错误
+
+    返回有效的行和错误列表，错误里的 row 是 Excel 里的行号（第一行为标题）
+    '''
+    errors = pandas.Series([None] * len(df), index=df.index, dtype=object)
+    for valid, errorId in checks:
+        errors[errors.isnull() & ~valid.fillna(False).astype(bool)] = errorId
+
+    invalid = errors[errors.notnull()]
+    return df[errors.isnull()], [{'row': int(index) + 2, 'errorId': errorId}
+                                 for index, errorId in invalid.items()]
+
+
+def optional(value):
+    return None if pandas.isnull(value) else value
+
+
+def bulkImport(model, objs, progress=None):
+    with transaction.atomic():
+        for start in range(0, len(objs), BATCH_SIZE):
+            model.objects.bulk_create(objs[start:start + BATCH_SIZE])
+            if progress is not None:
+                progress(min(start + BATCH_SIZE, len(objs)))
+
+
+def createImportJob(profile, category, fileId):
+    '''
+    创建导入任务，事务提交之后交给后台线程执行
+    '''
+    job = ImportJob.objects.create(profile=profile, category=category, file_id=fileId)
+    transaction.on_commit(lambda: submitImportJob(job.pk))
+    return job
+
+
+def submitImportJob(jobId):
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=settings.IMPORT_JOB_WORKERS)
+    executor.submit(runImportJobInThread, jobId)
+
+
+def runImportJobInThread(jobId):
+    try:
+        runImportJob(jobId)
+    finally:
+        # 每个线程有自己的数据库连接，结束之后关闭
+        connection.close()
+
+
+def runImportJob(jobId):
+    # 只有一个 worker 能够拿到 pending 状态的任务
+    claimed = ImportJob.objects \
+        .filter(pk=jobId, state=ImportJob.StatePending) \
+        .update(state=ImportJob.StateRunning, started_at=timezone.now())
+    if claimed == 0:
+        return
+
+    job = ImportJob.objects.get(pk=jobId)
+    columns, fn = importers[job.category]
+    try:
+        df = readImportFile(job.file_id, columns)
+        job.total = len(df)
+        job.save()
+
+        def progress(processed):
+            # 导入在事务里进行，进度放在缓存里，其他请求才能看到
+            cache.set('import-job-{}'.format(job.pk), processed, 3600)
+
+        success, errors = fn(df, job.profile, progress)
+        job.success = success
+        job.fail = job.total - success
+        job.errors = errors
+        job.state = ImportJob.StateFinished
+    except:
+        logger.exception('fail to run import job {}'.format(job.pk))
+        job.state = ImportJob.StateFailed
+
+    job.finished_at = timezone.now()
+    job.save()
+    cache.delete('import-job-{}'.format(job.pk))
+
+
+def failStaleImportJobs(jobs=None):
+    '''
+    执行任务的进程重启或者崩溃时，任务会一直停在 running，超过 IMPORT_JOB_TIMEOUT 的标记为失败；
+    导入的数据在事务里写入，没有完成的任务不会留下数据
+    '''
+    if jobs is None:
+        jobs = ImportJob.objects.all()
+
+    deadline = timezone.now() - datetime.timedelta(seconds=settings.IMPORT_JOB_TIMEOUT)
+    return jobs \
+        .filter(state=ImportJob.StateRunning, started_at__lt=deadline) \
+        .update(state=ImportJob.StateFailed, finished_at=timezone.now())
+
+
+def resolve_import_job(job):
+    if job.state == ImportJob.StateRunning:
+        processed = cache.get('import-job-{}'.format(job.pk), 0)
+    elif job.state == ImportJob.StatePending:
+        processed = 0
+    else:
+        processed = job.total
+
+    throughput = None
+    if job.started_at is not None:
+        end = job.finished_at or timezone.now()
+        seconds = (end - job.started_at).total_seconds()
+        if seconds > 0:
+            throughput = round(processed / seconds, 2)
+
+    return {
+        'id': str(job.pk),
+        'category': job.category,
+        'state': job.state,
+        'total': job.total,
+        'processed': processed,
+        'success': job.success,
+        'fail': job.fail,
+        'errors': job.errors,
+        'throughput': throughput,  # 每秒处理的行数
+        'started_at': job.started_at.isoformat() if job.started_at is not None else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at is not None else None,
+        'created_at': job.created_at.isoformat()
+    }
@@ -0,0 +1,76 @@
+import time
+import statistics
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from core.models import *
+
+
+class Rollback(Exception):
+    pass
+
+
+@contextmanager
+def rollback():
+    '''
+    基准测试的数据都在一个事务里面创建，结束之后全部回滚
+    '''
+    try:
+        with transaction.atomic():
+            yield
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+def measure(fn, repeat=5):
+    '''
+    多次执行 fn，返回耗时的中位数（毫秒）
+    '''
+    costs = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        costs.append((time.perf_counter() - start) * 1000)
+    return statistics.median(costs)
+
+
+def prepareOrganization():
+    '''
+    bench_root.bench_ceo: bench-ceo
+    bench_biz.bench_owner: bench-owner, bench_biz.bench_member: bench-member
+    bench_fin.bench_owner: bench-fin-owner, bench_fin.bench_accountant: bench-accountant
+    '''
+    org = {}
+    for code in ['bench_member', 'bench_owner', 'bench_accountant', 'bench_ceo']:
+        org[code] = Position.objects.create(name=code, code=code)
+
+    root = Department.objects.create(name='bench_root', code='bench_root')
+    org['bench_root'] = root
+    for code in ['bench_biz', 'bench_fin']:
+        org[code] = Department.objects.create(name=code, code=code, parent=root)
+
+    DepPos.objects.create(dep=org['bench_root'], pos=org['bench_ceo'])
+    DepPos.objects.create(dep=org['bench_biz'], pos=org['bench_owner'])
+    DepPos.objects.create(dep=org['bench_biz'], pos=org['bench_member'])
+    DepPos.objects.create(dep=org['bench_fin'], pos=org['bench_owner'])
+    DepPos.objects.create(dep=org['bench_fin'], pos=org['bench_accountant'])
+
+    members = [
+        ('bench-ceo', 'bench_root', 'bench_ceo'),
+        ('bench-owner', 'bench_biz', 'bench_owner'),
+        ('bench-member', 'bench_biz', 'bench_member'),
+        ('bench-fin-owner', 'bench_fin', 'bench_owner'),
+        ('bench-accountant', 'bench_fin', 'bench_accountant'),
+    ]
+    for name, dep, pos in members:
+        user = User.objects.create(username=name)
+        org[name] = Profile.objects.create(user=user,
+                                           name=name,
+                                           phone=name,
+                                           department=org[dep],
+                                           position=org[pos])
+
+    return org
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.models import *
+
+
+class Command(BaseCommand):
+    help = '根据审批步骤和催办消息回填审批单的当前审批步骤、当前审批人、是否已审批和最后催办时间；' \
+           'migrate 时已经回填过，数据有问题时可以重新执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=500)
+
+    def handle(self, *args, **options):
+        activityIds = list(AuditActivity.objects.order_by('pk').values_list('pk', flat=True))
+        for i in range(0, len(activityIds), options['batch']):
+            AuditActivity.backfillActiveStep(activityIds[i:i + options['batch']])
+            self.stdout.write('{}/{}'.format(min(i + options['batch'], len(activityIds)), len(activityIds)))
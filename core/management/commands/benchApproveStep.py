@@ -0,0 +1,70 @@
+import json
+import time
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.core.management.base import BaseCommand
+
+from core import specs
+from core.models import *
+from core.auth import generateToken
+from core.views.audit import createActivity
+from core.management.commands._bench import rollback, prepareOrganization
+
+
+class Command(BaseCommand):
+    help = '审批：每秒可以处理的审批通过请求数量和每次审批的查询次数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--activities', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with rollback():
+            org = prepareOrganization()
+            config = specs.createAuditConfig(
+                spec='bench.bench_flow:_.bench_owner->bench_fin.bench_accountant->'
+                     'bench_fin.bench_owner->bench_root.bench_ceo...')
+            activities = [createActivity(org['bench-member'], {
+                'code': config.subtype,
+                'submit': True,
+                'extra': {}
+            }) for i in range(options['activities'])]
+
+            client = Client()
+            tokens = {}
+
+            def approve(step):
+                response = client.post('/api/v1/audit-steps/{}/actions/approve'.format(step.pk),
+                                       json.dumps({}),
+                                       content_type='application/json',
+                                       HTTP_AUTHORIZATION=tokens[step.assignee_id])
+                assert response.status_code == 200
+
+            # 按审批顺序一轮一轮地审批，每一轮处理所有审批单的当前步骤
+            rounds = [list(AuditStep.objects
+                           .filter(activity__in=activities, position=position)
+                           .select_related('assignee'))
+                      for position in range(AuditActivityConfigStep.objects.filter(config=config).count())]
+            for steps in rounds:
+                for step in steps:
+                    if step.assignee_id not in tokens:
+                        tokens[step.assignee_id] = generateToken(step.assignee)
+
+            count = 0
+            queries = []
+            start = time.perf_counter()
+            for steps in rounds:
+                for step in steps:
+                    with CaptureQueriesContext(connection) as ctx:
+                        approve(step)
+                    queries.append(len(ctx.captured_queries))
+                    count = count + 1
+            cost = time.perf_counter() - start
+
+            approved = AuditActivity.objects \
+                .filter(pk__in=[a.pk for a in activities], state=AuditActivity.StateApproved) \
+                .count()
+            self.stdout.write('approvals: {}, approved activities: {}'.format(count, approved))
+            self.stdout.write('queries per approval: {} - {}'.format(min(queries), max(queries)))
+            self.stdout.write('approvals per second: {:.1f}'.format(count / cost))
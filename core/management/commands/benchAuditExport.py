@@ -0,0 +1,153 @@
+import os
+import gc
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from core.models import *
+from core.views import auditExport
+from core.management.commands._bench import rollback, measure, prepareOrganization
+
+account = {'name': 'bench', 'number': '6222000000000000', 'bank': 'bench-bank'}
+
+
+def costItems(n):
+    return [{'name': '办公用品', 'desc': 'bench', 'amount': '1234.56',
+             'tuibukuan': '0', 'yuanjiekuan': '0'} for i in range(n)]
+
+
+def travelItems(n):
+    return [{'startTime': '2018-06-01 08:00:00', 'endTime': '2018-06-03 18:00:00',
+             'days': 3, 'place': '北京', 'spec': '100', 'train': '500', 'hotel': '600'} for i in range(n)]
+
+
+# subtype -> extra
+documents = [
+    ('open_account', {'account': {'name': 'bench', 'bank': 'bench-bank', 'nature': 'basic', 'reason': 'bench'}}),
+    ('cost_lte_5000', {'items': costItems(15), 'account': account}),
+    ('loan_lte_5000', {'loan': {'amount': '3000', 'application': 'bench'}, 'account': account}),
+    ('money_lte_50k', {'info': {'amount': '30000', 'desc': 'bench'},
+                       'inAccount': account,
+                       'outAccount': dict(account, type='cash')}),
+    ('biz_contract', {'base': {'type': 'dazong', 'company': 'bench'},
+                      'info': {'upstream': 'bench', 'downstream': 'bench', 'asset': 'bench',
+                               'tonnage': '100', 'buyPrice': '1000', 'sellPrice': '1100',
+                               'settlementType': 'cash', 'profitsPerTon': '100', 'grossMargin': '10'}}),
+    ('fn_contract', {'base': {'name': 'bench', 'other': 'bench'},
+                     'info': {'amount': '10000', 'count': 2, 'sn': 'bench'}}),
+    ('rongzitikuan', {'info': {'applicants': 'bench', 'guarantee': 'bench', 'productType': 'bench',
+                               'marginRatio': '10%'}}),
+    ('travel_lte_5000', {'items': travelItems(10),
+                         'info': {'yuanjiekuan': '1000', 'reason': 'bench'},
+                         'account': account}),
+]
+
+# 审批单里需要显示的审批人
+assignees = [
+    ('bench-owner', 'bench_biz', 'owner'),
+    ('bench-accountant', 'fin', 'fin_accountant'),
+    ('bench-fin-owner', 'fin', 'owner'),
+    ('bench-member', 'hr', 'owner'),
+    ('bench-ceo', 'root', 'ceo'),
+]
+
+
+class Command(BaseCommand):
+    help = '审批单导出：每种审批单的耗时和内存峰值'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--batch', type=int, default=0, help='批量导出的审批单数量')
+        parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+
+    def prepareActivity(self, org, subtype, extra):
+        config = AuditActivityConfig.objects.get(subtype=subtype)
+        activity = AuditActivity.objects.create(sn='bench', config=config, creator=org['bench-member'], extra=extra)
+        for position, (name, dep, pos) in enumerate(assignees):
+            AuditStep.objects.create(activity=activity,
+                                     assignee=org[name],
+                                     assigneeDepartment=Department.objects.get(code=dep),
+                                     assigneePosition=Position.objects.get(code=pos),
+                                     position=position)
+        return activity
+
+    def render(self, activity):
+        path, filename = auditExport._export(activity)
+        os.remove(path)
+
+    def peak(self, activity):
+        gc.collect()
+        tracemalloc.start()
+        self.render(activity)
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size / 1024 / 1024
+
+    def stream(self, activityIds, workers, trace=False):
+        settings.AUDIT_EXPORT_WORKERS = workers
+        auditExport.closeExportPool()
+
+        gc.collect()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        size = 0
+        for chunk in auditExport.streamAuditDocs(activityIds):
+            size = size + len(chunk)
+        cost = time.perf_counter() - start
+        peak = 0
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        auditExport.closeExportPool()
+        return cost, peak / 1024 / 1024, size / 1024 / 1024
+
+    def batch(self, options):
+        # worker 进程看不到事务里的数据，批量导出的数据需要提交，结束之后再删除
+        org = prepareOrganization()
+        activities = []
+        try:
+            for i in range(options['batch']):
+                subtype, extra = documents[i % len(documents)]
+                activities.append(self.prepareActivity(org, subtype, extra))
+            activityIds = [a.pk for a in activities]
+            # 和 wsgi 一样先编译模板，workers 为 0 时直接使用；worker 进程启动时自己编译
+            auditExport.compileTemplates()
+
+            self.stdout.write('batch: {} documents'.format(len(activityIds)))
+            self.stdout.write('{:>8} {:>10} {:>16} {:>10}'.format(
+                'workers', 'total (s)', 'parent peak (MB)', 'zip (MB)'))
+            for workers in options['workers']:
+                # tracemalloc 会拖慢渲染，耗时和内存分两次测量
+                cost, _, size = self.stream(activityIds, workers)
+                _, peak, _ = self.stream(activityIds, workers, trace=True)
+                self.stdout.write('{:>8} {:>10.1f} {:>16.2f} {:>10.2f}'.format(workers, cost, peak, size))
+        finally:
+            AuditActivity.objects.filter(pk__in=[a.pk for a in activities]).delete()
+            for name in ['bench-ceo', 'bench-owner', 'bench-member', 'bench-fin-owner', 'bench-accountant']:
+                User.objects.filter(pk=org[name].user_id).delete()
+            DepPos.objects.filter(dep__code__startswith='bench_').delete()
+            Department.objects.filter(code__in=['bench_biz', 'bench_fin']).delete()
+            Department.objects.filter(code='bench_root').delete()
+            Position.objects.filter(code__startswith='bench_').delete()
+
+    def handle(self, *args, **options):
+        if options['batch'] > 0:
+            self.batch(options)
+            return
+
+        with rollback():
+            org = prepareOrganization()
+
+            self.stdout.write('{:>16} {:>12} {:>12} {:>12}'.format(
+                'document', 'first (ms)', 'median (ms)', 'peak (MB)'))
+            for subtype, extra in documents:
+                activity = self.prepareActivity(org, subtype, extra)
+                first = measure(lambda: self.render(activity), repeat=1)
+                cost = measure(lambda: self.render(activity), repeat=options['repeat'])
+                self.stdout.write('{:>16} {:>12.1f} {:>12.1f} {:>12.2f}'.format(
+                    subtype, first, cost, self.peak(activity)))
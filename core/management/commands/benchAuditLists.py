@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from core import specs
+from core.auth import generateToken
+from core.models import *
+from core.management.commands._bench import rollback, measure, prepareOrganization
+
+
+class Command(BaseCommand):
+    help = '待我审批/我已审批/与我相关的审批列表随审批人历史步骤数增长的耗时'
+
+    urls = [
+        '/api/v1/assigned-audit-activities',
+        '/api/v1/processed-audit-activities',
+        '/api/v1/related-audit-activities',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='100,1000,10000,100000')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def fill(self, org, config, count):
+        # 审批人的历史步骤绝大部分已经审批，少量待审批
+        batch = 1000
+        while count > 0:
+            n = min(batch, count)
+            activities = AuditActivity.objects.bulk_create([
+                AuditActivity(sn='bench',
+                              config=config,
+                              creator=org['bench-member'],
+                              state=AuditActivity.StateProcessing,
+                              extra={}) for i in range(n)
+            ])
+            AuditStep.objects.bulk_create([
+                AuditStep(activity=a,
+                          assignee=org['bench-owner'],
+                          assigneeDepartment=org['bench_biz'],
+                          assigneePosition=org['bench_owner'],
+                          active=i % 100 == 0,
+                          state=AuditStep.StatePending if i % 100 == 0 else AuditStep.StateApproved,
+                          position=0) for i, a in enumerate(activities)
+            ])
+            count = count - n
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        repeat = options['repeat']
+
+        with rollback():
+            org = prepareOrganization()
+            config = specs.createAuditConfig(spec='fin.bench_cost:_.bench_owner->bench_root.bench_ceo')
+            token = generateToken(org['bench-owner'])
+            client = Client()
+
+            self.stdout.write('{:>8} {}'.format('steps', ' '.join(['{:>36}'.format(u) for u in self.urls])))
+            filled = 0
+            for size in sizes:
+                self.fill(org, config, size - filled)
+                filled = size
+
+                costs = []
+                for url in self.urls:
+                    cost = measure(lambda: client.get(url, HTTP_AUTHORIZATION=token), repeat=repeat)
+                    costs.append('{:>33.1f} ms'.format(cost))
+                self.stdout.write('{:>8} {}'.format(size, ' '.join(costs)))
@@ -0,0 +1,80 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.core.management.base import BaseCommand
+
+from core.models import *
+from core.auth import validateToken, generateToken, profileCache
+from core.management.commands._bench import rollback, prepareOrganization
+
+
+def legacyValidateToken(fn):
+    '''
+    之前的做法：每个请求读取共享缓存，再单独查询 profile
+    '''
+
+    def wrapper(request, *args, **kwargs):
+        profileId = cache.get('token-' + request.META['HTTP_AUTHORIZATION'])
+        request.profile = Profile.objects.get(pk=profileId)
+        return fn(request, *args, **kwargs)
+
+    return wrapper
+
+
+def view(request):
+    # 和大部分接口一样会用到 profile 的部门和职位
+    return HttpResponse('{} {}'.format(request.profile.department.code, request.profile.position.code))
+
+
+class Command(BaseCommand):
+    help = '鉴权：只做 token 校验的接口每秒可以处理的请求数（使用 settings 里的共享缓存）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--tokens', type=int, default=50, help='同时在线的 token 数量')
+        parser.add_argument('--file-cache', default=None, help='改用这个目录下的 FileBasedCache 作为共享缓存')
+
+    def run(self, fn, tokens, count):
+        factory = RequestFactory()
+        requests = [factory.get('/', HTTP_AUTHORIZATION=tokens[i % len(tokens)]) for i in range(count)]
+        start = time.perf_counter()
+        for request in requests:
+            response = fn(request)
+            assert response.status_code == 200
+        return count / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        if options['file_cache'] is not None:
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': options['file_cache'],
+            }}):
+                self.bench(options)
+        else:
+            self.bench(options)
+
+    def bench(self, options):
+        self.stdout.write('cache backend: {}'.format(settings.CACHES['default']['BACKEND']))
+        with rollback():
+            org = prepareOrganization()
+            profiles = [p for p in org.values() if isinstance(p, Profile)]
+            tokens = [generateToken(profiles[i % len(profiles)]) for i in range(options['tokens'])]
+
+            ttl = settings.AUTH_CACHE_TTL
+            cases = [
+                ('legacy', legacyValidateToken(view), 0),
+                ('no local cache', validateToken(view), 0),
+                ('local cache', validateToken(view), ttl),
+            ]
+            for name, fn, cacheTTL in cases:
+                settings.AUTH_CACHE_TTL = cacheTTL
+                profileCache.evict()
+                throughput = self.run(fn, tokens, options['requests'])
+                self.stdout.write('{:>16}: {:>10.1f} requests/s'.format(name, throughput))
+            settings.AUTH_CACHE_TTL = ttl
+
+            for token in tokens:
+                cache.delete('token-' + token)
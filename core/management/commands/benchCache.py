@@ -0,0 +1,62 @@
+import time
+import uuid
+import shutil
+import tempfile
+
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = '共享缓存：文件缓存和数据库缓存每秒可以处理的 get/set 次数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keys', type=int, default=2000)
+        parser.add_argument('--entries', type=int, default=20000, help='缓存里已有的数据量')
+
+    def ops(self, fn, keys):
+        start = time.perf_counter()
+        for key in keys:
+            fn(key)
+        return len(keys) / (time.perf_counter() - start)
+
+    def bench(self, name, cache, options):
+        # 模拟已经登录的用户的 token
+        for i in range(options['entries']):
+            cache.set('token-{}'.format(uuid.uuid4()), str(uuid.uuid4()), 3600)
+
+        keys = ['token-{}'.format(uuid.uuid4()) for i in range(options['keys'])]
+        profileId = str(uuid.uuid4())
+        setOps = self.ops(lambda key: cache.set(key, profileId, 3600), keys)
+        getOps = self.ops(lambda key: cache.get(key), keys)
+        missOps = self.ops(lambda key: cache.get(key + '-miss'), keys)
+        # 超过 MAX_ENTRIES 之后会被淘汰，已经登录的 token 可能会失效
+        hits = len([key for key in keys if cache.get(key) is not None])
+        self.stdout.write('{:>8} {:>12.0f} {:>12.0f} {:>12.0f} {:>10.1%}'.format(
+            name, setOps, getOps, missOps, hits / len(keys)))
+
+    def handle(self, *args, **options):
+        self.stdout.write('{} entries in cache'.format(options['entries']))
+        self.stdout.write('{:>8} {:>12} {:>12} {:>12} {:>10}'.format('backend', 'set/s', 'get/s', 'miss/s', 'hits'))
+
+        self.bench('locmem', LocMemCache('bench', {'OPTIONS': {'MAX_ENTRIES': options['entries'] * 2}}), options)
+
+        path = tempfile.mkdtemp()
+        try:
+            # 和 settings 一样使用默认的 MAX_ENTRIES
+            self.bench('file', FileBasedCache(path, {}), options)
+        finally:
+            shutil.rmtree(path)
+
+        # 缓存可能走单独的 cache 连接，不在事务里，用单独的表，结束之后删除
+        call_command('createcachetable', 'bench_cache')
+        try:
+            # 和 settings 一样的 MAX_ENTRIES，每次写入都会统计行数
+            self.bench('db', DatabaseCache('bench_cache', {'OPTIONS': {'MAX_ENTRIES': 100000}}), options)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TABLE bench_cache')
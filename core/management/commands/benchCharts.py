@@ -0,0 +1,71 @@
+from decimal import Decimal
+
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management.base import BaseCommand
+
+from core.auth import generateToken
+from core.common import invalidateStats
+from core.models import *
+from core.management.commands._bench import rollback, measure, prepareOrganization
+
+
+class Command(BaseCommand):
+    help = '台账图表接口的耗时和查询数随货物数量的变化'
+
+    urls = [
+        '/api/v1/charts/taizhang/line?company=bench&prop=xiaoshoue',
+        '/api/v1/charts/taizhang/bar?company=bench',
+        '/api/v1/charts/taizhang/pie?company=bench',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,500')
+        parser.add_argument('--months', type=int, default=24)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def fill(self, start, stop, months):
+        TaizhangStat.objects.bulk_create([
+            TaizhangStat(category='month',
+                         month='{}-{:02d}'.format(2016 + m // 12, m % 12 + 1),
+                         company='bench',
+                         asset='asset-{}'.format(a),
+                         xiaoshoue=Decimal(a + m),
+                         lirune=Decimal(a),
+                         kuchun_liang=Decimal(m),
+                         zijin_zhanya=Decimal(1))
+            for a in range(start, stop) for m in range(months)
+            # 留一些空缺的月份
+            if (a + m) % 7 != 0
+        ])
+        invalidateStats('taizhang')
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+
+        with rollback():
+            org = prepareOrganization()
+            token = generateToken(org['bench-owner'])
+            client = Client()
+
+            names = [u.split('?')[0].split('/')[-1] + ' (cached)' for u in self.urls]
+            self.stdout.write('{:>8} {}'.format('assets', ' '.join(['{:>28}'.format(name) for name in names])))
+            filled = 0
+            for size in sizes:
+                self.fill(filled, size, options['months'])
+                filled = size
+
+                columns = []
+                for url in self.urls:
+                    # 先测不缓存响应时的查询数和耗时，再测命中响应缓存时的耗时
+                    with override_settings(STATS_CACHE_TIMEOUT=0):
+                        # queries_log 有长度上限，先清空才能数对
+                        connection.queries_log.clear()
+                        with CaptureQueriesContext(connection) as queries:
+                            client.get(url, HTTP_AUTHORIZATION=token)
+                        count = len(queries)
+                        cost = measure(lambda: client.get(url, HTTP_AUTHORIZATION=token), options['repeat'])
+                    cached = measure(lambda: client.get(url, HTTP_AUTHORIZATION=token), options['repeat'])
+                    columns.append('{:.1f}ms {}q {:.2f}ms'.format(cost, count, cached))
+                self.stdout.write('{:>8} {}'.format(size, ' '.join(['{:>28}'.format(c) for c in columns])))
@@ -0,0 +1,43 @@
+from django.db import connection
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import CaptureQueriesContext
+
+from core import specs
+from core.models import *
+from core.views.audit import createActivity
+from core.management.commands._bench import rollback, measure, prepareOrganization
+
+
+class Command(BaseCommand):
+    help = '提交审批：createActivity(submit=True) 的耗时和查询次数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with rollback():
+            org = prepareOrganization()
+            config = specs.createAuditConfig(
+                spec='bench.bench_flow:_.bench_owner->bench_fin.bench_accountant->'
+                     'bench_fin.bench_owner->bench_root.bench_ceo')
+            profile = org['bench-member']
+
+            def submit():
+                createActivity(profile, {
+                    'code': config.subtype,
+                    'submit': True,
+                    'extra': {}
+                })
+
+            with CaptureQueriesContext(connection) as ctx:
+                submit()
+            steps = AuditActivityConfigStep.objects.filter(config=config).count()
+            self.stdout.write('steps: {}, queries: {}'.format(steps, len(ctx.captured_queries)))
+
+            def cold():
+                cache.clear()
+                submit()
+
+            self.stdout.write('{:>16}: {:>8.2f} ms'.format('cold cache', measure(cold, repeat=options['repeat'])))
+            self.stdout.write('{:>16}: {:>8.2f} ms'.format('warm cache', measure(submit, repeat=options['repeat'])))
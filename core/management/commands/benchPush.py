@@ -0,0 +1,72 @@
+import json
+import time
+
+import requests
+from requests.auth import HTTPBasicAuth
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import push
+from core.models import *
+from core.tests.fakeJPush import FakeJPush
+from core.management.commands._bench import rollback, prepareOrganization
+
+
+def legacyPush():
+    '''
+    之前的做法：每条消息单独推送，每次新建连接，逐条保存
+    '''
+    for message in Message.objects.filter(category='progress', apn_sent=False, read=False):
+        requests.post(settings.JPUSH_URL,
+                      auth=HTTPBasicAuth(settings.JPUSH_APP_KEY, settings.JPUSH_APP_SECRET),
+                      data=json.dumps({
+                          "platform": "all",
+                          "audience": {"registration_id": [message.profile.deviceId]},
+                          "notification": {"alert": "您有新的审批需要处理！"},
+                          "options": {"apns_production": settings.JPUSH_APNS_PRODUCTION}
+                      }))
+        message.apn_sent = True
+        message.save()
+
+
+class Command(BaseCommand):
+    help = '推送：每秒可以推送的待审批消息数量（本地的模拟极光推送服务）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--latency', type=float, default=0.02, help='模拟推送服务每次请求的延迟（秒）')
+
+    def prepareMessages(self, profiles, count):
+        Message.objects.all().delete()
+        Message.objects.bulk_create([Message(profile=profiles[i % len(profiles)], category='progress', extra={})
+                                     for i in range(count)])
+
+    def handle(self, *args, **options):
+        jpush = FakeJPush(latency=options['latency']).start()
+        settings.JPUSH_URL = jpush.url
+        try:
+            with rollback():
+                org = prepareOrganization()
+                profiles = [p for p in org.values() if isinstance(p, Profile)]
+                for i, profile in enumerate(profiles):
+                    profile.deviceId = 'bench-device-{}'.format(i)
+                    profile.save()
+
+                self.stdout.write('{:>10} {:>10} {:>10} {:>14}'.format('worker', 'messages', 'requests', 'messages/s'))
+                for name in ['legacy', 'batched']:
+                    self.prepareMessages(profiles, options['messages'])
+                    jpush.pushes = []
+                    start = time.perf_counter()
+                    if name == 'legacy':
+                        legacyPush()
+                    else:
+                        worker = push.PushWorker()
+                        worker.run(once=True)
+                        worker.close()
+                    cost = time.perf_counter() - start
+                    assert not Message.objects.filter(apn_sent=False).exists()
+                    self.stdout.write('{:>10} {:>10} {:>10} {:>14.1f}'.format(
+                        name, options['messages'], len(jpush.pushes), options['messages'] / cost))
+        finally:
+            jpush.stop()
@@ -0,0 +1,80 @@
+import random
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import *
+from core.management.commands import stats
+from core.management.commands._bench import rollback, measure, prepareOrganization
+
+
+class Command(BaseCommand):
+    help = '资金信息统计：全量重新计算和增量更新的耗时对比'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=1000000)
+        parser.add_argument('--accounts', type=int, default=10)
+        parser.add_argument('--weeks', type=int, default=104)
+        parser.add_argument('--skip-full', action='store_true')
+
+    def fill(self, profile, numbers, count, weeks):
+        # 记录均匀分布在最近 weeks 周，按日期顺序录入
+        today = timezone.now().date()
+        days = weeks * 7
+        batch = 10000
+        created = 0
+        while created < count:
+            n = min(batch, count - created)
+            records = []
+            for i in range(created, created + n):
+                date = today - datetime.timedelta(days=days - i * days // count)
+                income = random.randint(1, 10000) if i % 2 == 0 else None
+                outcome = random.randint(1, 10000) if i % 2 == 1 else None
+                records.append(StatsTransactionRecord(creator=profile,
+                                                      date=date.strftime('%Y-%m-%d'),
+                                                      number=random.choice(numbers),
+                                                      income=income,
+                                                      outcome=outcome,
+                                                      balance=random.randint(1, 1000000),
+                                                      other='bench'))
+            StatsTransactionRecord.objects.bulk_create(records)
+            created = created + n
+
+    def handle(self, *args, **options):
+        count = options['records']
+
+        with rollback():
+            org = prepareOrganization()
+            profile = org['bench-accountant']
+            numbers = ['bench-{}'.format(i) for i in range(options['accounts'])]
+            for number in numbers:
+                FinAccount.objects.create(name=number, number=number, bank='bench', currency='rmb', creator=profile)
+            self.fill(profile, numbers, count, options['weeks'])
+
+            cmd = stats.Command()
+            self.stdout.write('records: {}, accounts: {}, weeks: {}'.format(count, len(numbers), options['weeks']))
+
+            if not options['skip_full']:
+                cost = measure(cmd.calTransactionStats, repeat=1)
+                self.stdout.write('{:>24}: {:>10.1f} ms'.format('full rebuild', cost))
+
+            # 没有统计数据时，所有账号都要从第一周开始计算
+            TransactionStat.objects.all().delete()
+            cost = measure(cmd.updateTransactionStats, repeat=1)
+            self.stdout.write('{:>24}: {:>10.1f} ms'.format('incremental (cold)', cost))
+
+            def update():
+                r = StatsTransactionRecord.objects.create(creator=profile,
+                                                          date=timezone.now().strftime('%Y-%m-%d'),
+                                                          number=numbers[0],
+                                                          income=100,
+                                                          balance=100,
+                                                          other='bench')
+                StatsEvent.objects.create(source='funds',
+                                          event='invalidate',
+                                          extra={'numbers': [r.number], 'since': r.date})
+                cmd.updateTransactionStats()
+
+            cost = measure(update, repeat=5)
+            self.stdout.write('{:>24}: {:>10.1f} ms'.format('incremental (1 record)', cost))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.push import PushWorker
+
+
+class Command(BaseCommand):
+    help = '批量推送待审批消息到极光推送'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true')
+
+    def handle(self, *args, **options):
+        worker = PushWorker()
+        try:
+            worker.run(once=options['once'])
+        finally:
+            worker.close()
@@ -0,0 +1,34 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.models import *
+from core.importer import runImportJobInThread, failStaleImportJobs
+# 注册各类导入的处理函数
+from core.views import customer, finAccount, stats
+
+
+class Command(BaseCommand):
+    help = '执行等待中的导入任务，比如 web 进程重启之前没有执行的任务；超时的 running 任务标记为失败'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true')
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=settings.IMPORT_JOB_WORKERS) as executor:
+            while True:
+                failStaleImportJobs()
+                jobs = ImportJob.objects \
+                    .filter(state=ImportJob.StatePending) \
+                    .order_by('created_at') \
+                    .values_list('pk', flat=True)
+                jobs = list(jobs)
+                futures = [executor.submit(runImportJobInThread, pk) for pk in jobs]
+                for future in futures:
+                    future.result()
+
+                if options['once']:
+                    break
+                time.sleep(1)
@@ -1,17 +1,17 @@
-import json
 import time
 import schedule
 import logging
 from decimal import Decimal
 from pytz import timezone as tz
-import requests
-from requests.auth import HTTPBasicAuth
+import pandas
 
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Sum, Max, Min
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
 from core.models import *
+from core.common import invalidateStats
 
 logger = logging.getLogger('app.core.views.audit')
 
@@ -61,39 +61,200 @@ class Command(BaseCommand):
         return d
 
     def calTransactionStats(self):
-        TransactionStat.objects.all().delete()
-
+        stats = []
         accounts = FinAccount.objects.filter(archived=False)
         for account in accounts:
             balance, income, outcome = self.calTransactionStatsForAccountTotal(account)
-            TransactionStat.objects.create(account=account,
-                                           balance=balance,
-                                           income=income,
-                                           outcome=outcome,
-                                           category='total')
+            stats.append(TransactionStat(account=account,
+                                         balance=balance,
+                                         income=income,
+                                         outcome=outcome,
+                                         category='total'))
 
         date = self.resolveFirstWeekdayForTransaction()
-        if date is None:
-            # no record just now
-            return
-
+        if date is not None:
+            nextDate = date + datetime.timedelta(days=7)
+            stopDate = self.calStopDate()
+            while nextDate < stopDate:
+                for account in accounts:
+                    balance, income, outcome = \
+                        self.calTransactionStatsForAccountTotal(account,
+                                                                startDate=date,
+                                                                endDate=nextDate)
+                    stats.append(TransactionStat(account=account,
+                                                 balance=balance,
+                                                 income=income,
+                                                 outcome=outcome,
+                                                 startDayOfWeek=date.strftime('%Y-%m-%d'),
+                                                 category='week'))
+                date = nextDate
+                nextDate = date + datetime.timedelta(days=7)
+
+        self.activateStats(TransactionStat, stats)
+
+    def resolveTransactionStatsForAccount(self, account, firstWeek, since=None):
+        '''
+        按日期分组汇总账号的收支，再合并成周数据，只生成 since 所在周之后的周数据
+
+        余额和全量计算一致：取对应日期之前最后录入的那条记录的余额
+        '''
+        days = StatsTransactionRecord.objects \
+            .filter(number=account.number, archived=False) \
+            .values('date') \
+            .annotate(income=Sum('income'), outcome=Sum('outcome'), last=Max('pk')) \
+            .order_by('date')
+        days = list(days)
+
+        weeks = []
+        index, last = 0, None
+        date = firstWeek
         nextDate = date + datetime.timedelta(days=7)
         stopDate = self.calStopDate()
         while nextDate < stopDate:
-            for account in accounts:
-                balance, income, outcome = \
-                    self.calTransactionStatsForAccountTotal(account,
-                                                            startDate=date,
-                                                            endDate=nextDate)
-                TransactionStat.objects.create(account=account,
-                                               balance=balance,
-                                               income=income,
-                                               outcome=outcome,
-                                               startDayOfWeek=date.strftime('%Y-%m-%d'),
-                                               category='week')
+            start, end = date.strftime('%Y-%m-%d'), nextDate.strftime('%Y-%m-%d')
+            income, outcome = Decimal(0), Decimal(0)
+            while index < len(days) and days[index]['date'] < end:
+                day = days[index]
+                if day['date'] >= start:
+                    income = income + Decimal(day['income'] or 0)
+                    outcome = outcome + Decimal(day['outcome'] or 0)
+                if last is None or day['last'] > last:
+                    last = day['last']
+                index = index + 1
+
+            if since is None or start >= since:
+                weeks.append((start, income, outcome, last))
             date = nextDate
             nextDate = date + datetime.timedelta(days=7)
 
+        income = sum([Decimal(d['income'] or 0) for d in days], Decimal(0))
+        outcome = sum([Decimal(d['outcome'] or 0) for d in days], Decimal(0))
+        last = max([d['last'] for d in days]) if len(days) > 0 else None
+        total = (None, income, outcome, last)
+
+        pks = set([w[3] for w in weeks] + [last]) - set([None])
+        balances = StatsTransactionRecord.objects.in_bulk(list(pks))
+
+        def resolveStat(week, category):
+            start, income, outcome, last = week
+            balance = Decimal(balances[last].balance) if last is not None else Decimal(0)
+            return TransactionStat(account=account,
+                                   balance=balance,
+                                   income=income,
+                                   outcome=outcome,
+                                   startDayOfWeek=start,
+                                   category=category)
+
+        return resolveStat(total, 'total'), [resolveStat(w, 'week') for w in weeks]
+
+    def resolveDirtyTransactionAccounts(self, events, accounts, firstWeek, stats):
+        '''
+        根据 StatsEvent 计算每个账号需要从哪一周开始重新计算，None 表示从第一周开始，
+        stats 为当前 generation 的统计数据
+        '''
+        dirty = {}
+
+        def markDirty(account, since):
+            if account.pk in dirty and (dirty[account.pk] is None or
+                                        (since is not None and dirty[account.pk] <= since)):
+                return
+            dirty[account.pk] = since
+
+        numbers = {}
+        for account in accounts:
+            numbers.setdefault(account.number, []).append(account)
+
+        for event in events:
+            extra = event.extra or {}
+            if 'numbers' not in extra:
+                for account in accounts:
+                    markDirty(account, None)
+                continue
+
+            since = extra.get('since', None)
+            if since is not None:
+                since = datetime.datetime.strptime(since, '%Y-%m-%d')
+                since = since - datetime.timedelta(days=since.weekday())
+                since = since.strftime('%Y-%m-%d')
+            for number in extra['numbers']:
+                for account in numbers.get(number, []):
+                    markDirty(account, since)
+
+        # 第一周有变化的话，所有账号的周数据都要重新生成
+        weekStats = stats.filter(category='week')
+        first = weekStats.aggregate(first=Min('startDayOfWeek'))['first']
+        if first is not None and first != firstWeek.strftime('%Y-%m-%d'):
+            for account in accounts:
+                markDirty(account, None)
+
+        # 新增的账号，以及时间推移之后需要补上的周数据
+        lastWeeks = dict(weekStats.values_list('account').annotate(last=Max('startDayOfWeek')))
+        totals = set(stats.filter(category='total').values_list('account', flat=True))
+        stopDate = self.calStopDate()
+        for account in accounts:
+            if account.pk not in totals or account.pk not in lastWeeks:
+                markDirty(account, None)
+                continue
+
+            last = datetime.datetime.strptime(lastWeeks[account.pk], '%Y-%m-%d')
+            since = last + datetime.timedelta(days=7)
+            if since.replace(tzinfo=firstWeek.tzinfo) + datetime.timedelta(days=7) < stopDate:
+                markDirty(account, since.strftime('%Y-%m-%d'))
+
+        return dirty
+
+    def updateTransactionStats(self):
+        '''
+        增量更新资金信息统计，只重新计算 StatsEvent 涉及的账号和周
+
+        只在一个事务里修改当前 generation 里涉及的账号，提交之前接口读取的还是之前的数据
+        '''
+        with transaction.atomic():
+            events = list(StatsEvent.objects
+                          .select_for_update()
+                          .filter(source='funds', handled=False)
+                          .order_by('pk'))
+
+            generation = StatsGeneration.current('funds', lock=True)
+            allStats = TransactionStat.objects.filter(generation=generation)
+
+            accounts = list(FinAccount.objects.filter(archived=False))
+            allStats.filter(account__archived=True).delete()
+
+            firstWeek = self.resolveFirstWeekdayForTransaction()
+            if firstWeek is None:
+                allStats.filter(category='week').delete()
+                dirty = dict([(account.pk, None) for account in accounts])
+            else:
+                dirty = self.resolveDirtyTransactionAccounts(events, accounts, firstWeek, allStats)
+
+            for account in accounts:
+                if account.pk not in dirty:
+                    continue
+
+                since = dirty[account.pk]
+                stats = allStats.filter(account=account)
+                if since is None:
+                    stats.delete()
+                else:
+                    stats.filter(Q(category='total') | Q(startDayOfWeek__gte=since)).delete()
+
+                if firstWeek is None:
+                    total = TransactionStat(account=account,
+                                            balance=Decimal(0),
+                                            income=Decimal(0),
+                                            outcome=Decimal(0),
+                                            category='total')
+                    weeks = []
+                else:
+                    total, weeks = self.resolveTransactionStatsForAccount(account, firstWeek, since=since)
+                for stat in [total] + weeks:
+                    stat.generation = generation
+                TransactionStat.objects.bulk_create([total] + weeks)
+
+            StatsEvent.objects.filter(pk__in=[e.pk for e in events]).update(handled=True)
+            invalidateStats('funds')
+
     def resolveCompaniesAndAssets(self):
         companies = set()
         records = Taizhang.objects.filter(archived=False).values('upstream').distinct()
@@ -115,47 +276,56 @@ class Command(BaseCommand):
 
         return companies, assets
 
-    def calTaizhangStateByCompanyAndAsset(self, company, asset=None, month=None):
-        xiaoshoue = Decimal(0.0)
-        caigoue = Decimal(0.0)
-        lirune = Decimal(0.0)
-        kuchun_liang = Decimal(0.0)
-        zijin_zhanya = Decimal(0.0)
-
-        commonParams = {'archived': False}
-        if asset is not None:
-            commonParams['asset'] = asset
-        if month is not None:
-            commonParams['date'] = month
-
-        records = Taizhang.objects \
-            .filter(Q(upstream=company) | Q(downstream=company), **commonParams)
-
-        # 销售金额
-        for r in records:
-            xiaoshoue = r.xiaoshou_jine + xiaoshoue
-
-        # 采购金额
-        caigoue = Decimal(0.0)
-        for r in records:
-            caigoue = r.caigou_jine + caigoue
-
-        # 利润额
-        lirune = xiaoshoue - caigoue
-
-        # 库存量
-        for r in records:
-            kuchun_liang = r.kuchun_jine + kuchun_liang
-
-        # 资金占压
-        for r in records:
-            zijin_zhanya = r.shangyou_zijin_zhanya + zijin_zhanya
+    def resolveTaizhangFrame(self):
+        '''
+        一次读出所有台账，每条台账按上游、下游公司各展开一行（上下游相同只算一次），并算好各项金额
+        '''
+        columns = ['date', 'asset', 'upstream', 'downstream',
+                   'kaipiao_dunwei_trade', 'downstream_jiesuan_price',
+                   'kaipiao_dunwei', 'upstream_jiesuan_price',
+                   'shangyou_kuchun_liang', 'shangyou_kuchun_yuji_danjia',
+                   'shangyou_zijin_zhanya']
+        records = Taizhang.objects.filter(archived=False).values(*columns)
+        df = pandas.DataFrame.from_records(list(records), columns=columns)
+
+        def product(a, b):
+            valid = df[a].notnull() & df[b].notnull()
+            return df[a].where(valid, Decimal(0)) * df[b].where(valid, Decimal(0))
+
+        frame = pandas.DataFrame({
+            'month': df['date'],
+            'asset': df['asset'],
+            # 销售金额
+            'xiaoshoue': product('kaipiao_dunwei_trade', 'downstream_jiesuan_price'),
+            # 采购金额
+            'caigoue': product('kaipiao_dunwei', 'upstream_jiesuan_price'),
+            # 库存量
+            'kuchun_liang': product('shangyou_kuchun_liang', 'shangyou_kuchun_yuji_danjia'),
+            # 资金占压
+            'zijin_zhanya': df['shangyou_zijin_zhanya'].where(df['shangyou_zijin_zhanya'].notnull(), Decimal(0)),
+        }, columns=['month', 'asset', 'xiaoshoue', 'caigoue', 'kuchun_liang', 'zijin_zhanya'])
+
+        downstream = df['downstream'].notnull() & (df['downstream'] != '') & (df['downstream'] != df['upstream'])
+        return pandas.concat([
+            frame.assign(company=df['upstream']),
+            frame[downstream].assign(company=df['downstream'][downstream])
+        ])
+
+    def resolveTaizhangStat(self, data):
+        if data is None:
+            return {
+                'xiaoshoue': Decimal(0),
+                'lirune': Decimal(0),
+                'kuchun_liang': Decimal(0),
+                'zijin_zhanya': Decimal(0)
+            }
 
         return {
-            'xiaoshoue': xiaoshoue,
-            'lirune': lirune,
-            'kuchun_liang': kuchun_liang,
-            'zijin_zhanya': zijin_zhanya
+            'xiaoshoue': data['xiaoshoue'],
+            # 利润额
+            'lirune': data['xiaoshoue'] - data['caigoue'],
+            'kuchun_liang': data['kuchun_liang'],
+            'zijin_zhanya': data['zijin_zhanya']
         }
 
     def resolveFirstMonthForTaizhang(self):
@@ -187,36 +357,41 @@ class Command(BaseCommand):
         return nextMonth
 
     def calTaizhangStats(self):
-        TaizhangStat.objects.all().delete()
-
         companies, assets = self.resolveCompaniesAndAssets()
+
+        # 按 (公司, 货物) 和 (公司, 货物, 月份) 一次分组汇总
+        frame = self.resolveTaizhangFrame()
+        metrics = ['xiaoshoue', 'caigoue', 'kuchun_liang', 'zijin_zhanya']
+        totals = frame.groupby(['company', 'asset'])[metrics].sum().to_dict('index')
+        months = frame.groupby(['company', 'asset', 'month'])[metrics].sum().to_dict('index')
+
+        stats = []
         for company in companies:
             for asset in assets:
-                data = self.calTaizhangStateByCompanyAndAsset(company, asset=asset)
-                TaizhangStat.objects.create(category='total',
-                                            company=company,
-                                            asset=asset,
-                                            **data)
+                data = self.resolveTaizhangStat(totals.get((company, asset), None))
+                stats.append(TaizhangStat(category='total',
+                                          company=company,
+                                          asset=asset,
+                                          **data))
 
         month = self.resolveFirstMonthForTaizhang()
-        if month is None:
-            return
-
-        nextMonth = self.calNextMonth(month)
-        stopMonth = self.calStopMonth()
-        while month < stopMonth:
-            monthText = month.strftime('%Y-%m')
-            for company in companies:
-                for asset in assets:
-                    data = self.calTaizhangStateByCompanyAndAsset(
-                        company, asset=asset, month=monthText)
-                    TaizhangStat.objects.create(category='month',
-                                                company=company,
-                                                asset=asset,
-                                                month=monthText,
-                                                **data)
-            month = nextMonth
+        if month is not None:
             nextMonth = self.calNextMonth(month)
+            stopMonth = self.calStopMonth()
+            while month < stopMonth:
+                monthText = month.strftime('%Y-%m')
+                for company in companies:
+                    for asset in assets:
+                        data = self.resolveTaizhangStat(months.get((company, asset, monthText), None))
+                        stats.append(TaizhangStat(category='month',
+                                                  company=company,
+                                                  asset=asset,
+                                                  month=monthText,
+                                                  **data))
+                month = nextMonth
+                nextMonth = self.calNextMonth(month)
+
+        self.activateStats(TaizhangStat, stats)
 
     def calCustomerStatsByCustomer(self, customer, month=None):
         records = Taizhang.objects.filter(Q(upstream=customer.name) | Q(downstream=customer.name),
@@ -231,96 +406,57 @@ class Command(BaseCommand):
         return {'yewuliang': yewuliang}
 
     def calCustomerStats(self):
-        CustomerStat.objects.all().delete()
-
+        stats = []
         customers = Customer.objects.filter(archived=False)
         for c in customers:
             data = self.calCustomerStatsByCustomer(c)
-            CustomerStat.objects.create(category='total',
-                                        customer=c,
-                                        **data)
+            stats.append(CustomerStat(category='total',
+                                      customer=c,
+                                      **data))
 
         month = self.resolveFirstMonthForTaizhang()
-        if month is None:
-            return
-
-        nextMonth = self.calNextMonth(month)
-        stopMonth = self.calStopMonth()
-        while month < stopMonth:
-            monthText = month.strftime('%Y-%m')
-            for customer in customers:
-                data = self.calCustomerStatsByCustomer(c, month=monthText)
-                CustomerStat.objects.create(category='month',
-                                            customer=customer,
-                                            month=monthText,
-                                            **data)
-            month = nextMonth
+        if month is not None:
             nextMonth = self.calNextMonth(month)
+            stopMonth = self.calStopMonth()
+            while month < stopMonth:
+                monthText = month.strftime('%Y-%m')
+                for customer in customers:
+                    data = self.calCustomerStatsByCustomer(customer, month=monthText)
+                    stats.append(CustomerStat(category='month',
+                                              customer=customer,
+                                              month=monthText,
+                                              **data))
+                month = nextMonth
+                nextMonth = self.calNextMonth(month)
+
+        self.activateStats(CustomerStat, stats)
+
+    def activateStats(self, model, stats):
+        '''
+        重新计算的统计数据写入新的 generation，全部写完之后再切换，
+        切换之前接口读取的还是之前的数据，不会读到空的或者写了一半的统计数据
+        '''
+        source = model.statsSource
+        generation = StatsGeneration.allocate(source)
+        for stat in stats:
+            stat.generation = generation
+        with transaction.atomic():
+            model.objects.bulk_create(stats, batch_size=500)
+        StatsGeneration.activate(source, model, generation)
+        invalidateStats(source)
 
     def _stats(self):
-        self.calTransactionStats()
+        self.updateTransactionStats()
         self.calTaizhangStats()
         self.calCustomerStats()
 
-    def sendAPN(self, message):
-        try:
-            profile = message.profile
-
-            if profile is None or \
-                    profile.archived or \
-                    profile.blocked or \
-                            profile.deviceId is None or \
-                            profile.deviceId == '':
-                message.apn_sent = True
-                message.save()
-                return
+    def handle(self, *args, **kwargs):
+        def job():
+            # self._stats()
+            pass
 
-            r = requests.post('https://api.jpush.cn/v3/push',
-                              auth=HTTPBasicAuth(settings.JPUSH_APP_KEY, settings.JPUSH_APP_SECRET),
-                              data=json.dumps({
-                                  "platform": "all",
-                                  "audience": {
-                                      "registration_id": [profile.deviceId]
-                                  },
-                                  "notification": {
-                                      "alert": "您有新的审批需要处理！"
-                                  },
-                                  "options": {
-                                      "apns_production": settings.JPUSH_APNS_PRODUCTION
-                                  }
-                              }))
-            result = r.json()
-            if 'error' not in result:
-                message.apn_sent = True
-                message.save()
-                return
-            else:
-                raise Exception(str(result['error']))
-        except:
-            logger.exception("fail to send message activity: {}, profile: {}".format(str(message.activity.pk),
-                                                                                     str(message.profile.pk)))
-
-
-def sendAPNIfNeed(self):
-    try:
-        # 既没有被阅读，有没有被推送的消息
-        messages = Message.objects \
-            .filter(category='progress',
-                    apn_sent=False,
-                    read=False)
-        for msg in messages:
-            self.sendAPN(msg)
-    except:
-        logger.exception("some error happens while sending push notifications.")
-
-
-def handle(self, *args, **kwargs):
-    def job():
-        # self._stats()
-        pass
-
-    schedule.every(1).hour().do(job)
-    while True:
-        schedule.run_pending()
-        self.sendAPNIfNeed()
-        time.sleep(1)
+        # 待审批消息的推送由 pushMessages 处理
+        schedule.every(1).hours.do(job)
+        while True:
+            schedule.run_pending()
+            time.sleep(1)
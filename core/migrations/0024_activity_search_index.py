@@ -0,0 +1,39 @@
+# Generated by Django 2.0.1 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+from core.models import resolveActivityDisplayName, resolveActivityDisplayType
+
+
+def build_search_index(apps, schema_editor):
+    AuditActivity = apps.get_model('core', 'AuditActivity')
+    activities = AuditActivity.objects \
+        .select_related('creator', 'config') \
+        .only('creator__name', 'config__subtype')
+    for activity in activities.iterator():
+        subtype = activity.config.subtype
+        AuditActivity.objects \
+            .filter(pk=activity.pk) \
+            .update(searchName=resolveActivityDisplayName(activity.creator.name, subtype),
+                    searchType=resolveActivityDisplayType(subtype))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_revert_audit_flow_transfer_20190510_0303'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditactivity',
+            name='searchName',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='auditactivity',
+            name='searchType',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.1 on 2026-10-18 13:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_activity_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='auditstep',
+            index=models.Index(fields=['assignee', 'active', 'state'], name='core_audits_assigne_321590_idx'),
+        ),
+    ]
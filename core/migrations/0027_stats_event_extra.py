@@ -0,0 +1,28 @@
+# Generated by Django 2.0.1 on 2026-10-18 13:38
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_memo_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statsevent',
+            name='extra',
+            field=jsonfield.fields.JSONField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statsevent',
+            name='handled',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='statstransactionrecord',
+            index=models.Index(fields=['number', 'date'], name='core_statst_number_7b1190_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.0.1 on 2026-10-18 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0027_stats_event_extra'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('category', models.CharField(max_length=255)),
+                ('state', models.CharField(default='pending', max_length=20)),
+                ('total', models.IntegerField(default=0)),
+                ('success', models.IntegerField(default=0)),
+                ('fail', models.IntegerField(default=0)),
+                ('errors', jsonfield.fields.JSONField(default=list)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.File')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Profile')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.1 on 2026-10-18 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_import_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivitySequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('value', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 2.0.1 on 2026-10-18 14:51
+
+from django.db import migrations, models, transaction
+import django.db.models.deletion
+from django.db.models import Exists, Max, OuterRef, Subquery
+
+
+def backfill_active_step(apps, schema_editor):
+    # 和 AuditActivity.backfillActiveStep 一样分批回填，上线之后进行中的审批单马上有当前审批步骤；
+    # 用这个 migration 时的 model，之后修改 model 不影响
+    AuditActivity = apps.get_model('core', 'AuditActivity')
+    AuditStep = apps.get_model('core', 'AuditStep')
+    Message = apps.get_model('core', 'Message')
+
+    steps = AuditStep.objects \
+        .filter(activity=OuterRef('pk'), active=True) \
+        .order_by('position')
+    decided = AuditStep.objects \
+        .filter(activity=OuterRef('pk')) \
+        .exclude(state='pending')
+
+    activityIds = list(AuditActivity.objects.order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(activityIds), 500):
+        batch = activityIds[i:i + 500]
+        with transaction.atomic():
+            AuditActivity.objects \
+                .filter(pk__in=batch) \
+                .update(activeStep=Subquery(steps.values('pk')[:1]),
+                        activeAssignee=Subquery(steps.values('assignee')[:1]),
+                        stepDecided=Exists(decided),
+                        hurried_at=None)
+            hurried = Message.objects \
+                .filter(activity__in=batch, category='hurryup') \
+                .values('activity') \
+                .annotate(hurried_at=Max('created_at'))
+            for row in hurried:
+                AuditActivity.objects \
+                    .filter(pk=row['activity']) \
+                    .update(hurried_at=row['hurried_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_activity_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='auditactivity',
+            name='activeAssignee',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Profile'),
+        ),
+        migrations.AddField(
+            model_name='auditactivity',
+            name='activeStep',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.AuditStep'),
+        ),
+        migrations.AddField(
+            model_name='auditactivity',
+            name='hurried_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='auditactivity',
+            name='stepDecided',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(backfill_active_step, migrations.RunPython.noop),
+    ]
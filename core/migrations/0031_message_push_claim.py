@@ -0,0 +1,22 @@
+# Generated by Django 2.0.1 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_activity_active_step'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='apn_claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['apn_sent', 'category', 'read'], name='core_messag_apn_sen_af51e9_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.0.1 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_message_push_claim'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheEntry',
+            fields=[
+                ('key', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('value', models.BinaryField()),
+                ('expires', models.DateTimeField(db_index=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.0.1 on 2026-10-18 15:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_cache_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255, unique=True)),
+                ('active', models.IntegerField(default=0)),
+                ('latest', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='customerstat',
+            name='generation',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='taizhangstat',
+            name='generation',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='transactionstat',
+            name='generation',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+    ]
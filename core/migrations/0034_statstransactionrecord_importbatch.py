@@ -0,0 +1,18 @@
+# Generated by Django 2.0.1 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_stats_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statstransactionrecord',
+            name='importBatch',
+            field=models.UUIDField(db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.0.1 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_statstransactionrecord_importbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bankaccount',
+            name='memoVersion',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='company',
+            name='memoVersion',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='memo',
+            name='memoVersion',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+    ]
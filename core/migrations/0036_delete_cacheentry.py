@@ -0,0 +1,16 @@
+# Generated by Django 2.0.1 on 2026-10-18 17:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_memo_version'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='CacheEntry',
+        ),
+    ]
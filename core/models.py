@@ -3,7 +3,8 @@ import uuid
 
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 
 from jsonfield import JSONField
 
@@ -146,6 +147,41 @@ class Profile(models.Model):
             .first()
 
 
+def resolveActivityDisplayCategory(subtype):
+    category = ''
+    if any([k in subtype for k in ['cost', 'money', 'loan', 'open_account', 'travel']]):
+        category = '财务类'
+    if 'contract' in subtype:
+        category = '法务类'
+
+    return category
+
+
+def resolveActivityDisplayName(creatorName, subtype):
+    category = resolveActivityDisplayCategory(subtype)
+    return '{}的{}审批'.format(creatorName, category)
+
+
+def resolveActivityDisplayType(subtype):
+    r = ''
+    if 'cost' in subtype:
+        r = '费用报销'
+    elif 'loan' in subtype:
+        r = '借款申请'
+    elif 'money' in subtype:
+        r = '用款申请'
+    elif 'open_account' in subtype:
+        r = '银行开户'
+    elif 'travel' in subtype:
+        r = '差旅报销'
+    elif 'biz' in subtype:
+        r = '业务合同会签'
+    elif 'fn' in subtype:
+        r = '职能合同会签'
+
+    return r
+
+
 # TODO: 支持待处理任务的生成
 class AuditActivityConfig(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
@@ -191,26 +227,27 @@ class AuditActivity(models.Model):
     taskState = models.CharField(null=True, max_length=255)  # None or (pending / finished)
     amount = models.DecimalField(max_digits=32, decimal_places=2, null=True)
 
+    # 搜索索引，分别和 appDisplayName / appDisplayType 一致
+    searchName = models.CharField(max_length=255, default='')
+    searchType = models.CharField(max_length=255, default='')
+
+    # 审批步骤的冗余状态，由提交、审批、撤回、催办维护，列表不需要再查询审批步骤和消息
+    activeStep = models.ForeignKey('AuditStep', null=True, on_delete=models.SET_NULL, related_name='+')  # 当前审批步骤
+    activeAssignee = models.ForeignKey(Profile, null=True, on_delete=models.SET_NULL, related_name='+')  # 当前审批人
+    stepDecided = models.BooleanField(default=False)  # 是否已经有审批步骤通过或者拒绝
+    hurried_at = models.DateTimeField(null=True)  # 当前审批步骤最后一次催办的时间
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def isCancellable(self):
-        if self.state != self.StateProcessing:
-            return False
-
-        steps = AuditStep.objects.filter(activity=self)
-        pendingSteps = AuditStep.objects.filter(activity=self,
-                                                state=AuditStep.StatePending)
-        return steps.count() == pendingSteps.count()
+        return self.state == self.StateProcessing and not self.stepDecided
 
     def currentStep(self):
         if self.state != self.StateProcessing:
             return None
 
-        return AuditStep.objects \
-            .filter(activity=self, active=True) \
-            .order_by('position') \
-            .first()
+        return self.activeStep
 
     def steps(self):
         return AuditStep.objects \
@@ -219,48 +256,72 @@ class AuditActivity(models.Model):
 
     @property
     def canHurryup(self):
+        # 一天之内只能催办一次
         now = datetime.datetime.now(tz=timezone.utc)
-        start = now - datetime.timedelta(days=1)
-        hurryupMsgs = Message.objects \
-            .filter(activity=self,
-                    category='hurryup',
-                    created_at__gte=start,
-                    created_at__lt=now)
-        return hurryupMsgs.count() == 0
+        return self.hurried_at is None or self.hurried_at < now - datetime.timedelta(days=1)
 
     @property
     def appDisplayName(self):
-        creatorName = self.creator.name
-        subtype = self.config.subtype
-
-        category = ''
-        if any([k in subtype for k in ['cost', 'money', 'loan', 'open_account', 'travel']]):
-            category = '财务类'
-        if 'contract' in subtype:
-            category = '法务类'
-
-        return '{}的{}审批'.format(creatorName, category)
+        return resolveActivityDisplayName(self.creator.name, self.config.subtype)
 
     @property
     def appDisplayType(self):
-        r = ''
-        subtype = self.config.subtype
-        if 'cost' in subtype:
-            r = '费用报销'
-        elif 'loan' in subtype:
-            r = '借款申请'
-        elif 'money' in subtype:
-            r = '用款申请'
-        elif 'open_account' in subtype:
-            r = '银行开户'
-        elif 'travel' in subtype:
-            r = '差旅报销'
-        elif 'biz' in subtype:
-            r = '业务合同会签'
-        elif 'fn' in subtype:
-            r = '职能合同会签'
-
-        return r
+        return resolveActivityDisplayType(self.config.subtype)
+
+    @classmethod
+    def updateSearchIndexForCreator(cls, creator):
+        # 发起人改名后需要同步更新搜索索引
+        configs = AuditActivityConfig.objects \
+            .filter(auditactivity__creator=creator) \
+            .distinct()
+        for config in configs:
+            cls.objects \
+                .filter(creator=creator, config=config) \
+                .update(searchName=resolveActivityDisplayName(creator.name, config.subtype))
+
+    @classmethod
+    def updateActiveStep(cls, activities, **fields):
+        '''
+        根据审批步骤重新计算 activeStep / activeAssignee / stepDecided，activities 为审批单或者 id，
+        fields 为同时需要更新的其他字段
+        '''
+        steps = AuditStep.objects \
+            .filter(activity=models.OuterRef('pk'), active=True) \
+            .order_by('position')
+        decided = AuditStep.objects \
+            .filter(activity=models.OuterRef('pk')) \
+            .exclude(state=AuditStep.StatePending)
+        cls.objects \
+            .filter(pk__in=activities) \
+            .update(activeStep=models.Subquery(steps.values('pk')[:1]),
+                    activeAssignee=models.Subquery(steps.values('assignee')[:1]),
+                    stepDecided=models.Exists(decided),
+                    **fields)
+
+    @classmethod
+    def backfillActiveStep(cls, activities):
+        '''
+        根据审批步骤和催办消息回填一批审批单的 activeStep / activeAssignee / stepDecided / hurried_at，
+        migration 和 backfillActiveStep 命令共用
+        '''
+        with transaction.atomic():
+            cls.updateActiveStep(activities, hurried_at=None)
+            hurried = Message.objects \
+                .filter(activity__in=activities, category='hurryup') \
+                .values('activity') \
+                .annotate(hurried_at=models.Max('created_at'))
+            for row in hurried:
+                cls.objects \
+                    .filter(pk=row['activity']) \
+                    .update(hurried_at=row['hurried_at'])
+
+
+class ActivitySequence(models.Model):
+    '''
+    审批单流水号，每天一行，value 为当天已经分配的最大序号
+    '''
+    date = models.DateField(unique=True)
+    value = models.IntegerField(default=0)
 
 
 class AuditStep(models.Model):
@@ -291,6 +352,12 @@ class AuditStep(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # 待我审批/我已审批/与我相关的审批列表
+            models.Index(fields=['assignee', 'active', 'state']),
+        ]
+
     def prevStep(self):
         if self.position == 0:
             return None
@@ -315,18 +382,48 @@ class File(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
 
+# 导入 Excel 的后台任务
+class ImportJob(models.Model):
+    StatePending = 'pending'
+    StateRunning = 'running'
+    StateFinished = 'finished'
+    StateFailed = 'failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    category = models.CharField(max_length=255)  # customers/fin-accounts/transaction-records
+    file = models.ForeignKey(File, on_delete=models.CASCADE)
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    state = models.CharField(max_length=20, default=StatePending)
+
+    total = models.IntegerField(default=0)
+    success = models.IntegerField(default=0)
+    fail = models.IntegerField(default=0)
+    errors = JSONField(default=list)
+
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class BankAccount(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE, null=True)
     name = models.CharField(max_length=255)
     number = models.CharField(max_length=255)
     bank = models.CharField(max_length=255)
+    memoVersion = models.IntegerField(null=True, db_index=True)  # 第一次加载时的记忆数据版本号
+
+    created_at = models.DateTimeField(auto_now_add=True)
 
 
 class Company(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE, null=True)
     name = models.CharField(max_length=255)
+    memoVersion = models.IntegerField(null=True, db_index=True)  # 第一次加载时的记忆数据版本号
+
+    created_at = models.DateTimeField(auto_now_add=True)
 
 
 # 记忆数据
@@ -334,6 +431,9 @@ class Memo(models.Model):
     category = models.CharField(max_length=255)  # upstream/downstream/asset...
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE, null=True)
     value = models.CharField(max_length=255, null=True)
+    memoVersion = models.IntegerField(null=True, db_index=True)  # 第一次加载时的记忆数据版本号
+
+    created_at = models.DateTimeField(auto_now_add=True)
 
 
 class Message(models.Model):
@@ -345,11 +445,18 @@ class Message(models.Model):
                                  null=True)
     category = models.CharField(max_length=255)  # hurryup/finish/progress
     apn_sent = models.BooleanField(default=False)
+    apn_claimed_at = models.DateTimeField(null=True)  # 推送 worker 领取的时间
     extra = JSONField()
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # 推送 worker 查询待推送的消息
+            models.Index(fields=['apn_sent', 'category', 'read']),
+        ]
+
 
 CustomerCatgetories = (
     ('c1', '大型生产商/终端用户'),
@@ -440,10 +547,16 @@ class StatsTransactionRecord(models.Model):
     balance = models.FloatField()
     other = models.CharField(max_length=255)  # 对方账号名称
     archived = models.BooleanField(default=False)
+    importBatch = models.UUIDField(null=True, db_index=True)  # 同一次导入的记录相同
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['number', 'date']),
+        ]
+
 
 class StatsTransactionRecordOps(models.Model):
     record = models.ForeignKey(StatsTransactionRecord, on_delete=models.CASCADE)
@@ -531,12 +644,91 @@ class TaizhangOps(models.Model):
 class StatsEvent(models.Model):
     source = models.CharField(max_length=255)  # customer/taizhang/funds
     event = models.CharField(max_length=255)  # invalidate
+    # 受影响的范围，比如资金信息：{'numbers': [账号], 'since': 'YYYY-MM-DD'}，为空表示全部
+    extra = JSONField(null=True)
+    handled = models.BooleanField(default=False)  # 统计数据是否已经更新
 
     created_at = models.DateTimeField(auto_now_add=True)
 
 
+class StatsGeneration(models.Model):
+    '''
+    统计数据的版本：重新计算时先写入新的 generation，写完之后再切换 active，
+    接口只读取 active 的数据，不会读到删了一半或者还没写完的统计数据
+    '''
+    source = models.CharField(max_length=255, unique=True)  # customer/taizhang/funds
+    active = models.IntegerField(default=0)
+    latest = models.IntegerField(default=0)  # 已经分配出去的最大 generation
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def activeExpression(cls, source):
+        # 还没有重新计算过的统计数据都是 0
+        active = cls.objects.filter(source=source).values('active')[:1]
+        return Coalesce(models.Subquery(active, output_field=models.IntegerField()), models.Value(0))
+
+    @classmethod
+    def current(cls, source, lock=False):
+        '''
+        lock 为 True 时在事务提交之前不能切换 generation
+        '''
+        generations = cls.objects.filter(source=source)
+        if lock:
+            generations = generations.select_for_update()
+        generation = generations.first()
+        return generation.active if generation is not None else 0
+
+    @classmethod
+    def allocate(cls, source):
+        '''
+        分配一个新的 generation 用来写入重新计算的统计数据
+        '''
+        with transaction.atomic():
+            generation, _ = cls.objects.select_for_update().get_or_create(source=source)
+            generation.latest = max(generation.latest, generation.active) + 1
+            generation.save(update_fields=['latest', 'updated_at'])
+        return generation.latest
+
+    @classmethod
+    def activate(cls, source, model, generation):
+        '''
+        切换到已经写完的 generation，再删除更旧的 generation 的数据（包括之前失败留下的），
+        更新的 generation 可能还有别的重新计算正在写入，不能删除；
+        返回 False 表示已经有更新的 generation，这次写入的数据直接删除
+        '''
+        with transaction.atomic():
+            row = cls.objects.select_for_update().get(source=source)
+            activated = generation > row.active
+            if activated:
+                row.active = generation
+                row.save(update_fields=['active', 'updated_at'])
+
+        if not activated:
+            model.objects.filter(generation=generation).delete()
+            return False
+
+        model.objects.filter(generation__lt=row.active).delete()
+        return True
+
+
+class GenerationStat(models.Model):
+    statsSource = None
+
+    generation = models.IntegerField(default=0, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def active(cls):
+        return cls.objects.filter(generation=StatsGeneration.activeExpression(cls.statsSource))
+
+
 # 资金信息统计数据
-class TransactionStat(models.Model):
+class TransactionStat(GenerationStat):
+    statsSource = 'funds'
+
     account = models.ForeignKey(FinAccount, on_delete=models.CASCADE)
 
     category = models.CharField(max_length=255)  # week / total
@@ -547,7 +739,9 @@ class TransactionStat(models.Model):
     balance = models.DecimalField(decimal_places=2, max_digits=19)
 
 
-class TaizhangStat(models.Model):
+class TaizhangStat(GenerationStat):
+    statsSource = 'taizhang'
+
     category = models.CharField(max_length=255)  # month / total
 
     month = models.CharField(max_length=255, null=True)
@@ -560,7 +754,9 @@ class TaizhangStat(models.Model):
     zijin_zhanya = models.DecimalField(decimal_places=2, max_digits=19)
 
 
-class CustomerStat(models.Model):
+class CustomerStat(GenerationStat):
+    statsSource = 'customer'
+
     category = models.CharField(max_length=255)  # month / total
     month = models.CharField(max_length=255, null=True)
 
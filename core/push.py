@@ -0,0 +1,179 @@
+import json
+import time
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from core.models import *
+
+logger = logging.getLogger('app.core.push')
+
+# 极光推送一次最多 1000 个 registration_id
+MAX_AUDIENCE = 1000
+
+
+class PushError(Exception):
+    def __init__(self, status, result, retry):
+        super().__init__('jpush error, status: {}, result: {}'.format(status, result))
+        self.retry = retry
+
+
+def pendingMessages():
+    '''
+    需要推送的消息：待审批，既没有被阅读，也没有被推送
+    '''
+    return Message.objects.filter(category='progress', apn_sent=False, read=False)
+
+
+def claimMessages(limit):
+    '''
+    领取一批待推送的消息，领取之后 JPUSH_CLAIM_TIMEOUT 秒之内其他 worker 不会再领取；
+    推送失败的消息超时之后重新领取
+    '''
+    now = datetime.datetime.now(tz=timezone.utc)
+    expired = now - datetime.timedelta(seconds=settings.JPUSH_CLAIM_TIMEOUT)
+    claimable = Q(apn_claimed_at=None) | Q(apn_claimed_at__lt=expired)
+    messageIds = list(pendingMessages()
+                      .filter(claimable)
+                      .order_by('created_at')
+                      .values_list('pk', flat=True)[:limit])
+    if len(messageIds) == 0:
+        return []
+
+    # 领取时间同时作为这一批的标识，同时领取的 worker 只有一个能更新成功
+    Message.objects \
+        .filter(claimable, pk__in=messageIds) \
+        .update(apn_claimed_at=now)
+    return list(Message.objects
+                .filter(pk__in=messageIds, apn_claimed_at=now)
+                .select_related('profile'))
+
+
+def createSession():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.JPUSH_CONCURRENCY)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = HTTPBasicAuth(settings.JPUSH_APP_KEY, settings.JPUSH_APP_SECRET)
+    return session
+
+
+def push(session, registrationIds):
+    r = session.post(settings.JPUSH_URL,
+                     data=json.dumps({
+                         "platform": "all",
+                         "audience": {
+                             "registration_id": registrationIds
+                         },
+                         "notification": {
+                             "alert": "您有新的审批需要处理！"
+                         },
+                         "options": {
+                             "apns_production": settings.JPUSH_APNS_PRODUCTION
+                         }
+                     }),
+                     timeout=settings.JPUSH_TIMEOUT)
+    try:
+        result = r.json()
+    except ValueError:
+        result = r.text
+
+    if r.status_code == 200 and isinstance(result, dict) and 'error' not in result:
+        return result
+    # 限流和服务端错误可以重试，其他错误（比如设备已经失效）重试也不会成功
+    raise PushError(r.status_code, result, retry=r.status_code == 429 or r.status_code >= 500)
+
+
+def pushWithRetry(session, registrationIds):
+    '''
+    推送失败时按指数退避重试，返回是否推送成功（或者确定不需要再推送）
+    '''
+    for attempt in range(settings.JPUSH_RETRIES + 1):
+        try:
+            push(session, registrationIds)
+            return True
+        except PushError as e:
+            if not e.retry:
+                logger.error('drop push to {} devices: {}'.format(len(registrationIds), e))
+                return True
+            error = e
+        except requests.RequestException as e:
+            error = e
+
+        if attempt < settings.JPUSH_RETRIES:
+            time.sleep(settings.JPUSH_BACKOFF * (2 ** attempt))
+
+    logger.error('fail to push to {} devices: {}'.format(len(registrationIds), error))
+    return False
+
+
+class PushWorker(object):
+    '''
+    批量推送待审批消息：每批领取 JPUSH_BATCH_SIZE 条消息，相同提醒内容的设备合并成一次推送，
+    推送请求复用 HTTP 连接，最多 JPUSH_CONCURRENCY 个请求同时进行
+    '''
+
+    def __init__(self):
+        self.session = createSession()
+        self.executor = ThreadPoolExecutor(max_workers=settings.JPUSH_CONCURRENCY)
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+    def runOnce(self):
+        '''
+        处理一批消息，返回领取的消息数量
+        '''
+        messages = claimMessages(settings.JPUSH_BATCH_SIZE)
+        if len(messages) == 0:
+            return 0
+
+        # 没有设备或者已经不能登录的员工不需要推送
+        sent = []
+        targets = {}
+        for message in messages:
+            profile = message.profile
+            if profile.archived or profile.blocked or not profile.deviceId:
+                sent.append(message.pk)
+            else:
+                targets.setdefault(profile.deviceId, []).append(message.pk)
+
+        registrationIds = list(targets.keys())
+        chunks = [registrationIds[i:i + MAX_AUDIENCE] for i in range(0, len(registrationIds), MAX_AUDIENCE)]
+        results = self.executor.map(lambda chunk: pushWithRetry(self.session, chunk), chunks)
+        for chunk, ok in zip(chunks, results):
+            if ok:
+                for registrationId in chunk:
+                    sent.extend(targets[registrationId])
+
+        if len(sent) > 0:
+            Message.objects.filter(pk__in=sent).update(apn_sent=True)
+        return len(messages)
+
+    def run(self, once=False):
+        '''
+        once 为 True 时处理完当前所有待推送的消息就返回
+        '''
+        while True:
+            try:
+                count = self.runOnce()
+            except:
+                logger.exception('some error happens while sending push notifications.')
+                count = 0
+                # 数据库连接断开之后下一次重新连接
+                connection.close()
+
+            if count < settings.JPUSH_BATCH_SIZE:
+                if once:
+                    return
+                time.sleep(settings.JPUSH_POLL_INTERVAL)
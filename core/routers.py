@@ -0,0 +1,19 @@
+from django.conf import settings
+
+
+class CacheRouter:
+    '''
+    数据库缓存（DatabaseCache）的读写走单独的 cache 连接：不在请求的事务里，
+    写入立即提交，不会把缓存行锁到请求的事务结束，其他节点也马上能看到
+    '''
+
+    def _cacheDB(self, model):
+        if model._meta.app_label == 'django_cache' and 'cache' in settings.DATABASES:
+            return 'cache'
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._cacheDB(model)
+
+    def db_for_write(self, model, **hints):
+        return self._cacheDB(model)
@@ -5,3 +5,11 @@ from .specs import *
 from .roles import *
 from .stats import *
 from .auditExport import *
+from .activities import *
+from .imports import *
+from .exports import *
+from .customers import *
+from .workflow import *
+from .push import *
+from .cache import *
+from .charts import *
@@ -0,0 +1,461 @@
+import io
+import json
+import datetime
+import importlib
+import time
+import threading
+
+from freezegun import freeze_time
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, OperationalError
+from django.db.migrations.loader import MigrationLoader
+from django.test import TestCase, TransactionTestCase
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from core import specs
+from core.common import *
+from core.models import *
+from core.auth import generateToken
+from core.tests import helpers
+from core.views.audit import createActivity, generateActivitySN
+
+
+class ActivityListTestCase(TestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        self.config = specs.createAuditConfig(
+            spec='fin.qa_cost:_.qa_owner->qa_fin.qa_accountant->qa_root.qa_ceo...')
+
+    def createActivities(self, count, creator='qa-jack'):
+        for i in range(count):
+            createActivity(self.org[creator], {
+                'code': self.config.subtype,
+                'submit': True,
+                'extra': {'amount': 100 + i}
+            })
+
+    def approve(self, name):
+        client = Client()
+        token = generateToken(self.org[name])
+        steps = AuditStep.objects.filter(assignee=self.org[name], active=True)
+        for step in steps:
+            response = client.post(
+                '/api/v1/audit-steps/{}/actions/approve'.format(step.pk),
+                json.dumps({}),
+                content_type='application/json',
+                HTTP_AUTHORIZATION=token)
+            self.assertEqual(response.status_code, 200)
+
+    def countQueries(self, url, profile):
+        client = Client()
+        token = generateToken(profile)
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get(url, HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode('utf-8'))
+        return len(ctx.captured_queries), result
+
+    def assertConstantQueries(self, url, profile, prepare):
+        prepare(2)
+        few, result = self.countQueries(url, profile)
+        self.assertEqual(len(result['activities']), 2)
+
+        prepare(8)
+        many, result = self.countQueries(url, profile)
+        self.assertEqual(len(result['activities']), 10)
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 10)
+
+    def test_resolve_activities_same_as_resolve_activity(self):
+        self.createActivities(3)
+        self.approve('qa-lee')
+        self.createActivities(2, creator='qa-lucy')
+        activity = AuditActivity.objects.filter(creator=self.org['qa-lucy']).first()
+        response = Client().post('/api/v1/audit-activities/{}/actions/hurryup'.format(activity.pk),
+                                 HTTP_AUTHORIZATION=generateToken(self.org['qa-lucy']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Message.objects.filter(activity=activity, category='hurryup').count(), 1)
+
+        activities = AuditActivity.objects.order_by('-updated_at')
+        expected = [resolve_activity(a, include_steps=False) for a in activities]
+        actual = resolve_activities(activities)
+        self.assertEqual(json.dumps(actual, cls=DjangoJSONEncoder),
+                         json.dumps(expected, cls=DjangoJSONEncoder))
+        self.assertEqual([a['cancellable'] for a in actual].count(True), 2)
+        self.assertEqual([a['canHurryup'] for a in actual].count(False), 1)
+
+    def test_mine_activities_queries(self):
+        self.assertConstantQueries('/api/v1/mine-audit-activities',
+                                   self.org['qa-jack'],
+                                   self.createActivities)
+
+    def test_assigned_activities_queries(self):
+        self.assertConstantQueries('/api/v1/assigned-audit-activities',
+                                   self.org['qa-lee'],
+                                   self.createActivities)
+
+    def test_related_activities_queries(self):
+        self.assertConstantQueries('/api/v1/related-audit-activities',
+                                   self.org['qa-lee'],
+                                   self.createActivities)
+
+    def test_processed_activities_queries(self):
+        def prepare(count):
+            self.createActivities(count)
+            self.approve('qa-lee')
+
+        self.assertConstantQueries('/api/v1/processed-audit-activities',
+                                   self.org['qa-lee'],
+                                   prepare)
+
+    def test_audit_tasks_queries(self):
+        def prepare(count):
+            self.createActivities(count)
+            for name in ['qa-lee', 'qa-lucy', 'qa-ceo']:
+                self.approve(name)
+
+        self.assertConstantQueries('/api/v1/audit-tasks',
+                                   self.org['qa-neo'],
+                                   prepare)
+
+
+    def fetchActivity(self, activity):
+        client = Client()
+        token = generateToken(self.org['qa-jack'])
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get('/api/v1/audit-activities/{}'.format(activity.pk), HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.content
+
+    def test_activity_detail_queries(self):
+        self.createActivities(1)
+        short = AuditActivity.objects.get(config=self.config)
+        config = specs.createAuditConfig(
+            spec='fin.qa_cost_long:_.qa_owner->qa_fin.qa_accountant->qa_fin.qa_owner->qa_biz.qa_owner->qa_root.qa_ceo')
+        createActivity(self.org['qa-jack'], {'code': config.subtype, 'submit': True, 'extra': {'amount': 100}})
+        long = AuditActivity.objects.get(config=config)
+
+        few, content = self.fetchActivity(short)
+        self.assertEqual(len(json.loads(content.decode('utf-8'))['steps']), 3)
+        many, content = self.fetchActivity(long)
+        self.assertEqual(len(json.loads(content.decode('utf-8'))['steps']), 4)
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 10)
+
+    def test_activity_detail_payload(self):
+        self.createActivities(1)
+        activity = AuditActivity.objects.get(config=self.config)
+        count, content = self.fetchActivity(activity)
+
+        # 审批人的记忆数据、消息等不会出现在审批详情里
+        for profile in self.org.values():
+            if isinstance(profile, Profile):
+                for i in range(20):
+                    Company.objects.create(profile=profile, name='company-{}'.format(i))
+                    Memo.objects.create(profile=profile, category='test', value='memo-{}'.format(i))
+        self.assertEqual(self.fetchActivity(activity)[1], content)
+
+        result = json.loads(content.decode('utf-8'))
+        self.assertEqual(sorted(result['steps'][0]['assignee'].keys()),
+                         ['department', 'email', 'id', 'name', 'phone', 'position'])
+        self.assertLess(len(json.dumps(result['steps'])), 4096)
+
+
+class ActiveStepTestCase(TestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        config = specs.createAuditConfig(spec='fin.qa_cost:_.qa_owner->qa_fin.qa_accountant->qa_root.qa_ceo')
+        self.activity = createActivity(self.org['qa-jack'], {
+            'code': config.subtype,
+            'submit': True,
+            'extra': {}
+        })
+
+    def reload(self):
+        return AuditActivity.objects.get(pk=self.activity.pk)
+
+    def post(self, url, name):
+        response = Client().post(url, json.dumps({}),
+                                 content_type='application/json',
+                                 HTTP_AUTHORIZATION=generateToken(self.org[name]))
+        self.assertEqual(response.status_code, 200)
+
+    def approve(self, name):
+        step = self.reload().activeStep
+        self.post('/api/v1/audit-steps/{}/actions/approve'.format(step.pk), name)
+
+    def hurryup(self):
+        self.post('/api/v1/audit-activities/{}/actions/hurryup'.format(self.activity.pk), 'qa-jack')
+
+    def assertActiveStep(self, position, name):
+        activity = self.reload()
+        step = AuditStep.objects.get(activity=activity, position=position)
+        self.assertEqual(activity.activeStep, step)
+        self.assertEqual(activity.currentStep(), step)
+        self.assertEqual(activity.activeAssignee, self.org[name])
+
+    def test_submit(self):
+        self.assertActiveStep(0, 'qa-lee')
+        activity = self.reload()
+        self.assertFalse(activity.stepDecided)
+        self.assertTrue(activity.isCancellable())
+        self.assertTrue(activity.canHurryup)
+
+    def test_approve(self):
+        self.approve('qa-lee')
+        self.assertActiveStep(1, 'qa-lucy')
+        self.assertTrue(self.reload().stepDecided)
+        self.assertFalse(self.reload().isCancellable())
+
+        self.approve('qa-lucy')
+        self.approve('qa-ceo')
+        activity = self.reload()
+        self.assertEqual(activity.state, AuditActivity.StateApproved)
+        self.assertIsNone(activity.activeStep)
+        self.assertIsNone(activity.activeAssignee)
+        self.assertIsNone(activity.currentStep())
+
+    def test_reject(self):
+        step = self.reload().activeStep
+        self.post('/api/v1/audit-steps/{}/actions/reject'.format(step.pk), 'qa-lee')
+        activity = self.reload()
+        self.assertIsNone(activity.activeStep)
+        self.assertIsNone(activity.activeAssignee)
+        self.assertTrue(activity.stepDecided)
+
+    def test_cancel_and_resubmit(self):
+        self.post('/api/v1/audit-activities/{}/actions/cancel'.format(self.activity.pk), 'qa-jack')
+        activity = self.reload()
+        self.assertEqual(activity.state, AuditActivity.StateCancelled)
+        self.assertIsNone(activity.activeStep)
+        self.assertIsNone(activity.activeAssignee)
+
+        self.post('/api/v1/audit-activities/{}/actions/submit-audit'.format(self.activity.pk), 'qa-jack')
+        self.assertActiveStep(0, 'qa-lee')
+
+    def test_hurryup(self):
+        self.hurryup()
+        self.hurryup()
+        # 一天之内只能催办一次
+        self.assertFalse(self.reload().canHurryup)
+        self.assertEqual(Message.objects.filter(category='hurryup', profile=self.org['qa-lee']).count(), 1)
+
+        # 审批之后可以催办下一位审批人
+        self.approve('qa-lee')
+        self.assertTrue(self.reload().canHurryup)
+        self.hurryup()
+        self.assertEqual(Message.objects.filter(category='hurryup', profile=self.org['qa-lucy']).count(), 1)
+
+        activity = self.reload()
+        activity.hurried_at = activity.hurried_at - datetime.timedelta(days=2)
+        activity.save()
+        self.assertTrue(self.reload().canHurryup)
+
+    def test_backfill(self):
+        self.approve('qa-lee')
+        self.hurryup()
+        expected = self.reload()
+        AuditActivity.objects.update(activeStep=None, activeAssignee=None, stepDecided=False, hurried_at=None)
+
+        call_command('backfillActiveStep', stdout=io.StringIO())
+        activity = self.reload()
+        self.assertEqual(activity.activeStep, expected.activeStep)
+        self.assertEqual(activity.activeAssignee, expected.activeAssignee)
+        self.assertTrue(activity.stepDecided)
+        self.assertEqual(activity.hurried_at, Message.objects.get(category='hurryup').created_at)
+
+    def test_backfill_in_migration(self):
+        self.approve('qa-lee')
+        expected = self.reload()
+        AuditActivity.objects.update(activeStep=None, activeAssignee=None, stepDecided=False)
+
+        # 用 migration 时的 model 执行
+        name = '0030_activity_active_step'
+        apps = MigrationLoader(connection).project_state(('core', name)).apps
+        importlib.import_module('core.migrations.' + name).backfill_active_step(apps, None)
+        activity = self.reload()
+        self.assertEqual(activity.activeStep, expected.activeStep)
+        self.assertTrue(activity.stepDecided)
+        self.assertFalse(activity.isCancellable())
+
+
+class ActivitySearchTestCase(TestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        specs.createAuditConfig(spec='fin.qa_cost:_.qa_owner->qa_root.qa_ceo')
+        specs.createAuditConfig(spec='law.qa_biz_contract:_.qa_owner->qa_root.qa_ceo')
+
+        for creator in ['qa-jack', 'qa-lucy']:
+            for code in ['qa_cost', 'qa_biz_contract']:
+                createActivity(self.org[creator], {
+                    'code': code,
+                    'submit': True,
+                    'extra': {}
+                })
+
+    def search(self, url, profile, search):
+        client = Client()
+        response = client.get(url,
+                              {'search': search},
+                              HTTP_AUTHORIZATION=generateToken(profile))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def expected(self, activities, search):
+        # 原先在 python 里面逐条匹配的规则
+        keywords = [k for k in search.split(' ') if k != '']
+        return [str(a.pk) for a in activities.order_by('-updated_at')
+                if any([k in a.appDisplayType for k in keywords]) or
+                any([k in a.appDisplayName for k in keywords])]
+
+    def test_search_index(self):
+        activity = AuditActivity.objects.filter(config__subtype='qa_biz_contract').first()
+        self.assertEqual(activity.searchName, activity.appDisplayName)
+        self.assertEqual(activity.searchType, activity.appDisplayType)
+
+    def test_search_mine_activities(self):
+        jack = self.org['qa-jack']
+        mine = AuditActivity.objects.filter(creator=jack)
+        for search in ['报销', '法务类', 'qa-jack的', '会签 报销', ' ', 'qa-lucy']:
+            result = self.search('/api/v1/mine-audit-activities', jack, search)
+            expected = self.expected(mine, search)
+            self.assertEqual(result['total'], len(expected))
+            self.assertListEqual([a['id'] for a in result['activities']], expected)
+
+    def test_search_related_activities(self):
+        lee = self.org['qa-lee']
+        for search in ['qa-lucy', '财务类审批', '会签']:
+            result = self.search('/api/v1/related-audit-activities', lee, search)
+            expected = self.expected(AuditActivity.objects.filter(creator=self.org['qa-jack']), search)
+            self.assertEqual(result['total'], len(expected))
+            self.assertListEqual([a['id'] for a in result['activities']], expected)
+
+    def test_search_after_creator_deleted(self):
+        jack = self.org['qa-jack']
+        client = Client()
+        response = client.delete('/api/v1/emps/{}'.format(jack.pk),
+                                 HTTP_AUTHORIZATION=generateToken(self.org['qa-ceo']))
+        self.assertEqual(response.status_code, 200)
+
+        for activity in AuditActivity.objects.filter(creator=jack):
+            self.assertEqual(activity.searchName, activity.appDisplayName)
+            self.assertTrue(activity.searchName.startswith('已删除-'))
+
+
+class StepActivitiesFilterTestCase(TestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        specs.createAuditConfig(spec='fin.qa_cost:_.qa_owner->qa_root.qa_ceo')
+        specs.createAuditConfig(spec='fin.qa_loan:_.qa_owner->qa_root.qa_ceo')
+
+        for code in ['qa_cost', 'qa_loan']:
+            createActivity(self.org['qa-jack'], {
+                'code': code,
+                'submit': True,
+                'extra': {'amount': 100 if code == 'qa_cost' else 1000}
+            })
+
+    def query(self, url, profile, params):
+        client = Client()
+        response = client.get(url, params, HTTP_AUTHORIZATION=generateToken(profile))
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.decode('utf-8'))
+        return [a['type'] for a in result['activities']], result['total']
+
+    def test_filter_assigned_activities(self):
+        lee = self.org['qa-lee']
+        url = '/api/v1/assigned-audit-activities'
+        self.assertEqual(self.query(url, lee, {})[1], 2)
+        self.assertEqual(self.query(url, lee, {'type': 'qa_cost'}), (['qa_cost'], 1))
+        self.assertEqual(self.query(url, lee, {'amount_start': '500'}), (['qa_loan'], 1))
+        self.assertEqual(self.query(url, lee, {'creator': 'qa-lucy'}), ([], 0))
+        self.assertEqual(self.query(url, self.org['qa-ceo'], {}), ([], 0))
+
+    def test_filter_processed_and_related_activities(self):
+        lee = self.org['qa-lee']
+        step = AuditStep.objects.get(assignee=lee, activity__config__subtype='qa_cost')
+        client = Client()
+        response = client.post('/api/v1/audit-steps/{}/actions/approve'.format(step.pk),
+                               json.dumps({}),
+                               content_type='application/json',
+                               HTTP_AUTHORIZATION=generateToken(lee))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.query('/api/v1/processed-audit-activities', lee, {}), (['qa_cost'], 1))
+        self.assertEqual(self.query('/api/v1/related-audit-activities', lee, {})[1], 2)
+        self.assertEqual(self.query('/api/v1/related-audit-activities', lee, {'type': 'qa_loan'}),
+                         (['qa_loan'], 1))
+        self.assertEqual(self.query('/api/v1/related-audit-activities', self.org['qa-ceo'], {}),
+                         (['qa_cost'], 1))
+
+        AuditActivity.objects.filter(config__subtype='qa_cost').update(archived=True)
+        self.assertEqual(self.query('/api/v1/processed-audit-activities', lee, {}), ([], 0))
+
+
+class ActivitySNTestCase(TransactionTestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        self.config = specs.createAuditConfig(spec='fin.qa_cost:_.qa_owner->qa_root.qa_ceo')
+
+    def create(self):
+        return createActivity(self.org['qa-jack'], {
+            'code': self.config.subtype,
+            'submit': False,
+            'extra': {}
+        })
+
+    def test_sequential_sn(self):
+        sns = [self.create().sn for i in range(3)]
+        self.assertEqual([sn[-4:] for sn in sns], ['0001', '0002', '0003'])
+        self.assertEqual(len(set(sn[:8] for sn in sns)), 1)
+
+    def continueExistingActivities(self, day):
+        # 上线当天已经按数量生成过流水号的审批单
+        AuditActivity.objects.create(sn='legacy', config=self.config, creator=self.org['qa-jack'], extra={})
+        AuditActivity.objects.create(sn='legacy', config=self.config, creator=self.org['qa-jack'], extra={})
+        sn = self.create().sn
+        self.assertEqual((sn[:8], sn[-4:]), (day, '0003'))
+        self.assertEqual(self.create().sn[-4:], '0004')
+
+    @freeze_time('2018-05-18 08:00:00')
+    def test_continue_existing_activities(self):
+        self.continueExistingActivities('20180518')
+
+    @freeze_time('2018-05-18 18:00:00')
+    def test_continue_existing_activities_after_utc_16(self):
+        # UTC 16 点之后已经是北京时间的第二天
+        self.continueExistingActivities('20180519')
+
+    def test_concurrent_sn(self):
+        errors = []
+        sns = []
+
+        def allocate():
+            # 测试用的 sqlite 遇到锁直接报错而不是等待，这里重试，相当于 MySQL 上等待行锁
+            while True:
+                try:
+                    return generateActivitySN()
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    time.sleep(0.001)
+
+        def run():
+            try:
+                for i in range(5):
+                    sns.append(allocate())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(int(sn[-4:]) for sn in sns), list(range(1, 21)))
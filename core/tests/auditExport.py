@@ -1,16 +1,96 @@
+import io
+import os
 import json
-from django.test import TestCase
+import zipfile
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.test import Client
 
 from core import specs
 from core.models import *
 from core.auth import generateToken
 from core.tests import helpers
-from core.views.auditExport import convertToDaxieAmountV2
+from openpyxl import load_workbook
+from openpyxl.styles import Alignment
+from core.views import auditExport
+from core.views.auditExport import convertToDaxieAmountV2, loadTemplate, getCompiledTemplate, saveWorkbook, \
+    closeExportPool
+
+
+def checkBatchExport(test):
+    org = helpers.prepareOrganization()
+    config = AuditActivityConfig.objects.get(subtype='loan_lte_5000')
+    extra = {
+        'loan': {'amount': '3000', 'application': 'test'},
+        'account': {'name': 'test', 'number': '6222000000000000', 'bank': 'test'}
+    }
+    activities = []
+    for i in range(2):
+        activity = AuditActivity.objects.create(sn='sn-{}'.format(i), config=config, creator=org['qa-jack'],
+                                                extra=extra)
+        AuditStep.objects.create(activity=activity,
+                                 assignee=org['qa-lee'],
+                                 assigneeDepartment=org['qa_biz'],
+                                 assigneePosition=org['qa_owner'],
+                                 position=0)
+        activities.append(activity)
+    # 缺少借款信息，导出失败
+    broken = AuditActivity.objects.create(sn='broken', config=config, creator=org['qa-jack'], extra={})
+
+    # 同一秒创建的审批单
+    AuditActivity.objects.filter(pk__in=[a.pk for a in activities]).update(created_at=activities[0].created_at)
+
+    idx = ','.join([str(a.pk) for a in activities + [broken]])
+    response = Client().get('/api/v1/export-audit', {'idx': idx})
+    test.assertEqual(response.status_code, 200)
+    test.assertEqual(response['Content-Type'], 'application/zip')
+
+    zipf = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+    time_str = activities[0].created_at.strftime('%Y%m%d%H%M%S')
+    test.assertEqual(zipf.namelist(), ['借款审批单-{}.xlsx'.format(time_str),
+                                       '借款审批单-{}-2.xlsx'.format(time_str),
+                                       '导出失败.txt'])
+    ws = load_workbook(io.BytesIO(zipf.read(zipf.namelist()[0]))).active
+    test.assertEqual(ws['C7'].value, 'test')
+    test.assertEqual(zipf.read('导出失败.txt').decode(), str(broken.pk))
 
 
 class AuditExportTestCase(TestCase):
 
     def test_convert_to_daxie(self):
-        result = convertToDaxieAmountV2(1000)
-        print(result)
\ No newline at end of file
+        self.assertEqual(convertToDaxieAmountV2(1000), '壹仟元整')
+
+    def test_load_template(self):
+        wb = loadTemplate('loan')
+        ws = wb.active
+        self.assertEqual(ws['B4'].border.top.border_style, 'medium')
+        self.assertEqual(ws['B4'].border.bottom.border_style, 'thin')
+        self.assertTrue(ws.protection.sheet)
+
+        # 修改复制出来的模板不影响缓存的模板
+        ws['C7'] = 'changed'
+        ws['C7'].alignment = Alignment(horizontal='center', vertical='center')
+        self.assertNotEqual(loadTemplate('loan').active['C7'].value, 'changed')
+        self.assertIsNot(getCompiledTemplate('loan'), wb)
+
+        path = saveWorkbook(wb)
+        saved = load_workbook(path).active
+        self.assertEqual(saved['C7'].value, 'changed')
+        self.assertEqual(saved['C7'].alignment.horizontal, 'center')
+        self.assertEqual(saved['B4'].border.top.border_style, 'medium')
+        os.remove(path)
+
+    def test_batch_export(self):
+        checkBatchExport(self)
+
+
+@override_settings(AUDIT_EXPORT_WORKERS=1)
+class AuditExportPoolTestCase(TransactionTestCase):
+    # worker 进程只能看到已经提交的数据；flush 之后恢复初始化的审批配置
+    serialized_rollback = True
+
+    def tearDown(self):
+        closeExportPool()
+
+    def test_batch_export(self):
+        checkBatchExport(self)
+        self.assertIsNotNone(auditExport.exportPool)
@@ -0,0 +1,59 @@
+import json
+
+from django.core.cache.backends.db import DatabaseCache
+from django.core.management import call_command
+from django.test import TestCase
+from django.test import Client
+from django.test import override_settings
+
+from core.models import *
+from core.auth import generateToken, profileCache
+from core.routers import CacheRouter
+from core.tests import helpers
+from core.views import session
+
+DB_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'core_cache',
+    }
+}
+
+
+@override_settings(CACHES=DB_CACHES)
+class DatabaseCacheTestCase(TestCase):
+    def setUp(self):
+        call_command('createcachetable')
+
+    def node(self):
+        # 另一个节点使用自己的缓存实例
+        return DatabaseCache('core_cache', {})
+
+    def test_router(self):
+        router = CacheRouter()
+        model = self.node().cache_model_class
+        self.assertIsNone(router.db_for_write(model))
+        self.assertIsNone(router.db_for_write(Profile))
+
+        databases = {'default': {}, 'cache': {}}
+        with override_settings(DATABASES=databases):
+            self.assertEqual(router.db_for_write(model), 'cache')
+            self.assertEqual(router.db_for_read(model), 'cache')
+            self.assertIsNone(router.db_for_write(Profile))
+
+    def test_token_shared_between_nodes(self):
+        profile = helpers.prepareProfile('张三', 'root', '18888888888')
+        # 节点 A 登录
+        token = generateToken(profile)
+
+        # 节点 B 使用自己的缓存实例和进程内缓存
+        self.assertEqual(self.node().get('token-' + token), profile.pk)
+        profileCache.evict()
+        response = Client().get('/api/v1/profile', HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['name'], '张三')
+
+    def test_code_shared_between_nodes(self):
+        session.cacheCode('18888888888', '1234')
+        self.assertEqual(self.node().get('code-18888888888'), '1234')
+        self.assertTrue(session.checkCode('18888888888', '1234'))
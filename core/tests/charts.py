@@ -0,0 +1,265 @@
+import json
+from decimal import Decimal
+
+from django.test import TestCase
+from django.test import Client
+from django.test import override_settings
+from django.core.cache import cache
+
+from core.models import *
+from core.auth import generateToken, loadProfile
+from core.common import createStatsEvent, _flushStatsCacheCounts
+from core.tests import helpers
+from core.management.commands import stats
+
+
+class ChartsTestCase(TestCase):
+    def setUp(self):
+        # 统计接口的响应缓存不随测试数据库回滚
+        cache.clear()
+        profile = helpers.prepareProfile('root', 'root', '18888888888')
+        self.token = generateToken(profile)
+        # 先把 profile 放进进程内缓存，下面只统计图表本身的查询
+        loadProfile(self.token)
+        self.client = Client()
+
+    def get(self, url, **params):
+        response = self.client.get(url, params, HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+
+def createTaizhangStat(month, asset, xiaoshoue, lirune, company='公司1'):
+    TaizhangStat.objects.create(
+        category='month', month=month, company=company, asset=asset,
+        xiaoshoue=Decimal(xiaoshoue), lirune=Decimal(lirune),
+        kuchun_liang=Decimal(0), zijin_zhanya=Decimal(0))
+
+
+def prepareTaizhangStats():
+    # 螺纹钢 2018-02 没有数据
+    createTaizhangStat('2018-01', '电解铜', 100, 10)
+    createTaizhangStat('2018-02', '电解铜', 200, 20)
+    createTaizhangStat('2018-03', '电解铜', 300, 30)
+    createTaizhangStat('2018-01', '螺纹钢', 50, 5)
+    createTaizhangStat('2018-03', '螺纹钢', 350, 35)
+    createTaizhangStat('2018-01', '电解铜', 999, 99, company='公司2')
+
+
+class TaizhangChartsTestCase(ChartsTestCase):
+    def setUp(self):
+        super().setUp()
+        prepareTaizhangStats()
+
+    def test_line(self):
+        with self.assertNumQueries(1):
+            result = self.get('/api/v1/charts/taizhang/line', company='公司1', prop='xiaoshoue')
+        self.assertEqual(result, {
+            'months': ['2018-01', '2018-02', '2018-03'],
+            'assets': ['电解铜', '螺纹钢'],
+            'series': [
+                ['100.00', '200.00', '300.00'],
+                ['50.00', '0.00', '350.00'],
+            ]
+        })
+
+        response = self.client.get('/api/v1/charts/taizhang/line',
+                                   {'company': '公司1', 'prop': 'asset'},
+                                   HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, 400)
+
+        result = self.get('/api/v1/charts/taizhang/line', company='公司3', prop='lirune')
+        self.assertEqual(result, {'months': [], 'assets': [], 'series': []})
+
+    def test_line_queries_independent_of_assets(self):
+        for i in range(20):
+            createTaizhangStat('2018-04', 'asset-{}'.format(i), i, i)
+        with self.assertNumQueries(1):
+            result = self.get('/api/v1/charts/taizhang/line', company='公司1', prop='lirune')
+        self.assertEqual(len(result['assets']), 22)
+        self.assertTrue(all(len(s) == 4 for s in result['series']))
+
+    def test_bar(self):
+        with self.assertNumQueries(1):
+            result = self.get('/api/v1/charts/taizhang/bar', company='公司1')
+        self.assertEqual(result, {
+            'months': ['2018-01', '2018-02', '2018-03'],
+            'series': [
+                ['150.00', '200.00', '650.00'],
+                ['15.00', '20.00', '65.00'],
+                ['0.00', '0.00', '0.00'],
+                ['0.00', '0.00', '0.00'],
+            ]
+        })
+
+    def test_pie(self):
+        with self.assertNumQueries(1):
+            result = self.get('/api/v1/charts/taizhang/pie', company='公司1')
+        self.assertEqual([(d['name'], d['value']) for d in result], [('电解铜', '600.00'), ('螺纹钢', '400.00')])
+        self.assertEqual([Decimal(d['percent']) for d in result], [Decimal(60), Decimal(40)])
+
+        TaizhangStat.objects.update(xiaoshoue=Decimal(0))
+        createStatsEvent('taizhang')
+        result = self.get('/api/v1/charts/taizhang/pie', company='公司1')
+        self.assertEqual([d['percent'] for d in result], ['0', '0'])
+
+
+class FundsChartsTestCase(ChartsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.a = FinAccount.objects.create(name='账户A', number='001', bank='bank', currency='rmb')
+        self.b = FinAccount.objects.create(name='账户B', number='002', bank='bank', currency='rmb')
+
+        # 插入顺序和周的顺序不一致，账户B 2018-01-08 没有数据
+        self.createStat(self.a, '2018-01-15', 30, 3, 300)
+        self.createStat(self.a, '2018-01-01', 10, 1, 100)
+        self.createStat(self.a, '2018-01-08', 20, 2, 200)
+        self.createStat(self.b, '2018-01-15', 7, 0, 70)
+        self.createStat(self.b, '2018-01-01', 5, 0, 50)
+
+    def createStat(self, account, week, income, outcome, balance):
+        TransactionStat.objects.create(
+            account=account, category='week', startDayOfWeek=week,
+            income=Decimal(income), outcome=Decimal(outcome), balance=Decimal(balance))
+
+    def test_line(self):
+        with self.assertNumQueries(1):
+            result = self.get('/api/v1/charts/funds/line')
+        self.assertEqual(result['weeks'], ['2018-01-01', '2018-01-08', '2018-01-15'])
+        self.assertEqual(result['accounts'], ['账户A', '账户B'])
+        self.assertEqual(result['series'], [
+            [
+                {'income': '10.00', 'outcome': '1.00', 'balance': '100.00'},
+                {'income': '20.00', 'outcome': '2.00', 'balance': '200.00'},
+                {'income': '30.00', 'outcome': '3.00', 'balance': '300.00'},
+            ],
+            [
+                {'income': '5.00', 'outcome': '0.00', 'balance': '50.00'},
+                # 没有流水的周余额沿用上一周
+                {'income': '0.00', 'outcome': '0.00', 'balance': '50.00'},
+                {'income': '7.00', 'outcome': '0.00', 'balance': '70.00'},
+            ],
+        ])
+
+        result = self.get('/api/v1/charts/funds/line', number='002')
+        self.assertEqual(result['accounts'], ['账户B'])
+
+    def test_line_date_range(self):
+        result = self.get('/api/v1/charts/funds/line', date_start='2018-01-08', date_end='2018-01-15')
+        self.assertEqual(result['weeks'], ['2018-01-08', '2018-01-15'])
+        self.assertEqual([[w['income'] for w in s] for s in result['series']], [['20.00', '30.00'], ['0.00', '7.00']])
+
+        result = self.get('/api/v1/charts/funds/line', date_start='2018-02-01')
+        self.assertEqual(result, {'weeks': [], 'accounts': [], 'series': []})
+
+        response = self.client.get('/api/v1/charts/funds/line', {'date_start': '2018-13'},
+                                   HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, 400)
+
+
+class CustomersChartsTestCase(ChartsTestCase):
+    def setUp(self):
+        super().setUp()
+        fields = {'rating': 'A', 'shareholder': '', 'faren': '', 'capital': 0, 'year': '2018',
+                  'category': 'downstream', 'nature': 'state', 'address': '', 'desc': ''}
+        a = Customer.objects.create(name='客户A', **fields)
+        b = Customer.objects.create(name='客户B', **fields)
+        for customer, month, yewuliang in [(a, '2018-03', 3), (a, '2018-01', 1), (b, '2018-02', 2)]:
+            CustomerStat.objects.create(category='month', customer=customer, month=month,
+                                        yewuliang=Decimal(yewuliang))
+
+    def test_line(self):
+        with self.assertNumQueries(1):
+            result = self.get('/api/v1/charts/customers/line')
+        self.assertEqual(result['months'], ['2018-01', '2018-02', '2018-03'])
+        self.assertEqual(result['customers'], ['客户A', '客户B'])
+        self.assertEqual([[m['yewuliang'] for m in s] for s in result['series']],
+                         [['1.00', '0.00', '3.00'], ['0.00', '2.00', '0.00']])
+        self.assertEqual(result['series'][0][0]['avg_price'], '0.00')
+
+        result = self.get('/api/v1/charts/customers/line', date_start='2018-02-01', date_end='2018-02-28')
+        self.assertEqual(result['months'], ['2018-02'])
+        self.assertEqual(result['customers'], ['客户B'])
+
+
+class StatsCacheTestCase(ChartsTestCase):
+    def setUp(self):
+        # 之前的测试还没有写入共享缓存的次数，随缓存一起清掉
+        _flushStatsCacheCounts()
+        super().setUp()
+        prepareTaizhangStats()
+
+    def counters(self, source):
+        return self.get('/api/v1/stats-cache')[source]
+
+    def test_cached(self):
+        url = '/api/v1/charts/taizhang/line'
+        with self.assertNumQueries(1):
+            first = self.get(url, company='公司1', prop='xiaoshoue')
+        with self.assertNumQueries(0):
+            second = self.get(url, company='公司1', prop='xiaoshoue')
+        self.assertEqual(first, second)
+        self.assertEqual(self.counters('taizhang'), {'version': 1, 'hits': 1, 'misses': 1})
+
+        # 参数不同
+        with self.assertNumQueries(1):
+            self.get(url, company='公司1', prop='lirune')
+        # 错误的响应不缓存
+        for i in range(2):
+            response = self.client.get(url, {'prop': 'none'}, HTTP_AUTHORIZATION=self.token)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.counters('taizhang'), {'version': 1, 'hits': 1, 'misses': 4})
+        self.assertEqual(self.counters('funds'), {'version': 1, 'hits': 0, 'misses': 0})
+
+    @override_settings(STATS_CACHE_COUNTER_FLUSH=3600)
+    def test_counters_flushed_in_batches(self):
+        url = '/api/v1/charts/taizhang/line'
+        for i in range(3):
+            self.get(url, company='公司1', prop='xiaoshoue')
+        # 命中缓存的请求不写共享缓存
+        self.assertIsNone(cache.get('stats-cache-hits-taizhang'))
+        self.assertEqual(self.counters('taizhang'), {'version': 1, 'hits': 2, 'misses': 1})
+        self.assertEqual(cache.get('stats-cache-hits-taizhang'), 2)
+
+    def test_invalidated_by_stats_event(self):
+        url = '/api/v1/charts/taizhang/pie'
+        self.get(url, company='公司1')
+        TaizhangStat.objects.filter(asset='螺纹钢').update(xiaoshoue=Decimal(600))
+        self.assertEqual(self.get(url, company='公司1')[1]['value'], '400.00')
+
+        createStatsEvent('taizhang')
+        self.assertEqual(self.get(url, company='公司1')[1]['value'], '1200.00')
+        self.assertEqual(self.counters('taizhang'), {'version': 2, 'hits': 1, 'misses': 2})
+
+        # 其他来源的事件不影响
+        createStatsEvent('funds')
+        with self.assertNumQueries(0):
+            self.get(url, company='公司1')
+
+    def test_invalidated_by_rebuild(self):
+        url = '/api/v1/taizhang-stats'
+        TaizhangStat.objects.create(category='total', company='公司1', asset='电解铜',
+                                    xiaoshoue=Decimal(1), lirune=Decimal(0),
+                                    kuchun_liang=Decimal(0), zijin_zhanya=Decimal(0))
+        self.assertEqual(self.get(url)['total'], 1)
+        self.assertEqual(self.get(url)['total'], 1)
+
+        # 没有台账，重新计算之后统计数据为空
+        stats.Command().calTaizhangStats()
+        self.assertEqual(self.get(url)['total'], 0)
+
+    def test_invalidated_by_customer_changes(self):
+        fields = {'rating': 'A', 'shareholder': '', 'faren': '', 'capital': 0, 'year': '2018',
+                  'category': 'downstream', 'nature': 'state', 'address': '', 'desc': ''}
+        customer = Customer.objects.create(name='客户A', **fields)
+        CustomerStat.objects.create(category='total', customer=customer, yewuliang=Decimal(1))
+
+        url = '/api/v1/customer-stats'
+        self.assertEqual(self.get(url)['customers'][0]['name'], '客户A')
+
+        data = dict(fields, id=customer.pk, creator=None, name='客户B')
+        response = self.client.put('/api/v1/customers/{}'.format(customer.pk), json.dumps(data),
+                                   content_type='application/json', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(url)['customers'][0]['name'], '客户B')
+        self.assertEqual(StatsEvent.objects.filter(source='customer').count(), 1)
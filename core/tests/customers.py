@@ -0,0 +1,75 @@
+import json
+
+from django.db import connection
+from django.test import TestCase
+from django.test import Client
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from core.models import *
+from core.auth import generateToken
+from core.tests import helpers
+
+
+# 统计接口的响应缓存会让后面的请求不查询数据库，这里比较的是没有缓存时的查询
+@override_settings(STATS_CACHE_TIMEOUT=0)
+class CustomerListTestCase(TestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        self.profile = self.org['qa-jack']
+
+    def createCustomers(self, count):
+        for i in range(count):
+            customer = Customer.objects.create(name='customer-{}'.format(i), creator=self.profile, rating='A',
+                                               shareholder='foo', faren='bar', capital=100, year='2000',
+                                               category='upstream', nature='foo', address='bar', desc='')
+            CustomerStat.objects.create(category='total', customer=customer, yewuliang=100)
+            FinAccount.objects.create(name='account-{}'.format(i), number=str(i), bank='bank', currency='rmb',
+                                      creator=self.profile)
+
+    def createMemo(self, count):
+        for i in range(count):
+            Company.objects.create(profile=self.profile, name='company-{}'.format(i))
+            Memo.objects.create(profile=self.profile, category='upstream', value='memo-{}'.format(i))
+            BankAccount.objects.create(profile=self.profile, name='bank-{}'.format(i), number=str(i), bank='bank')
+
+    def fetch(self, url):
+        client = Client()
+        token = generateToken(self.profile)
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.get(url, {'limit': 100}, HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), json.loads(response.content.decode('utf-8'))
+
+    def assertLightList(self, url, key):
+        self.createCustomers(2)
+        few, result = self.fetch(url)
+        self.assertEqual(len(result[key]), 2)
+
+        self.createCustomers(8)
+        many, result = self.fetch(url)
+        self.assertEqual(len(result[key]), 10)
+        self.assertEqual(few, many)
+
+        # 创建人的记忆数据不会出现在列表里
+        self.createMemo(20)
+        count, withMemo = self.fetch(url)
+        self.assertEqual(count, many)
+        self.assertEqual(withMemo, result)
+
+        creator = result[key][0]['creator']
+        self.assertEqual(creator['name'], 'qa-jack')
+        self.assertEqual(creator['department']['code'], 'qa_biz')
+        self.assertNotIn('memo', creator)
+        self.assertNotIn('messages', creator)
+        for row in result[key]:
+            self.assertLess(len(json.dumps(row)), 1024)
+
+    def test_customers(self):
+        self.assertLightList('/api/v1/customers', 'customers')
+
+    def test_customer_stats(self):
+        self.assertLightList('/api/v1/customer-stats', 'customers')
+
+    def test_fin_accounts(self):
+        self.assertLightList('/api/v1/fin-accounts', 'accounts')
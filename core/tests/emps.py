@@ -1,7 +1,11 @@
 import json
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 
+from core.common import resolveAssignees
 from core.models import *
 from core.auth import generateToken
 from core.tests import helpers
@@ -94,3 +98,81 @@ class EmpsTestCase(TestCase):
         self.assertEquals(response.status_code, 200)
         profile = Profile.objects.get(name='jack1')
         self.assertEqual(profile.phone, '18888888888')
+
+
+class AssigneeCacheTestCase(TestCase):
+    def setUp(self):
+        # 人员缓存不随测试数据库回滚
+        cache.clear()
+        self.org = helpers.prepareOrganization()
+        self.token = generateToken(self.org['qa-ceo'])
+
+    def resolve(self, *keys):
+        with CaptureQueriesContext(connection) as ctx:
+            result = resolveAssignees([(self.org[dep].pk, self.org[pos].pk) for dep, pos in keys])
+        return len(ctx.captured_queries), dict([(key, result.get((self.org[key[0]].pk, self.org[key[1]].pk)))
+                                                 for key in keys])
+
+    def test_resolve_assignees(self):
+        keys = [('qa_biz', 'qa_owner'), ('qa_fin', 'qa_accountant'), ('qa_root', 'qa_ceo')]
+        self.resolve(*keys)
+        count, result = self.resolve(*keys)
+        self.assertEqual(count, 1)
+        self.assertEqual(result[('qa_biz', 'qa_owner')], self.org['qa-lee'])
+        self.assertEqual(result[('qa_fin', 'qa_accountant')], self.org['qa-lucy'])
+
+        # 没有人员的职位会重新加载一次
+        count, result = self.resolve(('qa_biz', 'qa_owner'), ('qa_biz', 'qa_ceo'))
+        self.assertEqual(count, 3)
+        self.assertIsNone(result[('qa_biz', 'qa_ceo')])
+
+    def test_invalidate_on_emp_changes(self):
+        client = Client()
+        self.resolve(('qa_biz', 'qa_member'))
+
+        version = cache.get('assignees-version')
+        response = client.put('/api/v1/emps/{}'.format(self.org['qa-jack'].pk),
+                              json.dumps({'position': str(self.org['qa_owner'].pk)}),
+                              content_type='application/json',
+                              HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(cache.get('assignees-version'), version)
+        count, result = self.resolve(('qa_biz', 'qa_member'))
+        self.assertIsNone(result[('qa_biz', 'qa_member')])
+
+        version = cache.get('assignees-version')
+        response = client.post('/api/v1/emps',
+                               json.dumps({
+                                   'name': 'qa-tom',
+                                   'department': str(self.org['qa_biz'].pk),
+                                   'position': str(self.org['qa_member'].pk),
+                                   'phone': '13900000005',
+                                   'password': '123456'
+                               }),
+                               content_type='application/json',
+                               HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(cache.get('assignees-version'), version)
+        count, result = self.resolve(('qa_biz', 'qa_member'))
+        self.assertEqual(result[('qa_biz', 'qa_member')].name, 'qa-tom')
+
+        version = cache.get('assignees-version')
+        response = client.delete('/api/v1/emps/{}'.format(result[('qa_biz', 'qa_member')].pk),
+                                 HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(cache.get('assignees-version'), version)
+        count, result = self.resolve(('qa_biz', 'qa_member'))
+        self.assertIsNone(result[('qa_biz', 'qa_member')])
+
+    def test_stale_assignee(self):
+        self.resolve(('qa_fin', 'qa_accountant'))
+
+        # 不经过 emps 接口修改的人员，发现缓存过期后重新加载
+        lucy = self.org['qa-lucy']
+        lucy.archived = True
+        lucy.save()
+        neo = self.org['qa-neo']
+        neo.position = self.org['qa_accountant']
+        neo.save()
+        count, result = self.resolve(('qa_fin', 'qa_accountant'))
+        self.assertEqual(result[('qa_fin', 'qa_accountant')], neo)
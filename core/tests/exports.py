@@ -0,0 +1,96 @@
+import io
+import csv
+from unittest import mock
+
+import openpyxl
+from django.test import TestCase
+from django.test import Client
+
+from core import exporter
+from core.models import *
+from core.tests import helpers
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.profile = helpers.prepareProfile('张三', 'root', '18888888888')
+
+    def export(self, url, params):
+        client = Client()
+        response = client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def exportCSV(self, url, params):
+        response = self.export(url, dict(params, format='csv'))
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8-sig')
+        return list(csv.reader(io.StringIO(content)))
+
+    def exportXLSX(self, url, params):
+        response = self.export(url, dict(params, format='xlsx'))
+        self.assertTrue(response.streaming)
+        wb = openpyxl.load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        return [[c.value for c in row] for row in wb.active.rows]
+
+    def test_export_transaction_records(self):
+        STR = StatsTransactionRecord
+        STR.objects.create(date='2018-07-01', number='95551', income=1000, balance=1000, other='foo',
+                           desc='收款', creator=self.profile)
+        STR.objects.create(date='2018-07-02', number='95551', outcome=100, balance=900, other='bar',
+                           desc='付款', creator=self.profile)
+        STR.objects.create(date='2018-07-02', number='95552', outcome=100, balance=900, other='bar',
+                           desc='付款', creator=self.profile)
+        STR.objects.create(date='2018-07-03', number='95551', outcome=100, balance=800, other='bar',
+                           desc='付款', creator=self.profile, archived=True)
+
+        url = '/api/v1/transaction-records/actions/export'
+        rows = self.exportCSV(url, {'number': '95551'})
+        self.assertListEqual(rows, [
+            ['交易日期', '账号', '收款', '支出', '账号余额', '摘要', '对方账户名称'],
+            ['2018-07-02', '95551', '', '100.0', '900.0', '付款', 'bar'],
+            ['2018-07-01', '95551', '1000.0', '', '1000.0', '收款', 'foo'],
+        ])
+
+        rows = self.exportXLSX(url, {'date': '2018-07-02'})
+        self.assertListEqual(rows[1:], [
+            ['2018-07-02', '95552', None, 100, 900, '付款', 'bar'],
+            ['2018-07-02', '95551', None, 100, 900, '付款', 'bar'],
+        ])
+
+        # 默认仍然导出 xls
+        response = self.export(url, {})
+        self.assertFalse(response.streaming)
+
+    def test_export_customers(self):
+        category, nature = CustomerCatgetories[0], CustomerNatures[0]
+        for name, rating in [('公司1', 'A'), ('公司2', 'B')]:
+            Customer.objects.create(name=name, rating=rating, shareholder='foo', faren='bar', capital=2000,
+                                    year='2000', category=category[0], nature=nature[0], address='address',
+                                    desc='desc', creator=self.profile)
+
+        rows = self.exportCSV('/api/v1/customers/actions/export', {'rating': 'B'})
+        nianxian = datetime.datetime.now(tz=timezone.utc).year - 2000
+        self.assertListEqual(rows[1:], [
+            ['公司2', 'B', 'foo', 'bar', '2000.0', '2000', str(nianxian), category[1], nature[1], 'address', 'desc'],
+        ])
+
+    def test_export_accounts(self):
+        FinAccount.objects.create(name='fin1', number='95551', bank='招商银行', currency='rmb', creator=self.profile)
+        FinAccount.objects.create(name='fin2', number='95552', bank='招商银行', currency='dollar', creator=self.profile)
+
+        rows = self.exportXLSX('/api/v1/fin-accounts/actions/export', {'name': 'fin'})
+        self.assertListEqual(rows, [
+            ['账户名称', '账号', '开户机构', '币种'],
+            ['fin2', '95552', '招商银行', '美元'],
+            ['fin1', '95551', '招商银行', '人民币'],
+        ])
+
+    def test_export_pages_by_id(self):
+        for i in range(5):
+            FinAccount.objects.create(name='fin{}'.format(i), number='9555{}'.format(i), bank='招商银行',
+                                      currency='rmb', creator=self.profile)
+
+        with mock.patch.object(exporter, 'CHUNK_SIZE', 2):
+            rows = self.exportCSV('/api/v1/fin-accounts/actions/export', {})
+        self.assertListEqual([row[0] for row in rows[1:]], ['fin4', 'fin3', 'fin2', 'fin1', 'fin0'])
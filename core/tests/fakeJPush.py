@@ -0,0 +1,79 @@
+import json
+import time
+import base64
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeJPush(object):
+    '''
+    本地的极光推送服务，记录收到的推送，用于测试和基准测试
+
+    failures: 接下来的几次推送返回的状态码，比如 [503, 503]
+    latency: 每次推送的延迟（秒）
+    '''
+
+    def __init__(self, appKey='', appSecret='', latency=0):
+        self.auth = 'Basic ' + base64.b64encode('{}:{}'.format(appKey, appSecret).encode('utf-8')).decode('ascii')
+        self.latency = latency
+        self.failures = []
+        self.pushes = []
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/v3/push'.format(self.server.server_address[1])
+
+    @property
+    def registrationIds(self):
+        return [i for p in self.pushes for i in p['audience']['registration_id']]
+
+    def handle(self, handler):
+        body = handler.rfile.read(int(handler.headers['Content-Length']))
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.connections.add(handler.client_address)
+            if handler.headers.get('Authorization') != self.auth:
+                return 401, {'error': {'code': 1004, 'message': 'Authen failed'}}
+            if len(self.failures) > 0:
+                status = self.failures.pop(0)
+                return status, {'error': {'code': 1000, 'message': 'fake error'}}
+
+            payload = json.loads(body.decode('utf-8'))
+            self.pushes.append(payload)
+            return 200, {'sendno': '0', 'msg_id': str(len(self.pushes))}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                status, result = fake.handle(self)
+                content = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
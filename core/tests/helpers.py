@@ -11,3 +11,44 @@ def prepareProfile(name, password, phone):
                                      name=name,
                                      phone=phone)
     return profile
+
+
+def prepareOrganization():
+    '''
+    独立于初始化数据的组织架构：
+    qa_root.qa_ceo: ceo
+    qa_biz.qa_owner: lee, qa_biz.qa_member: jack
+    qa_fin.qa_owner: neo, qa_fin.qa_accountant: lucy
+    '''
+    org = {}
+    for code in ['qa_member', 'qa_owner', 'qa_accountant', 'qa_ceo']:
+        org[code] = Position.objects.create(name=code, code=code)
+
+    root = Department.objects.create(name='qa_root', code='qa_root')
+    org['qa_root'] = root
+    for code in ['qa_biz', 'qa_fin']:
+        org[code] = Department.objects.create(name=code, code=code, parent=root)
+
+    DepPos.objects.create(dep=org['qa_root'], pos=org['qa_ceo'])
+    DepPos.objects.create(dep=org['qa_biz'], pos=org['qa_owner'])
+    DepPos.objects.create(dep=org['qa_biz'], pos=org['qa_member'])
+    DepPos.objects.create(dep=org['qa_fin'], pos=org['qa_owner'])
+    DepPos.objects.create(dep=org['qa_fin'], pos=org['qa_accountant'])
+
+    role = Role.objects.create(name='qa_role', extra=P_V1)
+    members = [
+        ('qa-ceo', '13900000000', 'qa_root', 'qa_ceo'),
+        ('qa-lee', '13900000001', 'qa_biz', 'qa_owner'),
+        ('qa-jack', '13900000002', 'qa_biz', 'qa_member'),
+        ('qa-neo', '13900000003', 'qa_fin', 'qa_owner'),
+        ('qa-lucy', '13900000004', 'qa_fin', 'qa_accountant'),
+    ]
+    for name, phone, dep, pos in members:
+        profile = prepareProfile(name, name, phone)
+        profile.department = org[dep]
+        profile.position = org[pos]
+        profile.role = role
+        profile.save()
+        org[name] = profile
+
+    return org
@@ -0,0 +1,186 @@
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+import pandas
+from django.test import TestCase
+from django.test import Client
+from django.test import override_settings
+from django.conf import settings
+
+from core.models import *
+from core.auth import generateToken
+from core.importer import runImportJob, failStaleImportJobs
+from core.views import stats
+from core.tests import helpers
+
+
+class ImportTestCase(TestCase):
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp()
+        self.override = override_settings(DATA_DIR=self.dataDir)
+        self.override.enable()
+        self.profile = helpers.prepareProfile('张三', 'root', '18888888888')
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.dataDir)
+
+    def importRows(self, url, columns, rows):
+        path = str(uuid.uuid4())
+        pandas.DataFrame(rows, columns=columns) \
+            .to_excel('{}/{}'.format(self.dataDir, path), index=False, engine='openpyxl')
+        f = File.objects.create(path=path, name='import.xlsx', size=0)
+
+        token = generateToken(self.profile)
+        client = Client()
+        response = client.post(url,
+                               json.dumps({'file': f.pk}),
+                               content_type='application/json',
+                               HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        job = json.loads(response.content.decode('utf-8'))
+        self.assertEqual((job['state'], job['processed']), ('pending', 0))
+
+        # TestCase 里事务不会提交，直接执行导入任务
+        runImportJob(job['id'])
+
+        response = client.get('/api/v1/import-jobs/{}'.format(job['id']), HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        job = json.loads(response.content.decode('utf-8'))
+        self.assertEqual((job['state'], job['total'], job['processed']), ('finished', len(rows), len(rows)))
+        self.assertIsNotNone(job['throughput'])
+        return {'success': job['success'], 'fail': job['fail'], 'errors': job['errors']}
+
+    def test_import_customers(self):
+        columns = ['客户名称', '评级', '主要股东信息', '法人', '注册资本(万元)', '成立年份', '成立年限',
+                   '公司类型', '公司性质', '地址信息', '备注']
+        category, nature = CustomerCatgetories[0], CustomerNatures[0]
+        rows = [
+            ['公司1', 'A', 'foo', 'bar', 2000, 2000, 18, category[1], nature[1], 'address', 'desc'],
+            ['公司2', 'D', 'foo', 'bar', 2000, 2000, 18, category[1], nature[1], 'address', 'desc'],
+            ['公司3', 'A', 'foo', 'bar', 2000, 1900, 18, category[1], nature[1], 'address', 'desc'],
+            ['公司4', 'A', 'foo', 'bar', 2000, 2000, 18, category[1], 'foobar', 'address', 'desc'],
+        ]
+        result = self.importRows('/api/v1/customers/actions/import', columns, rows)
+        self.assertEqual(result, {
+            'success': 1,
+            'fail': 3,
+            'errors': [
+                {'row': 3, 'errorId': 'invalid-rating'},
+                {'row': 4, 'errorId': 'invalid-year'},
+                {'row': 5, 'errorId': 'invalid-nature'},
+            ]
+        })
+
+        customer = Customer.objects.get(name='公司1')
+        self.assertEqual((customer.year, customer.category, customer.nature, customer.creator),
+                         ('2000', category[0], nature[0], self.profile))
+
+    def test_import_accounts(self):
+        columns = ['账户名称', '账号', '开户机构', '币种']
+        rows = [
+            ['fin1', '95551', '招商银行', '人民币'],
+            ['fin2', '95552', '招商银行', '美元'],
+            ['fin3', '95553', '招商银行', '日元'],
+        ]
+        result = self.importRows('/api/v1/fin-accounts/actions/import', columns, rows)
+        self.assertEqual(result, {'success': 2, 'fail': 1, 'errors': [{'row': 4, 'errorId': 'invalid-currency'}]})
+        self.assertListEqual(list(FinAccount.objects.order_by('name').values_list('number', 'currency')),
+                             [('95551', 'rmb'), ('95552', 'dollar')])
+
+    def test_import_transaction_records(self):
+        columns = ['交易日期', '账号', '收款', '支出', '账号余额', '摘要', '对方账户名称']
+        rows = [
+            ['2018-07-03', '95551', 1000, None, 1000, '收款', 'foo'],
+            ['2018-07-01 00:00:00', '95551', None, 100, 900, '付款', 'bar'],
+            ['2018-07-05', '95552', 10, None, 10, '收款', 'foo'],
+        ]
+        url = '/api/v1/transaction-records/actions/import'
+        result = self.importRows(url, columns, rows)
+        self.assertEqual(result, {'success': 3, 'fail': 0, 'errors': []})
+
+        records = StatsTransactionRecord.objects.order_by('pk')
+        self.assertListEqual([(r.date, r.number, r.income, r.outcome, r.balance) for r in records], [
+            ('2018-07-03', '95551', 1000, None, 1000),
+            ('2018-07-01', '95551', None, 100, 900),
+            ('2018-07-05', '95552', 10, None, 10),
+        ])
+        self.assertEqual(StatsTransactionRecordOps.objects.filter(op='create', record__in=records).count(), 3)
+        self.assertEqual(len(set(r.importBatch for r in records)), 1)
+        event = StatsEvent.objects.get(source='funds')
+        self.assertEqual((sorted(event.extra['numbers']), event.extra['since']), (['95551', '95552'], '2018-07-01'))
+
+        # 有错误的时候整个文件都不导入
+        rows = [
+            ['2018-07-06', '95551', 1000, None, 1000, '收款', 'foo'],
+            ['2018/07/06', '95551', 1000, None, 2000, '收款', 'foo'],
+            ['2018-07-06', '95551', 1000, None, None, '收款', 'foo'],
+            ['2018-07-06', '95551', 1000, None, 3000, None, 'foo'],
+        ]
+        result = self.importRows(url, columns, rows)
+        self.assertEqual(result, {
+            'success': 0,
+            'fail': 4,
+            'errors': [
+                {'row': 3, 'errorId': 'invalid-date'},
+                {'row': 4, 'errorId': 'invalid-balance'},
+                {'row': 5, 'errorId': 'invalid-desc'},
+            ]
+        })
+        self.assertEqual(StatsTransactionRecord.objects.count(), 3)
+
+    def test_concurrent_transaction_record_imports(self):
+        columns = ['交易日期', '账号', '收款', '支出', '账号余额', '摘要', '对方账户名称']
+        rows = [['2018-07-03', '95551', 1000, None, 1000, '收款', 'foo']]
+        importRecords = stats.bulkImport
+
+        def concurrentImport(model, objs, progress=None):
+            importRecords(model, objs, progress=progress)
+            if model is StatsTransactionRecord:
+                # 同一个人同时进行的另一次导入
+                StatsTransactionRecord.objects.create(date='2018-07-04', number='95551', income=10, balance=1010,
+                                                      desc='收款', other='foo', creator=self.profile,
+                                                      importBatch=uuid.uuid4())
+
+        with mock.patch.object(stats, 'bulkImport', side_effect=concurrentImport):
+            result = self.importRows('/api/v1/transaction-records/actions/import', columns, rows)
+        self.assertEqual(result['success'], 1)
+
+        ops = StatsTransactionRecordOps.objects.filter(op='create')
+        self.assertListEqual([op.record.date for op in ops], ['2018-07-03'])
+
+    def test_import_job_not_found(self):
+        f = File.objects.create(path='foobar', name='import.xlsx', size=0)
+        other = helpers.prepareProfile('李四', 'root', '18888888889')
+        job = ImportJob.objects.create(profile=other, category='customers', file=f)
+
+        client = Client()
+        response = client.get('/api/v1/import-jobs/{}'.format(job.pk),
+                              HTTP_AUTHORIZATION=generateToken(self.profile))
+        self.assertEqual(response.status_code, 400)
+
+        # 文件不存在
+        runImportJob(job.pk)
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.state, ImportJob.StateFailed)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_fail_stale_running_jobs(self):
+        f = File.objects.create(path='foobar', name='import.xlsx', size=0)
+        started_at = timezone.now() - datetime.timedelta(seconds=settings.IMPORT_JOB_TIMEOUT + 60)
+        stale = ImportJob.objects.create(profile=self.profile, category='customers', file=f,
+                                         state=ImportJob.StateRunning, started_at=started_at)
+        running = ImportJob.objects.create(profile=self.profile, category='customers', file=f,
+                                           state=ImportJob.StateRunning, started_at=timezone.now())
+
+        response = Client().get('/api/v1/import-jobs/{}'.format(stale.pk),
+                                HTTP_AUTHORIZATION=generateToken(self.profile))
+        self.assertEqual(response.status_code, 200)
+        job = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(job['state'], ImportJob.StateFailed)
+        self.assertIsNotNone(job['finished_at'])
+
+        self.assertEqual(failStaleImportJobs(), 0)
+        self.assertEqual(ImportJob.objects.get(pk=running.pk).state, ImportJob.StateRunning)
@@ -0,0 +1,123 @@
+import datetime
+from unittest import mock
+
+from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+
+from core import push
+from core.models import *
+from core.tests import helpers
+from core.tests.fakeJPush import FakeJPush
+
+
+class PushWorkerTestCase(TestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        self.profiles = [p for p in self.org.values() if isinstance(p, Profile)]
+        for i, profile in enumerate(self.profiles):
+            profile.deviceId = 'device-{}'.format(i)
+            profile.save()
+
+        self.jpush = FakeJPush(appKey='key', appSecret='secret').start()
+        self.settings = override_settings(JPUSH_URL=self.jpush.url,
+                                          JPUSH_APP_KEY='key',
+                                          JPUSH_APP_SECRET='secret',
+                                          JPUSH_BACKOFF=0)
+        self.settings.enable()
+        self.worker = push.PushWorker()
+
+    def tearDown(self):
+        self.worker.close()
+        self.settings.disable()
+        self.jpush.stop()
+
+    def createMessages(self, profiles, category='progress', read=False):
+        return [Message.objects.create(profile=p, category=category, read=read, extra={}) for p in profiles]
+
+    def test_push(self):
+        messages = self.createMessages(self.profiles)
+        messages.extend(self.createMessages(self.profiles[:2]))
+        self.createMessages(self.profiles, category='finish')
+        self.createMessages(self.profiles, read=True)
+
+        self.worker.run(once=True)
+        # 所有设备合并成一次推送
+        self.assertEqual(len(self.jpush.pushes), 1)
+        self.assertEqual(sorted(self.jpush.registrationIds), sorted(p.deviceId for p in self.profiles))
+        self.assertEqual(Message.objects.filter(pk__in=[m.pk for m in messages], apn_sent=True).count(),
+                         len(messages))
+        self.assertFalse(Message.objects.filter(apn_sent=True).exclude(pk__in=[m.pk for m in messages]).exists())
+
+        self.worker.run(once=True)
+        self.assertEqual(len(self.jpush.pushes), 1)
+
+    def test_skip_profiles_without_device(self):
+        profile = self.profiles[0]
+        profile.deviceId = None
+        profile.save()
+        blocked = self.profiles[1]
+        blocked.blocked = True
+        blocked.save()
+
+        messages = self.createMessages(self.profiles[:2])
+        self.worker.run(once=True)
+        self.assertEqual(self.jpush.pushes, [])
+        self.assertEqual(Message.objects.filter(pk__in=[m.pk for m in messages], apn_sent=True).count(), 2)
+
+    def test_chunks(self):
+        self.createMessages(self.profiles)
+        with mock.patch.object(push, 'MAX_AUDIENCE', 2):
+            self.worker.run(once=True)
+        self.assertEqual(sorted(len(p['audience']['registration_id']) for p in self.jpush.pushes), [1, 2, 2])
+        self.assertEqual(Message.objects.filter(apn_sent=False).count(), 0)
+
+    def test_retry(self):
+        self.createMessages(self.profiles[:1])
+        self.jpush.failures = [503, 429]
+        self.worker.run(once=True)
+        self.assertEqual(len(self.jpush.pushes), 1)
+        self.assertTrue(Message.objects.get().apn_sent)
+
+    def test_give_up_and_claim_again(self):
+        message = self.createMessages(self.profiles[:1])[0]
+        with override_settings(JPUSH_RETRIES=2):
+            self.jpush.failures = [503] * 3
+            self.worker.run(once=True)
+            self.assertFalse(Message.objects.get(pk=message.pk).apn_sent)
+
+            # 领取之后没有超时，不会重复推送
+            self.worker.run(once=True)
+            self.assertEqual(self.jpush.failures, [])
+            self.assertEqual(self.jpush.pushes, [])
+
+            expired = datetime.datetime.now(tz=timezone.utc) - datetime.timedelta(minutes=10)
+            Message.objects.update(apn_claimed_at=expired)
+            self.worker.run(once=True)
+            self.assertEqual(len(self.jpush.pushes), 1)
+            self.assertTrue(Message.objects.get(pk=message.pk).apn_sent)
+
+    def test_drop_invalid_push(self):
+        self.createMessages(self.profiles[:1])
+        self.jpush.failures = [400]
+        self.worker.run(once=True)
+        # 不能重试的错误不会一直推送
+        self.assertEqual(self.jpush.failures, [])
+        self.assertEqual(self.jpush.pushes, [])
+        self.assertTrue(Message.objects.get().apn_sent)
+
+    def test_claim(self):
+        self.createMessages(self.profiles)
+        first = push.claimMessages(3)
+        second = push.claimMessages(3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertEqual(set(m.pk for m in first) & set(m.pk for m in second), set())
+        self.assertEqual(push.claimMessages(3), [])
+
+    def test_reuse_connection(self):
+        with override_settings(JPUSH_BATCH_SIZE=1):
+            self.createMessages(self.profiles)
+            self.worker.run(once=True)
+        self.assertEqual(len(self.jpush.pushes), len(self.profiles))
+        self.assertEqual(len(self.jpush.connections), 1)
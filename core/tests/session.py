@@ -1,11 +1,18 @@
 import json
 import logging
 
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test import override_settings
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 
-from core.auth import generateToken
+from core.auth import generateToken, loadProfile, profileCache
+from core.models import *
 from core.views import session
+from core.common import invalidateMemo
+from core.views.audit import recordBankAccountIfNeed, recordCompanyIfNeed, recordMemo
 from core.tests import helpers
 
 logger = logging.getLogger('app.core.tests.session')
@@ -128,3 +135,196 @@ class SessionTestCase(TestCase):
         result = json.loads(response.content.decode('utf-8'))
         logger.info(result)
         self.assertEqual(result['name'], self.profile.name)
+
+
+class ProfileMemoTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile = helpers.prepareProfile('张三', 'root', '18888888888')
+        self.token = generateToken(self.profile)
+
+    def runOnCommit(self):
+        # TestCase 不会提交事务，手动执行提交后的回调
+        callbacks = connection.run_on_commit
+        connection.run_on_commit = []
+        for _, func in callbacks:
+            func()
+
+    def record(self, company, account):
+        recordCompanyIfNeed(self.profile, 'biz', {'base': {'company': company}})
+        recordMemo(self.profile, 'biz', {'info': {'upstream': company + '-up'}})
+        recordBankAccountIfNeed(self.profile, 'cost', {
+            'account': {'name': account, 'bank': 'bank', 'number': '0001'}
+        })
+        self.runOnCommit()
+
+    def getProfile(self, **extra):
+        client = Client()
+        # 每次都从数据库加载 profile，查询次数只和记忆数据的缓存有关
+        profileCache.evict()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/v1/profile', HTTP_AUTHORIZATION=self.token, **extra)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8')), len(queries)
+
+    def test_profile_memo_cached(self):
+        self.record('c1', 'a1')
+
+        result, count = self.getProfile()
+        self.assertEqual(result['companies'], [{'name': 'c1'}])
+        self.assertEqual(result['memo'], [{'category': 'upstream', 'value': 'c1-up'}])
+        self.assertEqual(result['accounts'], [{'name': 'a1', 'bank': 'bank', 'number': '0001'}])
+
+        _, cachedCount = self.getProfile()
+        # 加载时给新增的数据记录版本号，再读取
+        self.assertEqual(cachedCount, count - 6)
+
+        self.record('c2', 'a2')
+        result, _ = self.getProfile()
+        self.assertEqual([c['name'] for c in result['companies']], ['c1', 'c2'])
+        self.assertEqual([a['name'] for a in result['accounts']], ['a1', 'a2'])
+
+        # 已存在的数据不会使缓存失效
+        self.record('c2', 'a2')
+        _, count = self.getProfile()
+        self.assertEqual(count, cachedCount)
+
+    def test_profile_memo_since(self):
+        self.record('c1', 'a1')
+        result, _ = self.getProfile()
+        cursor = result['memoCursor']
+        self.assertIsNotNone(cursor)
+
+        result, _ = self.getProfile(data={'since': cursor})
+        self.assertEqual((result['companies'], result['accounts'], result['memo']), ([], [], []))
+        self.assertEqual(result['memoCursor'], cursor)
+
+        self.record('c2', 'a2')
+        result, _ = self.getProfile(data={'since': cursor})
+        self.assertEqual(result['companies'], [{'name': 'c2'}])
+        self.assertEqual(result['memo'], [{'category': 'upstream', 'value': 'c2-up'}])
+        self.assertEqual([a['name'] for a in result['accounts']], ['a2'])
+        self.assertNotEqual(result['memoCursor'], cursor)
+
+    def test_profile_memo_late_commit(self):
+        self.record('c1', 'a1')
+        result, _ = self.getProfile()
+        cursor = result['memoCursor']
+
+        # 更早开始、返回 cursor 之后才提交的事务，created_at 比 cursor 对应的数据早
+        company = Company.objects.create(name='c0')
+        Company.objects.filter(pk=company.pk).update(created_at=timezone.now() - datetime.timedelta(days=1))
+        invalidateMemo()
+        self.runOnCommit()
+
+        result, _ = self.getProfile(data={'since': cursor})
+        self.assertEqual(result['companies'], [{'name': 'c0'}])
+        cursor = result['memoCursor']
+
+        # 缓存丢失之后版本号不会变小
+        cache.delete('memo-version')
+        result, _ = self.getProfile(data={'since': cursor})
+        self.assertEqual(result['companies'], [])
+        self.assertGreater(int(result['memoCursor']), int(cursor))
+
+    def test_profile_messages_queries(self):
+        config = AuditActivityConfig.objects.first()
+
+        def prepare(count):
+            for i in range(count):
+                activity = AuditActivity.objects.create(config=config,
+                                                        creator=self.profile,
+                                                        extra={})
+                Message.objects.create(activity=activity,
+                                       profile=self.profile,
+                                       category='hurryup',
+                                       extra={})
+
+        # 先让记忆数据进入缓存
+        self.getProfile()
+        prepare(1)
+        result, expected = self.getProfile()
+        self.assertEqual(len(result['messages']), 1)
+        prepare(5)
+        result, count = self.getProfile()
+        self.assertEqual(len(result['messages']), 6)
+        self.assertEqual(count, expected)
+
+
+class AuthCacheTestCase(TestCase):
+    def setUp(self):
+        profileCache.evict()
+        self.org = helpers.prepareOrganization()
+        self.profile = self.org['qa-jack']
+        self.token = generateToken(self.profile)
+
+    def load(self):
+        with CaptureQueriesContext(connection) as queries:
+            profile = loadProfile(self.token)
+        return profile, len(queries)
+
+    def request(self, method='get', url='/api/v1/profile', token=None, data=None):
+        client = Client()
+        return getattr(client, method)(url,
+                                       json.dumps(data or {}) if method != 'get' else None,
+                                       content_type='application/json',
+                                       HTTP_AUTHORIZATION=token or self.token)
+
+    def test_cached(self):
+        profile, count = self.load()
+        self.assertEqual(count, 1)
+        profile, count = self.load()
+        self.assertEqual(count, 0)
+        self.assertEqual(profile.pk, self.profile.pk)
+
+        # 部门、职位、角色已经一起加载
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(profile.department.code, 'qa_biz')
+            self.assertEqual(profile.position.code, 'qa_member')
+            profile.role
+        self.assertEqual(len(queries), 0)
+
+    def test_copy(self):
+        profile, _ = self.load()
+        profile.name = 'foo'
+        profile.department = None
+        profile, _ = self.load()
+        self.assertEqual(profile.name, 'qa-jack')
+        self.assertEqual(profile.department.code, 'qa_biz')
+
+    def test_ttl(self):
+        with override_settings(AUTH_CACHE_TTL=0):
+            self.load()
+            _, count = self.load()
+            self.assertEqual(count, 1)
+
+    def test_lru(self):
+        with override_settings(AUTH_CACHE_SIZE=2):
+            tokens = [generateToken(self.org[name]) for name in ['qa-lee', 'qa-neo', 'qa-lucy']]
+            for token in tokens:
+                loadProfile(token)
+            loadProfile(tokens[1])
+            loadProfile(self.token)
+            self.assertEqual(list(profileCache.entries.keys()), [tokens[1], self.token])
+
+    def test_evict_on_update(self):
+        self.load()
+        response = self.request('put', '/api/v1/emps/{}'.format(self.profile.pk), data={'desc': 'updated'})
+        self.assertEqual(response.status_code, 200)
+        profile, count = self.load()
+        self.assertEqual(count, 1)
+        self.assertEqual(profile.desc, 'updated')
+
+    def test_blocked(self):
+        self.assertEqual(self.request().status_code, 200)
+        token = generateToken(self.org['qa-ceo'])
+        response = self.request('post', '/api/v1/emps/{}/actions/update-state'.format(self.profile.pk),
+                                token=token, data={'blocked': True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.request().status_code, 401)
+
+    def test_logout(self):
+        self.assertEqual(self.request().status_code, 200)
+        self.assertEqual(self.request('post', '/api/v1/logout').status_code, 200)
+        self.assertEqual(self.request().status_code, 401)
+        self.assertIsNone(cache.get('token-' + self.token))
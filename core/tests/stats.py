@@ -1,9 +1,11 @@
 from decimal import Decimal
 import json
+from unittest import mock
 
 from freezegun import freeze_time
 from django.test import TestCase
 from django.test import Client
+from django.core.cache import cache
 from django.contrib.auth.models import User
 
 from core import specs
@@ -146,6 +148,58 @@ class StatsTestCase(TestCase):
         ]
         self.assertListEqual(actual, expected)
 
+    def snapshotTransactionStats(self):
+        tss = TransactionStat.objects.all()
+        return sorted([(t.account.name, t.category, t.startDayOfWeek or '', t.income, t.outcome, t.balance)
+                       for t in tss])
+
+    def assertTransactionStatsRebuilt(self):
+        incremental = self.snapshotTransactionStats()
+        stats.Command().calTransactionStats()
+        self.assertListEqual(incremental, self.snapshotTransactionStats())
+
+    def test_update_transaction_stats(self):
+        with freeze_time('2018-08-18'):
+            self._test_transaction_stat()
+            TransactionStat.objects.all().delete()
+
+            cmd = stats.Command()
+            cmd.updateTransactionStats()
+            self.assertTransactionStatsRebuilt()
+            cmd.updateTransactionStats()
+            self.assertTransactionStatsRebuilt()
+
+            f1 = FinAccount.objects.get(number='95551')
+            f1Stats = set(TransactionStat.objects.filter(account=f1).values_list('pk', flat=True))
+
+            profile = Profile.objects.get(name='foobar')
+            r = StatsTransactionRecord.objects.create(date='2018-07-10', number='95552', outcome=50,
+                                                      balance=850, creator=profile)
+            StatsEvent.objects.create(source='funds', event='invalidate',
+                                      extra={'numbers': [r.number], 'since': r.date})
+            cmd.updateTransactionStats()
+            self.assertEqual(StatsEvent.objects.filter(source='funds', handled=False).count(), 0)
+            # 没有变化的账号不会重新计算
+            self.assertEqual(set(TransactionStat.objects.filter(account=f1).values_list('pk', flat=True)),
+                             f1Stats)
+            ts = TransactionStat.objects.get(category='week', account__number='95552', startDayOfWeek='2018-07-09')
+            self.assertEqual((ts.outcome, ts.balance), (Decimal(50), Decimal(850)))
+            self.assertTransactionStatsRebuilt()
+
+            # 比第一周更早的记录
+            StatsTransactionRecord.objects.create(date='2018-06-10', number='95553', income=10,
+                                                  balance=10, creator=profile)
+            StatsEvent.objects.create(source='funds', event='invalidate',
+                                      extra={'numbers': ['95553'], 'since': '2018-06-10'})
+            cmd.updateTransactionStats()
+            self.assertTransactionStatsRebuilt()
+
+        # 时间推移之后补上新的周数据
+        with freeze_time('2018-09-05'):
+            cmd = stats.Command()
+            cmd.updateTransactionStats()
+            self.assertTransactionStatsRebuilt()
+
     def _test_taizhang_stat_and_customer_stat(self):
         customer_data = [{
             'name': '公司1', 'rating': 'A',
@@ -297,6 +351,37 @@ class StatsTestCase(TestCase):
         actual.sort(key=lambda x: x['customer'])
         self.assertListEqual(expect, actual)
 
+    @freeze_time('2018-06-18')
+    def test_taizhang_stat_edge_cases(self):
+        base = {
+            'upstream_dunwei': 1, 'buyPrice': 1, 'downstream_dunwei': 1, 'sellPrice': 1,
+            'kaipiao_dunwei': 2, 'upstream_jiesuan_price': '1.5',
+            'kaipiao_dunwei_trade': 2, 'downstream_jiesuan_price': '2.25',
+            'shangyou_kuchun_liang': 3, 'shangyou_kuchun_yuji_danjia': '0.5', 'shangyou_zijin_zhanya': 7
+        }
+        # 上下游相同只算一次
+        Taizhang.objects.create(date='2018-05', asset='铝', upstream='公司1', downstream='公司1', **base)
+        # 没有填写的数据按 0 计算
+        data = dict(base, kaipiao_dunwei_trade=None, shangyou_kuchun_yuji_danjia=None, shangyou_zijin_zhanya=None)
+        Taizhang.objects.create(date='2018-06', asset='铝', upstream='公司1', downstream='', **data)
+        # 已经删除的台账不参与统计，但是货物标的仍然会出现
+        Taizhang.objects.create(date='2018-05', asset='锌', upstream='公司2', archived=True, **base)
+
+        stats.Command().calTaizhangStats()
+
+        actual = sorted([(t.category, t.month or '', t.company, t.asset,
+                          t.xiaoshoue, t.lirune, t.kuchun_liang, t.zijin_zhanya)
+                         for t in TaizhangStat.objects.all()])
+        expect = sorted([
+            ('total', '', '公司1', '铝', Decimal('4.5'), Decimal('-1.5'), Decimal('1.5'), Decimal('7')),
+            ('total', '', '公司1', '锌', Decimal('0'), Decimal('0'), Decimal('0'), Decimal('0')),
+            ('month', '2018-05', '公司1', '铝', Decimal('4.5'), Decimal('1.5'), Decimal('1.5'), Decimal('7')),
+            ('month', '2018-05', '公司1', '锌', Decimal('0'), Decimal('0'), Decimal('0'), Decimal('0')),
+            ('month', '2018-06', '公司1', '铝', Decimal('0'), Decimal('-3'), Decimal('0'), Decimal('0')),
+            ('month', '2018-06', '公司1', '锌', Decimal('0'), Decimal('0'), Decimal('0'), Decimal('0')),
+        ])
+        self.assertListEqual(expect, actual)
+
     @freeze_time('2018-08-18')
     def test_taizhang_stat_and_customer_stat(self):
         self._test_taizhang_stat_and_customer_stat()
@@ -332,3 +417,96 @@ class StatsTestCase(TestCase):
              'kuchun_liang': '0.00', 'zijin_zhanya': '0.00'},
         ]
         self.assertListEqual(stats, expect)
+
+
+class StatsGenerationTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        profile = helpers.prepareProfile('root', 'root', '18888888888')
+        self.token = generateToken(profile)
+        Taizhang.objects.create(date='2018-05', asset='铝', upstream='公司1', downstream='公司2',
+                                upstream_dunwei=1, buyPrice=1, downstream_dunwei=1, sellPrice=1,
+                                kaipiao_dunwei_trade=2, downstream_jiesuan_price=3)
+
+    def fetchStats(self):
+        r = Client().get('/api/v1/taizhang-stats', HTTP_AUTHORIZATION=self.token)
+        self.assertEqual(r.status_code, 200)
+        return json.loads(r.content.decode('utf-8'))['stats']
+
+    @freeze_time('2018-05-18')
+    def test_readers_see_previous_generation_during_rebuild(self):
+        cmd = stats.Command()
+        cmd.calTaizhangStats()
+        before = self.fetchStats()
+        self.assertEqual([s['xiaoshoue'] for s in before], ['6.00', '6.00'])
+
+        Taizhang.objects.update(downstream_jiesuan_price=4)
+        activate = StatsGeneration.activate
+        during = []
+
+        def checkAndActivate(*args, **kwargs):
+            # 新的数据已经写完还没有切换
+            during.append(self.fetchStats())
+            return activate(*args, **kwargs)
+
+        with mock.patch.object(StatsGeneration, 'activate', side_effect=checkAndActivate):
+            cmd.calTaizhangStats()
+
+        self.assertEqual(during, [before])
+        self.assertEqual([s['xiaoshoue'] for s in self.fetchStats()], ['8.00', '8.00'])
+        # 之前的 generation 已经删除
+        self.assertEqual(StatsGeneration.current('taizhang'), 2)
+        self.assertEqual(TaizhangStat.objects.exclude(generation=2).count(), 0)
+        self.assertEqual(TaizhangStat.objects.count(), TaizhangStat.active().count())
+
+    @freeze_time('2018-05-18')
+    def test_stale_generation_not_activated(self):
+        cmd = stats.Command()
+        stale = StatsGeneration.allocate('customer')
+        # 没有写完的 generation 在下次切换时删除
+        CustomerStat.objects.create(category='total', yewuliang=1, generation=stale)
+        cmd.calCustomerStats()
+        active = StatsGeneration.current('customer')
+        self.assertGreater(active, stale)
+        self.assertEqual(CustomerStat.objects.filter(generation=stale).count(), 0)
+
+        CustomerStat.objects.create(category='total', yewuliang=1, generation=stale)
+        self.assertFalse(StatsGeneration.activate('customer', CustomerStat, stale))
+        self.assertEqual(StatsGeneration.current('customer'), active)
+        self.assertEqual(CustomerStat.objects.filter(generation=stale).count(), 0)
+
+    @freeze_time('2018-05-18')
+    def test_incremental_update_uses_active_generation(self):
+        profile = Profile.objects.get(name='root')
+        FinAccount.objects.create(name='fin1', number='95551', bank='招商银行', currency='rmb', creator=profile)
+        StatsTransactionRecord.objects.create(date='2018-05-02', number='95551', income=10, balance=10,
+                                              creator=profile)
+        cmd = stats.Command()
+        cmd.calTransactionStats()
+        generation = StatsGeneration.current('funds')
+        self.assertEqual(generation, 1)
+
+        StatsTransactionRecord.objects.create(date='2018-05-09', number='95551', income=5, balance=15,
+                                              creator=profile)
+        StatsEvent.objects.create(source='funds', event='invalidate',
+                                  extra={'numbers': ['95551'], 'since': '2018-05-09'})
+        cmd.updateTransactionStats()
+        self.assertEqual(TransactionStat.objects.exclude(generation=generation).count(), 0)
+        total = TransactionStat.active().get(category='total')
+        self.assertEqual((total.income, total.balance), (Decimal(15), Decimal(15)))
+
+    def test_interleaved_rebuilds_keep_newer_generation(self):
+        first = StatsGeneration.allocate('customer')
+        second = StatsGeneration.allocate('customer')
+        self.assertGreater(second, first)
+        CustomerStat.objects.create(category='total', yewuliang=1, generation=first)
+        CustomerStat.objects.create(category='total', yewuliang=2, generation=second)
+
+        # 先分配的先切换，后分配的还没有切换的数据不能删除
+        self.assertTrue(StatsGeneration.activate('customer', CustomerStat, first))
+        self.assertEqual(CustomerStat.objects.filter(generation=second).count(), 1)
+
+        self.assertTrue(StatsGeneration.activate('customer', CustomerStat, second))
+        self.assertEqual(StatsGeneration.current('customer'), second)
+        self.assertEqual([s.yewuliang for s in CustomerStat.active()], [Decimal(2)])
+        self.assertEqual(CustomerStat.objects.exclude(generation=second).count(), 0)
@@ -0,0 +1,223 @@
+import json
+import time
+import threading
+
+from django.db import connection, OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from core import specs
+from core import workflow
+from core.models import *
+from core.auth import generateToken
+from core.tests import helpers
+from core.views.audit import createActivity
+
+
+def prepareActivity(test, spec):
+    test.org = helpers.prepareOrganization()
+    config = specs.createAuditConfig(spec=spec)
+    return createActivity(test.org['qa-jack'], {
+        'code': config.subtype,
+        'submit': True,
+        'extra': {}
+    })
+
+
+class WorkflowTestCase(TestCase):
+    def setUp(self):
+        self.activity = prepareActivity(
+            self, 'fin.qa_cost:_.qa_owner->qa_fin.qa_accountant->qa_fin.qa_owner->qa_root.qa_ceo...')
+        self.steps = list(self.activity.steps())
+
+    def approve(self, step):
+        assignee = step.assignee
+        with CaptureQueriesContext(connection) as ctx:
+            workflow.approveStep(step.pk, assignee)
+        return len(ctx.captured_queries)
+
+    def test_approve(self):
+        for step in self.steps:
+            self.approve(step)
+            self.assertFalse(Message.objects.filter(profile=step.assignee, category='progress').exists())
+
+        activity = AuditActivity.objects.get(pk=self.activity.pk)
+        self.assertEqual(activity.state, AuditActivity.StateApproved)
+        self.assertEqual(activity.taskState, 'pending')
+        self.assertEqual(AuditStep.objects.filter(activity=activity, state=AuditStep.StateApproved).count(),
+                         len(self.steps))
+        self.assertEqual(Message.objects.filter(activity=activity, category='finish').count(), 1)
+
+    def test_approve_queries(self):
+        counts = [self.approve(step) for step in self.steps]
+        # 中间步骤的查询次数固定，最后一步需要读取审批单的配置
+        self.assertEqual(len(set(counts[:-1])), 1)
+        self.assertLessEqual(counts[0], 9)
+        self.assertLessEqual(counts[-1], 10)
+
+    def test_reject(self):
+        self.approve(self.steps[0])
+        assignee = self.steps[1].assignee
+        with CaptureQueriesContext(connection) as ctx:
+            workflow.rejectStep(self.steps[1].pk, assignee, desc='no')
+        self.assertLessEqual(len(ctx.captured_queries), 8)
+
+        activity = AuditActivity.objects.get(pk=self.activity.pk)
+        self.assertEqual(activity.state, AuditActivity.StateRejected)
+        self.assertIsNotNone(activity.finished_at)
+        step = AuditStep.objects.get(pk=self.steps[1].pk)
+        self.assertEqual(step.state, AuditStep.StateRejected)
+        self.assertEqual(step.desc, 'no')
+        self.assertFalse(AuditStep.objects.filter(activity=activity, active=True).exists())
+
+    def test_invalid_state(self):
+        step = self.steps[0]
+        self.approve(step)
+        with self.assertRaises(workflow.WorkflowError) as ctx:
+            workflow.approveStep(step.pk, step.assignee)
+        self.assertEqual(ctx.exception.data['errorId'], 'invalid-step-state')
+
+        with self.assertRaises(workflow.WorkflowError) as ctx:
+            workflow.rejectStep(self.steps[1].pk, self.org['qa-jack'])
+        self.assertEqual(ctx.exception.data['errorId'], 'invalid-assignee')
+
+        # 失败的操作不会修改任何数据
+        self.assertEqual(AuditStep.objects.get(pk=self.steps[1].pk).state, AuditStep.StatePending)
+        self.assertEqual(Message.objects.filter(activity=self.activity, category='progress').count(), 1)
+
+
+class BatchWorkflowTestCase(TestCase):
+    def setUp(self):
+        self.org = helpers.prepareOrganization()
+        self.config = specs.createAuditConfig(spec='fin.qa_cost:_.qa_owner->qa_root.qa_ceo')
+        contract = AuditActivityConfig.objects.get(subtype='biz_contract')
+        specs.updateAuditConfig(spec='{}.biz_contract:_.qa_owner'.format(contract.category))
+
+    def createActivities(self, count, code='qa_cost', extra={}):
+        return [createActivity(self.org['qa-jack'], {
+            'code': code,
+            'submit': True,
+            'extra': extra
+        }) for i in range(count)]
+
+    def currentSteps(self, activities):
+        return [str(AuditStep.objects.get(activity=a, active=True).pk) for a in activities]
+
+    def post(self, action, steps, name='qa-lee', desc='ok'):
+        client = Client()
+        token = generateToken(self.org[name])
+        with CaptureQueriesContext(connection) as ctx:
+            response = client.post('/api/v1/audit-steps/actions/{}'.format(action),
+                                   json.dumps({'steps': steps, 'desc': desc}),
+                                   content_type='application/json',
+                                   HTTP_AUTHORIZATION=token)
+        return response, len(ctx.captured_queries)
+
+    def test_batch_approve(self):
+        activities = self.createActivities(3)
+        steps = self.currentSteps(activities)
+        response, _ = self.post('approve', steps)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content.decode('utf-8'))['results']
+        self.assertEqual(results, [{'id': step, 'ok': True} for step in steps])
+
+        for activity in activities:
+            step = AuditStep.objects.get(activity=activity, position=0)
+            self.assertEqual(step.state, AuditStep.StateApproved)
+            self.assertEqual(step.desc, 'ok')
+            self.assertTrue(AuditStep.objects.get(activity=activity, position=1).active)
+        self.assertEqual(Message.objects.filter(profile=self.org['qa-ceo'], category='progress').count(), 3)
+        self.assertFalse(Message.objects.filter(profile=self.org['qa-lee'], category='progress').exists())
+
+        # 最后一步批量审批通过
+        response, _ = self.post('approve', self.currentSteps(activities), name='qa-ceo')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AuditActivity.objects.filter(state=AuditActivity.StateApproved).count(), 3)
+        self.assertEqual(Message.objects.filter(profile=self.org['qa-jack'], category='finish').count(), 3)
+
+    def test_batch_reject(self):
+        activities = self.createActivities(2)
+        response, _ = self.post('reject', self.currentSteps(activities), desc='no')
+        self.assertEqual(response.status_code, 200)
+        for activity in AuditActivity.objects.filter(pk__in=[a.pk for a in activities]):
+            self.assertEqual(activity.state, AuditActivity.StateRejected)
+            self.assertIsNotNone(activity.finished_at)
+        self.assertEqual(Message.objects.filter(category='finish', extra__contains='rejected').count(), 2)
+
+    def test_batch_results(self):
+        valid = self.currentSteps(self.createActivities(1))
+        approved = self.currentSteps(self.createActivities(1))
+        self.post('approve', approved)
+        # 不是当前审批人的步骤
+        other = self.createActivities(1)
+        self.post('approve', self.currentSteps(other))
+        notAssigned = self.currentSteps(other)
+
+        steps = valid + approved + notAssigned + ['foo', '00000000-0000-0000-0000-000000000000']
+        response, _ = self.post('approve', steps)
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content.decode('utf-8'))['results']
+        self.assertEqual([r['id'] for r in results], steps)
+        self.assertEqual([r['ok'] for r in results], [True, False, False, False, False])
+        self.assertEqual([r.get('errorId') for r in results],
+                         [None, 'invalid-step-state', 'invalid-assignee', 'step-not-found', 'step-not-found'])
+        self.assertEqual(AuditStep.objects.get(pk=valid[0]).state, AuditStep.StateApproved)
+
+        response, _ = self.post('approve', [])
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_taizhang(self):
+        info = {'asset': 'foo', 'upstream': 'up', 'downstream': 'down', 'tonnage': '100',
+                'buyPrice': '10', 'sellPrice': '11'}
+        activities = self.createActivities(3, code='biz_contract', extra={'base': {'company': 'foo'}, 'info': info})
+        activities.extend(self.createActivities(2))
+        response, _ = self.post('approve', self.currentSteps(activities))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Taizhang.objects.filter(auditId__in=[a.pk for a in activities]).count(), 3)
+        self.assertEqual(StatsEvent.objects.filter(source='taizhang').count(), 1)
+
+    def test_batch_queries(self):
+        few = self.currentSteps(self.createActivities(2))
+        many = self.currentSteps(self.createActivities(10))
+        _, fewQueries = self.post('approve', few)
+        _, manyQueries = self.post('approve', many)
+        self.assertEqual(fewQueries, manyQueries)
+
+
+class WorkflowConcurrencyTestCase(TransactionTestCase):
+    def setUp(self):
+        self.activity = prepareActivity(self, 'fin.qa_cost:_.qa_owner->qa_root.qa_ceo')
+
+    def test_double_click(self):
+        step = self.activity.steps()[0]
+        assignee = step.assignee
+        results = []
+
+        def run():
+            # 测试用的 sqlite 遇到锁直接报错而不是等待，这里重试，相当于 MySQL 上等待行锁
+            try:
+                while True:
+                    try:
+                        workflow.approveStep(step.pk, assignee)
+                        results.append('ok')
+                        return
+                    except OperationalError as e:
+                        if 'locked' not in str(e):
+                            raise
+                        time.sleep(0.001)
+            except workflow.WorkflowError as e:
+                results.append(e.data['errorId'])
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(results), ['invalid-step-state'] * 3 + ['ok'])
+        # 下一步只被激活一次
+        self.assertEqual(Message.objects.filter(activity=self.activity, category='progress').count(), 1)
+        self.assertEqual(AuditStep.objects.filter(activity=self.activity, active=True).count(), 1)
@@ -13,14 +13,17 @@ from core.views import finAccount
 from core.views import stats
 from core.views import taizhang
 from core.views import charts
+from core.views import importJob
 
 urlpatterns = [
     path(r'upload', upload.upload),
     path(r'assets/<str:path>', upload.assets),
+    path(r'import-jobs/<uuid:jobId>', importJob.job),
 
     # session api
     path(r'login', session.login),
     path(r'login-with-code', session.loginWithCode),
+    path(r'logout', session.logout),
     path(r'send-code', session.sendCode),
     path(r'change-phone', session.changePhone),
     path(r'profile', session.profile),
@@ -40,6 +43,8 @@ urlpatterns = [
     path(r'audit-activities/<uuid:activityId>/actions/hurryup', audit.hurryup),
     path(r'audit-activities/<uuid:activityId>/actions/mark-task-finished', audit.markTaskFinished),
 
+    path(r'audit-steps/actions/approve', audit.approveSteps),
+    path(r'audit-steps/actions/reject', audit.rejectSteps),
     path(r'audit-steps/<uuid:stepId>/actions/approve', audit.approveStep),
     path(r'audit-steps/<uuid:stepId>/actions/reject', audit.rejectStep),
 
@@ -80,6 +85,7 @@ urlpatterns = [
     path(r'transaction-records/actions/export', stats.exportRecords),
     path(r'transaction-record-ops', stats.ops),
     path(r'transaction-record-stats', stats.stats),
+    path(r'stats-cache', stats.cacheCounters),
 
     # taizhang api
     path(r'taizhang', taizhang.taizhang),
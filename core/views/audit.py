@@ -6,7 +6,7 @@ import datetime
 
 import iso8601
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, F
 from django.utils import timezone
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
@@ -16,6 +16,7 @@ from sendfile import sendfile
 from core.models import *
 from core.auth import validateToken
 from core.common import *
+from core import workflow
 
 logger = logging.getLogger('app.core.views.audit')
 
@@ -30,15 +31,19 @@ def configs(request):
 
 
 def submitActivityAudit(activity):
-    activity.state = AuditActivity.StateProcessing
-    activity.save()
-
     steps = activity.steps()
     step = steps[0]
     step.active = True
     step.activated_at = datetime.datetime.now(tz=timezone.utc)
     step.save()
 
+    activity.state = AuditActivity.StateProcessing
+    activity.activeStep = step
+    activity.activeAssignee_id = step.assignee_id
+    activity.stepDecided = False
+    activity.hurried_at = None
+    activity.save()
+
     # if step.assignee.pk == activity.creator.pk:
     #     # 发起人和第一位审批人相同
     #     step.state = AuditStep.StateApproved
@@ -80,6 +85,7 @@ def recordBankAccountIfNeed(profile, code, data):
                        name=name,
                        bank=bank,
                        number=number)
+            invalidateMemo()
 
 
 def recordCompanyIfNeed(profile, code, data):
@@ -88,6 +94,7 @@ def recordCompanyIfNeed(profile, code, data):
         count = Company.objects.filter(name=company).count()
         if count == 0:
             Company.objects.create(profile=profile, name=company)
+            invalidateMemo()
 
 
 def recordMemo(profile, code, data):
@@ -99,17 +106,45 @@ def recordMemo(profile, code, data):
                 count = Memo.objects.filter(category=prop, value=value).count()
                 if count == 0:
                     Memo.objects.create(category=prop, value=value, profile=profile)
+                    invalidateMemo()
 
 
-def generateActivitySN():
-    now = datetime.datetime.now()
-    now = now + datetime.timedelta(hours=8)
-    start = now.date()
+# 流水号按北京时间的日期生成
+SN_TIMEZONE = timezone.get_fixed_timezone(8 * 60)
+
+
+def countActivities(date):
+    start = timezone.make_aware(datetime.datetime.combine(date, datetime.time.min), SN_TIMEZONE)
     end = start + datetime.timedelta(days=1)
-    count = AuditActivity.objects \
+    return AuditActivity.objects \
         .filter(created_at__gte=start, created_at__lt=end) \
         .count()
-    sn = now.strftime('%Y%m%d') + str(count + 1).zfill(4)
+
+
+def allocateActivitySN(date):
+    '''
+    原子地把当天的序号加一并返回，序号只会分配一次
+
+    当天的序号行先在单独的短事务里创建好，再加锁更新：对不存在的行 UPDATE 会加间隙锁，
+    MySQL 上同时进行的第一次分配再 INSERT 会互相死锁
+    '''
+    # 当天第一次分配，从已经创建的审批单数量开始，和之前按数量生成的流水号衔接；
+    # 其他请求已经创建了当天的序号时 get_or_create 直接读取
+    ActivitySequence.objects.get_or_create(date=date, defaults={'value': lambda: countActivities(date)})
+
+    with transaction.atomic():
+        ActivitySequence.objects \
+            .filter(date=date) \
+            .update(value=F('value') + 1)
+        return ActivitySequence.objects \
+            .filter(date=date) \
+            .values_list('value', flat=True) \
+            .get()
+
+
+def generateActivitySN():
+    now = timezone.now().astimezone(SN_TIMEZONE)
+    sn = now.strftime('%Y%m%d') + str(allocateActivitySN(now.date())).zfill(4)
     return sn
 
 
@@ -121,38 +156,34 @@ def setupSteps(activity, taskId=None):
 
     logger.info('{} create steps'.format(taskId))
 
-    configSteps = AuditActivityConfigStep.objects \
-        .filter(config=activity.config) \
-        .order_by('position')
+    configSteps = list(AuditActivityConfigStep.objects
+                       .select_related('assigneeDepartment', 'assigneePosition')
+                       .filter(config=activity.config)
+                       .order_by('position'))
 
     logger.info('{} resolve assignee for every step'.format(taskId))
-    stepAssigneeTuples = []
-    for index, step in enumerate(configSteps):
-        logger.info('{} resolve assignee for step#{}'.format(
-            taskId, step.position))
-
+    departments = []
+    for step in configSteps:
         assigneeDepartment = step.assigneeDepartment
         if assigneeDepartment is None:
             # 如果部门没有配置，那么就设置为发起者所在部门
             assigneeDepartment = profile.department
+        departments.append(assigneeDepartment)
+
+    assignees = resolveAssignees([(dep.pk, step.assigneePosition_id)
+                                  for step, dep in zip(configSteps, departments)])
 
+    stepAssigneeTuples = []
+    for step, assigneeDepartment in zip(configSteps, departments):
         logger.info('{} resolve assignee for step#{}, dep: {}, pos: {}'.format(
             taskId, step.position, assigneeDepartment.code, step.assigneePosition.code))
 
-        profiles = Profile.objects \
-            .filter(archived=False,
-                    department=assigneeDepartment,
-                    position=step.assigneePosition)
-
-        if profiles.count() == 0:
+        assignee = assignees.get((assigneeDepartment.pk, step.assigneePosition_id))
+        if assignee is None:
             logger.info('{} no candidates, skip'.format(taskId))
             continue
 
-        names = ', '.join([p.name for p in profiles])
-        logger.info('{} candidates: {}'.format(taskId, names))
-        assignee = profiles[0]
         logger.info('{} assignee: {}'.format(taskId, assignee.name))
-
         stepAssigneeTuples.append((step, assignee,))
 
     logger.info('{} filter steps with the same assignee'.format(taskId))
@@ -189,8 +220,13 @@ def setupSteps(activity, taskId=None):
         pos = pos + 1
 
 
-@transaction.atomic
 def createActivity(profile, data):
+    # 流水号在审批单的事务之外分配，序号的行锁不会一直持有到审批单创建完成
+    return _createActivity(profile, data, generateActivitySN())
+
+
+@transaction.atomic
+def _createActivity(profile, data, sn):
     # TODO: validate user permission
     configId = data.get('config', None)  # audit acitivity config id
     configCode = data.get('code', None)  # audit acitivity config code
@@ -209,10 +245,12 @@ def createActivity(profile, data):
 
     activity = AuditActivity.objects \
         .create(config=config,
-                sn=generateActivitySN(),
+                sn=sn,
                 state=AuditActivity.StateDraft,
                 creator=profile,
                 amount=amount,
+                searchName=resolveActivityDisplayName(profile.name, config.subtype),
+                searchType=resolveActivityDisplayType(config.subtype),
                 extra=data['extra'])
 
     if submit:
@@ -240,7 +278,9 @@ def activities(request):
 @validateToken
 def activity(request, activityId):
     # TODO: validate user permission
-    activity = AuditActivity.objects.get(pk=activityId)
+    activity = AuditActivity.objects \
+        .select_related('config', 'creator__department', 'creator__position', 'creator__role') \
+        .get(pk=activityId)
     return JsonResponse(resolve_activity(activity))
 
 
@@ -255,6 +295,9 @@ def cancel(request, activityId):
             activity.state = AuditActivity.StateCancelled
             AuditStep.objects.filter(activity=activity).delete()
             activity.finished_at = datetime.datetime.now(tz=timezone.utc)
+            activity.activeStep = None
+            activity.activeAssignee = None
+            activity.hurried_at = None
             activity.save()
 
             # delete messages
@@ -321,95 +364,16 @@ def relaunch(request, activityId):
     return JsonResponse({'id': str(activity.pk)})
 
 
-def validateStepState(step, profile):
-    if step.state != AuditStep.StatePending:
-        return {
-            'errorId': 'invalid-step-state',
-            'errorMsg': 'Current step state is {}. Can not change current step state.'.format(step.state)
-        }
-
-    if step.active is not True:
-        return {
-            'errorId': 'invalid-step-state',
-            'errorMsg': 'not current step'
-        }
-
-    if step.assignee.pk != profile.pk:
-        return {
-            'errorId': 'invalid-assignee'
-        }
-
-    return None
-
-
 @require_http_methods(['POST'])
 @validateToken
 def approveStep(request, stepId):
     # TODO: validate user permission
-    profile = request.profile
     data = json.loads(request.body.decode('utf-8'))
-    desc = data.get('desc', None)
     try:
-        step = AuditStep.objects.get(pk=stepId)
-        err = validateStepState(step, profile)
-        if err != None:
-            return JsonResponse(err, status=400)
-
-        step.state = AuditStep.StateApproved
-        step.active = False
-        step.finished_at = datetime.datetime.now(tz=timezone.utc)
-        step.desc = desc
-
-        # delete hurry up message
-        Message.objects \
-            .filter(activity=step.activity,
-                    profile=step.assignee,
-                    category='hurryup') \
-            .delete()
-        Message.objects \
-            .filter(activity=step.activity,
-                    profile=step.assignee,
-                    category='progress') \
-            .delete()
-
-        step.save()
-        if step.nextStep() == None:
-            activity = step.activity
-            activity.state = AuditActivity.StateApproved
-            if activity.config.hasTask:
-                activity.taskState = 'pending'
-            activity.save()
-
-            if activity.config.subtype == 'biz_contract':
-                info = activity.extra['info']
-                Taizhang.objects.create(
-                    auditId=activity.pk,
-                    date=activity.created_at.strftime('%Y-%m'),
-                    asset=info['asset'],
-                    upstream=info['upstream'],
-                    upstream_dunwei=info['tonnage'],
-                    buyPrice=info['buyPrice'],
-
-                    downstream=info.get('downstream', ''),
-                    downstream_dunwei=info['tonnage'],
-                    sellPrice=info['sellPrice'],
-                )
-                StatsEvent.objects.create(source='taizhang', event='invalidate')
-
-            Message.objects.create(profile=activity.creator,
-                                   activity=activity,
-                                   category='finish',
-                                   extra={'state': 'approved'})
-        else:
-            nextStep = step.nextStep()
-            nextStep.active = True
-            nextStep.activated_at = datetime.datetime.now(tz=timezone.utc)
-            nextStep.save()
-            Message.objects.create(activity=step.activity,
-                                   category='progress',
-                                   extra={},
-                                   profile=nextStep.assignee)
+        workflow.approveStep(stepId, request.profile, desc=data.get('desc', None))
         return JsonResponse({'ok': True})
+    except workflow.WorkflowError as e:
+        return JsonResponse(e.data, status=400)
     except:
         logger.exception("fail to approve step")
         return JsonResponse({
@@ -421,49 +385,61 @@ def approveStep(request, stepId):
 @validateToken
 def rejectStep(request, stepId):
     # TODO: validate user permission
-    profile = request.profile
     data = json.loads(request.body.decode('utf-8'))
-    desc = data.get('desc', None)
     try:
-        step = AuditStep.objects.get(pk=stepId)
-        err = validateStepState(step, profile)
-        if err != None:
-            return JsonResponse(err, status=400)
-
-        step.state = AuditStep.StateRejected
-        step.finished_at = datetime.datetime.now(tz=timezone.utc)
-        step.active = False
-        step.desc = desc
-        step.save()
-
-        # delete hurry up message
-        Message.objects \
-            .filter(activity=step.activity,
-                    profile=step.assignee,
-                    category='hurryup') \
-            .delete()
-        Message.objects \
-            .filter(activity=step.activity,
-                    profile=step.assignee,
-                    category='progress') \
-            .delete()
-
-        activity = step.activity
-        activity.finished_at = datetime.datetime.now(tz=timezone.utc)
-        activity.state = AuditActivity.StateRejected
-        activity.save()
-
-        Message.objects.create(profile=activity.creator,
-                               activity=activity,
-                               category='finish',
-                               extra={'state': 'rejected'})
+        workflow.rejectStep(stepId, request.profile, desc=data.get('desc', None))
         return JsonResponse({'ok': True})
+    except workflow.WorkflowError as e:
+        return JsonResponse(e.data, status=400)
     except:
         return JsonResponse({
             'errorId': 'step-not-found'
         }, status=400)
 
 
+def transitionSteps(request, action):
+    data = json.loads(request.body.decode('utf-8'))
+    stepIds = data.get('steps', None)
+    if not isinstance(stepIds, list) or len(stepIds) == 0 \
+            or not all(isinstance(stepId, str) for stepId in stepIds):
+        return JsonResponse({'errorId': 'invalid-parameters'}, status=400)
+
+    try:
+        errors = workflow.transitionSteps(stepIds, request.profile, action, desc=data.get('desc', None))
+    except:
+        logger.exception("fail to %s steps", action)
+        return JsonResponse({
+            'errorId': '{}-step-error'.format(action)
+        }, status=400)
+
+    results = []
+    for stepId in stepIds:
+        err = errors.get(stepId, None)
+        if err is None:
+            results.append({'id': stepId, 'ok': True})
+        else:
+            results.append(dict(err, id=stepId, ok=False))
+    return JsonResponse({'results': results})
+
+
+@require_http_methods(['POST'])
+@validateToken
+def approveSteps(request):
+    '''
+    批量审批通过，body: {"steps": [stepId, ...], "desc": "..."}
+    '''
+    return transitionSteps(request, 'approve')
+
+
+@require_http_methods(['POST'])
+@validateToken
+def rejectSteps(request):
+    '''
+    批量审批拒绝，body: {"steps": [stepId, ...], "desc": "..."}
+    '''
+    return transitionSteps(request, 'reject')
+
+
 def searchActivities(activities, search):
     parts = search.split(' ')
     keywords = []
@@ -471,16 +447,14 @@ def searchActivities(activities, search):
         if part != '':
             keywords.append(part)
 
-    result = []
-    for activity in activities:
-        n = activity.appDisplayName
-        t = activity.appDisplayType
-        if any([k in t for k in keywords]):
-            result.append(activity)
-        elif any([k in n for k in keywords]):
-            result.append(activity)
+    if len(keywords) == 0:
+        return activities.none()
 
-    return result, len(result)
+    # 任一关键字出现在审批类型或者审批名称当中即可
+    q = Q()
+    for k in keywords:
+        q = q | Q(searchType__contains=k) | Q(searchName__contains=k)
+    return activities.filter(q)
 
 
 @require_http_methods(['GET'])
@@ -521,20 +495,14 @@ def mineActivities(request):
         activities = activities.filter(amount__lte=amount_end)
 
     if notEmpty(search):
-        activities = activities.order_by('-updated_at')
-        activities, total = searchActivities(activities, search)
-        activities = activities[start:start + limit]
-        return JsonResponse({
-            'total': total,
-            'activities': [resolve_activity(activity, include_steps=False) for activity in activities]
-        })
+        activities = searchActivities(activities, search)
 
     activities = activities.order_by('-updated_at')
     total = activities.count()
     activities = activities[start:start + limit]
     return JsonResponse({
         'total': total,
-        'activities': [resolve_activity(activity, include_steps=False) for activity in activities]
+        'activities': resolve_activities(activities)
     })
 
 
@@ -542,6 +510,31 @@ def notEmpty(value):
     return value is not None and value != ''
 
 
+# 审批人相关列表里作用在审批本身的筛选条件，审批步骤只作为子查询
+def filterStepActivities(activities,
+                         auditType=None,
+                         creator_name=None,
+                         created_at_start=None,
+                         amount_start=None,
+                         amount_end=None):
+    if notEmpty(auditType):
+        activities = activities.filter(
+            config__subtype__in=auditType.split(','))
+    if notEmpty(creator_name):
+        activities = activities.filter(creator__name=creator_name)
+
+    if notEmpty(created_at_start):
+        date = iso8601.parse_date(created_at_start)
+        activities = activities.filter(created_at__gte=date)
+
+    if notEmpty(amount_start):
+        activities = activities.filter(amount__gte=amount_start)
+    if notEmpty(amount_end):
+        activities = activities.filter(amount__lte=amount_end)
+
+    return activities
+
+
 # 被分配给用户的所有审批（包含未审批和已审批的）
 @require_http_methods(['GET'])
 @validateToken
@@ -556,46 +549,32 @@ def relatedActivities(request):
     limit = int(request.GET.get('limit', '20'))
 
     # TODO: 处理职位变更问题
-    steps = AuditStep.objects \
-        .select_related('creator', 'config') \
-        .filter(assignee=request.profile,
-                activity__archived=False)
+    steps = AuditStep.objects.filter(assignee=request.profile)
     steps = steps.filter(Q(active=True) |
                          Q(state__in=[
                              AuditStep.StateApproved,
                              AuditStep.StateRejected
                          ]))
-
-    if notEmpty(auditType):
-        steps = steps.filter(
-            activity__config__subtype__in=auditType.split(','))
-    if notEmpty(creator_name):
-        steps = steps.filter(activity__creator__name=creator_name)
-
-    if notEmpty(created_at_start):
-        date = iso8601.parse_date(created_at_start)
-        steps = steps.filter(activity__created_at__gte=date)
     if notEmpty(created_at_end):
         date = iso8601.parse_date(created_at_end)
         steps = steps.filter(created_at__lt=date)
 
-    activityIdx = [s.activity.pk for s in steps]
-    activities = AuditActivity.objects.filter(pk__in=activityIdx)
-    activities = activities.order_by('-updated_at')
-
+    activities = AuditActivity.objects \
+        .filter(pk__in=steps.values('activity'),
+                archived=False)
+    activities = filterStepActivities(activities,
+                                      auditType=auditType,
+                                      creator_name=creator_name,
+                                      created_at_start=created_at_start)
     if notEmpty(search):
-        activities, total = searchActivities(activities, search)
-        activities = activities[start:start + limit]
-        return JsonResponse({
-            'total': total,
-            'activities': [resolve_activity(activity, include_steps=False) for activity in activities]
-        })
+        activities = searchActivities(activities, search)
 
+    activities = activities.order_by('-updated_at')
     total = activities.count()
     activities = activities[start:start + limit]
     return JsonResponse({
         'total': total,
-        'activities': [resolve_activity(activity, include_steps=False) for activity in activities]
+        'activities': resolve_activities(activities)
     })
 
 
@@ -615,37 +594,28 @@ def assignedActivities(request):
 
     # TODO: 处理职位变更问题
     steps = AuditStep.objects.filter(assignee=request.profile,
-                                     activity__archived=False,
                                      active=True)
-    if notEmpty(auditType):
-        steps = steps.filter(
-            activity__config__subtype__in=auditType.split(','))
-    if notEmpty(creator_name):
-        steps = steps.filter(activity__creator__name=creator_name)
-
-    if notEmpty(created_at_start):
-        date = iso8601.parse_date(created_at_start)
-        steps = steps.filter(activity__created_at__gte=date)
     if notEmpty(created_at_end):
         date = iso8601.parse_date(created_at_end)
         steps = steps.filter(created_at__lt=date)
 
-    if notEmpty(amount_start):
-        steps = steps.filter(activity__amount__gte=amount_start)
-    if notEmpty(amount_end):
-        steps = steps.filter(activity__amount__lte=amount_end)
-
-    activityIdx = [s.activity.pk for s in steps]
     activities = AuditActivity.objects \
         .select_related('creator', 'config') \
-        .filter(pk__in=activityIdx)
+        .filter(pk__in=steps.values('activity'),
+                archived=False)
+    activities = filterStepActivities(activities,
+                                      auditType=auditType,
+                                      creator_name=creator_name,
+                                      created_at_start=created_at_start,
+                                      amount_start=amount_start,
+                                      amount_end=amount_end)
     activities = activities.order_by('-updated_at')
 
     total = activities.count()
     activities = activities[start:start + limit]
     return JsonResponse({
         'total': total,
-        'activities': [resolve_activity(activity, include_steps=False) for activity in activities]
+        'activities': resolve_activities(activities)
     })
 
 
@@ -663,41 +633,34 @@ def processedActivities(request):
     start = int(request.GET.get('start', '0'))
     limit = int(request.GET.get('limit', '20'))
 
+    # 已审批的步骤都不是 active 状态
     steps = AuditStep.objects.filter(assignee=request.profile,
-                                     activity__archived=False,
+                                     active=False,
                                      state__in=[
                                          AuditStep.StateApproved,
                                          AuditStep.StateRejected
                                      ])
-    if notEmpty(auditType):
-        steps = steps.filter(
-            activity__config__subtype__in=auditType.split(','))
-    if notEmpty(creator_name):
-        steps = steps.filter(activity__creator__name=creator_name)
-
-    if notEmpty(created_at_start):
-        date = iso8601.parse_date(created_at_start)
-        steps = steps.filter(activity__created_at__gte=date)
     if notEmpty(created_at_end):
         date = iso8601.parse_date(created_at_end)
         steps = steps.filter(created_at__lt=date)
 
-    if notEmpty(amount_start):
-        steps = steps.filter(activity__amount__gte=amount_start)
-    if notEmpty(amount_end):
-        steps = steps.filter(activity__amount__lte=amount_end)
-
-    activityIdx = [s.activity.pk for s in steps]
     activities = AuditActivity.objects \
         .select_related('creator', 'config') \
-        .filter(pk__in=activityIdx)
+        .filter(pk__in=steps.values('activity'),
+                archived=False)
+    activities = filterStepActivities(activities,
+                                      auditType=auditType,
+                                      creator_name=creator_name,
+                                      created_at_start=created_at_start,
+                                      amount_start=amount_start,
+                                      amount_end=amount_end)
     activities = activities.order_by('-updated_at')
 
     total = activities.count()
     activities = activities[start:start + limit]
     return JsonResponse({
         'total': total,
-        'activities': [resolve_activity(activity, include_steps=False) for activity in activities]
+        'activities': resolve_activities(activities)
     })
 
 
@@ -741,7 +704,7 @@ def auditTasks(request):
     activities = activities[start:start + limit]
     return JsonResponse({
         'total': total,
-        'activities': [resolve_activity(activity, include_steps=False) for activity in activities]
+        'activities': resolve_activities(activities)
     })
 
 
@@ -758,14 +721,13 @@ def hurryup(request, activityId):
         # nothing to do
         return JsonResponse({'ok': True})
 
-    step = activity.currentStep()
-    if activity.canHurryup \
-            and step is not None \
-            and step.assignee is not None:
+    if activity.canHurryup and activity.activeAssignee_id is not None:
         Message.objects.create(activity=activity,
                                category='hurryup',
                                extra={},
-                               profile=step.assignee)
+                               profile_id=activity.activeAssignee_id)
+        activity.hurried_at = datetime.datetime.now(tz=timezone.utc)
+        activity.save(update_fields=['hurried_at'])
 
     return JsonResponse({'ok': True})
 
@@ -1,27 +1,36 @@
 from __future__ import unicode_literals
 from decimal import Decimal
+import io
 import os
 import re
+import atexit
+import copy
 import json
 import logging
 import datetime
 import zipfile
-from shutil import copyfile, make_archive
+import threading
+import collections
+import multiprocessing
+from functools import partial
 
 import iso8601
-from django.db import transaction
+from django.db import transaction, connections
 from django.db.models import Q
 from django.utils import timezone
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.http import urlquote
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
 from sendfile import sendfile
 from openpyxl import load_workbook
 from openpyxl.styles import Border, Side, Alignment
+from openpyxl.utils.indexed_list import IndexedList
 
 from core.models import *
 from core.auth import validateToken
 from core.common import *
+from core.exportWorker import initExportWorker
 
 logger = logging.getLogger('app.core.views.auditExport')
 thin = Side(border_style="thin", color="000000")
@@ -187,8 +196,7 @@ def resolveProfileFromAudit(activity, dep=None, pos=None):
 def exportOpenAccountAuditDoc(activity):
     account = activity.extra['account']
 
-    cwd = os.getcwd()
-    wb = load_workbook(cwd + '/xlsx-templates/open_account.xlsx')
+    wb = loadTemplate('open_account')
     ws = wb.active
 
     ws['B2'].value = activity.creator.department.name
@@ -238,23 +246,7 @@ def exportOpenAccountAuditDoc(activity):
     ws['B9'].value = account.get('desc', '')
     ws['B9'].alignment = Alignment(horizontal='center', vertical='center')
 
-    # fix border style
-    for cell in ws.merged_cells:
-        if not inBounds('A2:D9', cell):
-            logger.info('ignore cell: {}'.format(cell.coord))
-            continue
-
-        logger.info('fix border style {}'.format(cell.coord))
-        style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
-
-    set_border(ws, 'A2:D9', 'medium')
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
-    path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
-    wb.save(path)
-    return path
+    return wb
 
 
 def exportCostAuditDoc(activity):
@@ -263,10 +255,10 @@ def exportCostAuditDoc(activity):
     rows = [3, 5, 7, 9, 11, 13, 15]
     for row in rows:
         if len(items) <= row:
-            template = 'cost-{}.xlsx'.format(row)
+            template = 'cost-{}'.format(row)
             break
 
-    wb = load_workbook(os.getcwd() + '/xlsx-templates/{}'.format(template))
+    wb = loadTemplate(template)
     ws = wb.active
 
     # cost items
@@ -343,33 +335,11 @@ def exportCostAuditDoc(activity):
         .format(account['name'], account['number'], account['bank'])
     ws['O3'].alignment = Alignment(vertical='center', wrapText=True)
 
-    # fix border tyle
-    style_range(ws, 'B3:B4', Border(top=medium, left=medium, right=thin, bottom=thin))
-    style_range(ws, 'C3:C4', Border(top=medium, left=thin, right=thin, bottom=thin))
-    style_range(ws, 'E3:M3', Border(top=medium, left=thin, right=thin, bottom=thin))
-
-    style_range(ws, 'N3:N' + str(5 + row), Border(top=medium, left=thin, right=thin, bottom=thin))
-    style_range(ws, 'O3:O' + str(5 + row), Border(top=medium, left=thin, right=medium, bottom=thin))
-
-    style_range(ws, 'D{}:M{}'.format(r, r), Border(top=thin, left=thin, right=thin, bottom=thin))
-    style_range(ws, 'N{}:O{}'.format(r, r), Border(top=thin, left=thin, right=medium, bottom=thin))
-
-    style_range(ws, 'D{}:O{}'.format(r + 1, r + 1), Border(top=thin, left=thin, right=medium, bottom=thin))
-    style_range(ws, 'D{}:O{}'.format(r + 2, r + 2), Border(top=thin, left=thin, right=medium, bottom=thin))
-    style_range(ws, 'D{}:O{}'.format(r + 3, r + 3), Border(top=thin, left=thin, right=medium, bottom=medium))
-
-    style_range(ws, 'B{}:B{}'.format(r + 1, r + 3), Border(top=thin, left=medium, right=thin, bottom=medium))
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
-    path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
-    wb.save(path)
-    return path
+    return wb
 
 
 def exportLoanAuditDoc(activity):
-    wb = load_workbook(os.getcwd() + '/xlsx-templates/loan.xlsx')
+    wb = loadTemplate('loan')
     ws = wb.active
 
     auditData = activity.extra
@@ -415,31 +385,7 @@ def exportLoanAuditDoc(activity):
     ws['M11'] = getattr(ceo, 'name', '')
     ws['M11'].alignment = Alignment(vertical='center', horizontal='center')
 
-    # fix border style
-    style_range(ws, 'B4:P4', Border(top=medium, left=medium, right=medium, bottom=thin))
-    style_range(ws, 'B5:P5', Border(top=thin, left=medium, right=medium, bottom=thin))
-    style_range(ws, 'B6:P6', Border(top=thin, left=medium, right=medium, bottom=thin))
-    style_range(ws, 'C7:P7', Border(top=thin, left=thin, right=medium, bottom=thin))
-    style_range(ws, 'B8:B9', Border(top=thin, left=medium, right=thin, bottom=thin))
-    style_range(ws, 'C8:P9', Border(top=thin, left=thin, right=medium, bottom=thin))
-
-    style_range(ws, 'B10:B11', Border(top=thin, left=medium, right=thin, bottom=medium))
-
-    style_range(ws, 'C10:E10', Border(top=thin, left=thin, right=thin, bottom=thin))
-    style_range(ws, 'C11:E11', Border(top=thin, left=thin, right=thin, bottom=medium))
-    style_range(ws, 'F10:H10', Border(top=thin, left=thin, right=thin, bottom=thin))
-    style_range(ws, 'F11:H11', Border(top=thin, left=thin, right=thin, bottom=medium))
-    style_range(ws, 'I10:L10', Border(top=thin, left=thin, right=thin, bottom=thin))
-    style_range(ws, 'I11:L11', Border(top=thin, left=thin, right=thin, bottom=medium))
-    style_range(ws, 'M10:P10', Border(top=thin, left=thin, right=medium, bottom=thin))
-    style_range(ws, 'M11:P11', Border(top=thin, left=thin, right=medium, bottom=medium))
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
-    path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
-    wb.save(path)
-    return path
+    return wb
 
 
 def set_border(ws, cell_range, border_style):
@@ -472,7 +418,7 @@ def set_border(ws, cell_range, border_style):
 
 
 def exportMoneyAuditDoc(activity):
-    wb = load_workbook(os.getcwd() + '/xlsx-templates/money.xlsx')
+    wb = loadTemplate('money')
     ws = wb.active
 
     ws['A1'] = '用 款 申 请 单'
@@ -522,26 +468,11 @@ def exportMoneyAuditDoc(activity):
     ws['H13'] = getattr(ceo, 'name', '')
     ws['H13'].alignment = Alignment(vertical='center', horizontal='center')
 
-    # A3:M3
-    for cell in ws.merged_cells:
-        if not inBounds('A3:M13', cell):
-            logger.info('ignore cell: {}'.format(cell.coord))
-            continue
-
-        logger.info('fix border style {}'.format(cell.coord))
-        style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
-    set_border(ws, 'A3:M13', 'medium')
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
-    path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
-    wb.save(path)
-    return path
+    return wb
 
 
 def exportBizContractAuditDoc(activity):
-    wb = load_workbook(os.getcwd() + '/xlsx-templates/biz_contract.xlsx')
+    wb = loadTemplate('biz_contract')
     ws = wb.active
 
     creator = activity.creator
@@ -586,20 +517,7 @@ def exportBizContractAuditDoc(activity):
     ws['B14'] = getattr(ceo, 'name', '')
     ws['B14'].alignment = Alignment(horizontal='center', vertical='center')
 
-    for cell in ws.merged_cells:
-        if not inBounds('A4:F19', cell):
-            logger.info('ignore cell: {}'.format(cell.coord))
-            continue
-
-        logger.info('fix border style {}'.format(cell.coord))
-        style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
-    path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
-    wb.save(path)
-    return path
+    return wb
 
 
 def exportFnContractAuditDoc(activity):
@@ -610,7 +528,7 @@ def exportFnContractAuditDoc(activity):
     if try_convert_float(info['amount']) == 0:
         template = 'fn_contract_zero'
 
-    wb = load_workbook(os.getcwd() + '/xlsx-templates/{}.xlsx'.format(template))
+    wb = loadTemplate(template)
     ws = wb.active
 
     ws['B3'] = base['name']
@@ -646,20 +564,7 @@ def exportFnContractAuditDoc(activity):
             if dp == 'root' and pos == 'ceo':
                 ws['B9'] = step.desc if step.desc is not None and desc != '' else '同意'
 
-    for cell in ws.merged_cells:
-        if not inBounds('A3:D11', cell):
-            logger.info('ignore cell: {}'.format(cell.coord))
-            continue
-
-        logger.info('fix border style {}'.format(cell.coord))
-        style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
-    path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
-    wb.save(path)
-    return path
+    return wb
 
 
 def exportTravelAuditDoc(activity):
@@ -672,9 +577,9 @@ def exportTravelAuditDoc(activity):
         availableRows = 10
 
     if availableRows == 4:
-        wb = load_workbook(os.getcwd() + '/xlsx-templates/travel.xlsx')
+        wb = loadTemplate('travel')
     else:
-        wb = load_workbook(os.getcwd() + '/xlsx-templates/travel-10.xlsx')
+        wb = loadTemplate('travel-10')
 
     ws = wb.worksheets[0]
     ws['C3'] = '姓名: {}                 部门: {}                    {}'.format(
@@ -803,17 +708,6 @@ def exportTravelAuditDoc(activity):
     ws['C' + str(r + 5)] = '会计：{}              人资专员：{}              出差人员签字：{}'.format(
         getattr(finAccountant, 'name', ''), getattr(hr, 'name', ''), creator.name)
 
-    for cell in ws.merged_cells:
-        if not inBounds('C4:W' + str(r + 4), cell):
-            logger.info('ignore cell: {}'.format(cell.coord))
-            continue
-
-        logger.info('fix border style {}'.format(cell.coord))
-        style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
     # 费用报销
     ws = wb.worksheets[1]
     info = auditData['info']
@@ -866,20 +760,7 @@ def exportTravelAuditDoc(activity):
         .format(account['name'], account['number'], account['bank'])
     ws['O3'].alignment = Alignment(vertical='center', wrapText=True)
 
-    for cell in ws.merged_cells:
-        if not inBounds('A3:O12', cell):
-            logger.info('ignore cell: {}'.format(cell.coord))
-            continue
-
-        logger.info('fix border style {}'.format(cell.coord))
-        style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
-
-    ws.protection.sheet = True
-    ws.protection.set_password('zyhr2018')
-
-    path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
-    wb.save(path)
-    return path
+    return wb
 
 
 def exportRongzitikuanAudit(activity):
@@ -887,7 +768,7 @@ def exportRongzitikuanAudit(activity):
     info = auditData['info']
     template = 'rongzitikuan'
 
-    wb = load_workbook(os.getcwd() + '/xlsx-templates/{}.xlsx'.format(template))
+    wb = loadTemplate(template)
     ws = wb.active
 
     ws['B2'] = info['applicants']
@@ -915,51 +796,214 @@ def exportRongzitikuanAudit(activity):
     ws['B14'] = '{}'.format(getattr(finOwner, 'name', ''))
     ws['B15'] = '{}'.format(getattr(ceo, 'name', ''))
 
+    return wb
+
+
+def fixMergedBorders(ws, bounds):
     for cell in ws.merged_cells:
-        if not inBounds('A1:D15', cell):
-            logger.info('ignore cell: {}'.format(cell.coord))
-            continue
+        if inBounds(bounds, cell):
+            style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
 
-        logger.info('fix border style {}'.format(cell.coord))
-        style_range(ws, cell.coord, Border(top=thin, left=thin, right=thin, bottom=thin))
 
+def protect(ws):
     ws.protection.sheet = True
     ws.protection.set_password('zyhr2018')
 
+
+def compileOpenAccountTemplate(wb):
+    ws = wb.active
+    fixMergedBorders(ws, 'A2:D9')
+    set_border(ws, 'A2:D9', 'medium')
+    protect(ws)
+
+
+def compileCostTemplate(wb, row):
+    ws = wb.active
+    r = 5 + row
+    style_range(ws, 'B3:B4', Border(top=medium, left=medium, right=thin, bottom=thin))
+    style_range(ws, 'C3:C4', Border(top=medium, left=thin, right=thin, bottom=thin))
+    style_range(ws, 'E3:M3', Border(top=medium, left=thin, right=thin, bottom=thin))
+
+    style_range(ws, 'N3:N' + str(5 + row), Border(top=medium, left=thin, right=thin, bottom=thin))
+    style_range(ws, 'O3:O' + str(5 + row), Border(top=medium, left=thin, right=medium, bottom=thin))
+
+    style_range(ws, 'D{}:M{}'.format(r, r), Border(top=thin, left=thin, right=thin, bottom=thin))
+    style_range(ws, 'N{}:O{}'.format(r, r), Border(top=thin, left=thin, right=medium, bottom=thin))
+
+    style_range(ws, 'D{}:O{}'.format(r + 1, r + 1), Border(top=thin, left=thin, right=medium, bottom=thin))
+    style_range(ws, 'D{}:O{}'.format(r + 2, r + 2), Border(top=thin, left=thin, right=medium, bottom=thin))
+    style_range(ws, 'D{}:O{}'.format(r + 3, r + 3), Border(top=thin, left=thin, right=medium, bottom=medium))
+
+    style_range(ws, 'B{}:B{}'.format(r + 1, r + 3), Border(top=thin, left=medium, right=thin, bottom=medium))
+    protect(ws)
+
+
+def compileLoanTemplate(wb):
+    ws = wb.active
+    style_range(ws, 'B4:P4', Border(top=medium, left=medium, right=medium, bottom=thin))
+    style_range(ws, 'B5:P5', Border(top=thin, left=medium, right=medium, bottom=thin))
+    style_range(ws, 'B6:P6', Border(top=thin, left=medium, right=medium, bottom=thin))
+    style_range(ws, 'C7:P7', Border(top=thin, left=thin, right=medium, bottom=thin))
+    style_range(ws, 'B8:B9', Border(top=thin, left=medium, right=thin, bottom=thin))
+    style_range(ws, 'C8:P9', Border(top=thin, left=thin, right=medium, bottom=thin))
+
+    style_range(ws, 'B10:B11', Border(top=thin, left=medium, right=thin, bottom=medium))
+
+    style_range(ws, 'C10:E10', Border(top=thin, left=thin, right=thin, bottom=thin))
+    style_range(ws, 'C11:E11', Border(top=thin, left=thin, right=thin, bottom=medium))
+    style_range(ws, 'F10:H10', Border(top=thin, left=thin, right=thin, bottom=thin))
+    style_range(ws, 'F11:H11', Border(top=thin, left=thin, right=thin, bottom=medium))
+    style_range(ws, 'I10:L10', Border(top=thin, left=thin, right=thin, bottom=thin))
+    style_range(ws, 'I11:L11', Border(top=thin, left=thin, right=thin, bottom=medium))
+    style_range(ws, 'M10:P10', Border(top=thin, left=thin, right=medium, bottom=thin))
+    style_range(ws, 'M11:P11', Border(top=thin, left=thin, right=medium, bottom=medium))
+    protect(ws)
+
+
+def compileMoneyTemplate(wb):
+    ws = wb.active
+    fixMergedBorders(ws, 'A3:M13')
+    set_border(ws, 'A3:M13', 'medium')
+    protect(ws)
+
+
+def compileBizContractTemplate(wb):
+    ws = wb.active
+    fixMergedBorders(ws, 'A4:F19')
+    protect(ws)
+
+
+def compileFnContractTemplate(wb):
+    ws = wb.active
+    fixMergedBorders(ws, 'A3:D11')
+    protect(ws)
+
+
+def compileTravelTemplate(wb, availableRows):
+    ws = wb.worksheets[0]
+    fixMergedBorders(ws, 'C4:W' + str(8 + availableRows + 4))
+    protect(ws)
+
+    ws = wb.worksheets[1]
+    fixMergedBorders(ws, 'A3:O12')
+    protect(ws)
+
+
+def compileRongzitikuanTemplate(wb):
+    ws = wb.active
+    fixMergedBorders(ws, 'A1:D15')
+    protect(ws)
+
+
+# 模板名称 -> 处理模板里固定样式的函数，数据无关的边框、保护在这里处理好
+templateCompilers = {
+    'open_account': compileOpenAccountTemplate,
+    'loan': compileLoanTemplate,
+    'money': compileMoneyTemplate,
+    'biz_contract': compileBizContractTemplate,
+    'fn_contract': compileFnContractTemplate,
+    'fn_contract_zero': compileFnContractTemplate,
+    'rongzitikuan': compileRongzitikuanTemplate,
+    'travel': partial(compileTravelTemplate, availableRows=4),
+    'travel-10': partial(compileTravelTemplate, availableRows=10),
+}
+for row in [3, 5, 7, 9, 11, 13, 15]:
+    templateCompilers['cost-{}'.format(row)] = partial(compileCostTemplate, row=row)
+
+compiledTemplates = {}
+compiledTemplatesLock = threading.Lock()
+
+# workbook 里共享的样式列表
+STYLE_LISTS = ['_fonts', '_borders', '_fills', '_number_formats', '_alignments', '_protections', '_cell_styles']
+
+
+def compileTemplate(name):
+    wb = load_workbook(os.getcwd() + '/xlsx-templates/{}.xlsx'.format(name))
+    templateCompilers[name](wb)
+    return wb
+
+
+def compileTemplates():
+    '''
+    启动时编译所有模板，导出时不需要再读取模板文件
+    '''
+    for name in templateCompilers:
+        getCompiledTemplate(name)
+
+
+def getCompiledTemplate(name):
+    wb = compiledTemplates.get(name)
+    if wb is None:
+        with compiledTemplatesLock:
+            wb = compiledTemplates.get(name)
+            if wb is None:
+                wb = compileTemplate(name)
+                compiledTemplates[name] = wb
+    return wb
+
+
+def copyIndexedList(styles):
+    c = IndexedList()
+    list.extend(c, styles)
+    c._dict = dict(styles._dict)
+    c.clean = styles.clean
+    return c
+
+
+def loadTemplate(name):
+    '''
+    复制一份编译好的模板，只需要再填入数据
+    '''
+    wb = getCompiledTemplate(name)
+
+    # IndexedList 没办法直接 deepcopy，先复制好放到 memo 里
+    memo = {}
+    for attr in STYLE_LISTS:
+        styles = getattr(wb, attr)
+        memo[id(styles)] = copyIndexedList(styles)
+    return copy.deepcopy(wb, memo)
+
+
+def saveWorkbook(wb):
     path = '/tmp/{}.xlsx'.format(str(uuid.uuid4()))
     wb.save(path)
     return path
 
 
-def _export(activity):
-    path, filename = None, None
+def _render(activity):
+    wb, filename = None, None
     if activity.config.subtype == 'open_account':
-        path = exportOpenAccountAuditDoc(activity)
+        wb = exportOpenAccountAuditDoc(activity)
         filename = '银行开户申请审批单.xlsx'
     elif re.match('cost', activity.config.subtype):
-        path = exportCostAuditDoc(activity)
+        wb = exportCostAuditDoc(activity)
         filename = '费用报销审批单.xlsx'
     elif re.match('loan', activity.config.subtype):
-        path = exportLoanAuditDoc(activity)
+        wb = exportLoanAuditDoc(activity)
         filename = '借款审批单.xlsx'
     elif re.match('money', activity.config.subtype):
-        path = exportMoneyAuditDoc(activity)
+        wb = exportMoneyAuditDoc(activity)
         filename = '用款审批单.xlsx'
     elif re.match('biz', activity.config.subtype):
-        path = exportBizContractAuditDoc(activity)
+        wb = exportBizContractAuditDoc(activity)
         filename = '业务合同会签审批.xlsx'
     elif re.match('fn', activity.config.subtype):
-        path = exportFnContractAuditDoc(activity)
+        wb = exportFnContractAuditDoc(activity)
         filename = '职能合同会签审批.xlsx'
     elif re.match('rongzitikuan', activity.config.subtype):
-        path = exportRongzitikuanAudit(activity)
+        wb = exportRongzitikuanAudit(activity)
         filename = '融资提款申请.xlsx'
     else:
         # travel
-        path = exportTravelAuditDoc(activity)
+        wb = exportTravelAuditDoc(activity)
         filename = '差旅费用报销审批单.xlsx'
 
-    return path, filename
+    return wb, filename
+
+
+def _export(activity):
+    wb, filename = _render(activity)
+    return saveWorkbook(wb), filename
 
 
 @require_http_methods(['GET'])
@@ -971,32 +1015,151 @@ def export(request, activityId):
                     attachment_filename=filename)
 
 
-def zipdir(path, ziph):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            ziph.write(os.path.join(root, file), arcname=file)
+def renderAuditDoc(activityId):
+    '''
+    在 worker 进程里执行，返回压缩包里的文件名和 xlsx 的内容
+    '''
+    activity = AuditActivity.objects \
+        .select_related('config', 'creator__department') \
+        .get(pk=activityId)
+    wb, filename = _render(activity)
+    f = io.BytesIO()
+    wb.save(f)
+
+    name = filename.split('.')[0]
+    time_str = activity.created_at.strftime('%Y%m%d%H%M%S')
+    return '{}-{}.xlsx'.format(name, time_str), f.getvalue()
+
+
+exportPool = None
+exportPoolLock = threading.Lock()
+
+
+def startExportPool():
+    '''
+    第一次批量导出时创建进程池。worker 用 spawn 启动，不复制请求线程的数据库连接和事务，
+    启动时连接父进程使用的数据库并编译好模板；每个 web 进程各有 AUDIT_EXPORT_WORKERS 个 worker
+    '''
+    global exportPool
+    with exportPoolLock:
+        if exportPool is None and settings.AUDIT_EXPORT_WORKERS > 0:
+            databases = dict((conn.alias, conn.settings_dict['NAME']) for conn in connections.all())
+            exportPool = multiprocessing.get_context('spawn').Pool(settings.AUDIT_EXPORT_WORKERS,
+                                                                   initializer=initExportWorker,
+                                                                   initargs=(databases,))
+            atexit.register(closeExportPool)
+    return exportPool
+
+
+def closeExportPool():
+    global exportPool
+    with exportPoolLock:
+        pool, exportPool = exportPool, None
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+def getExportPool():
+    return exportPool or startExportPool()
+
+
+def renderAuditDocs(activityIds):
+    '''
+    按顺序返回 (activityId, result)，渲染失败时 result 为异常
+
+    最多同时有 AUDIT_EXPORT_MAX_PENDING 个审批单在渲染或者等待写入压缩包，
+    渲染的并发数由进程池的大小 AUDIT_EXPORT_WORKERS 限制，为 0 时在当前进程渲染
+    '''
+    if settings.AUDIT_EXPORT_WORKERS == 0:
+        for activityId in activityIds:
+            try:
+                yield activityId, renderAuditDoc(activityId)
+            except Exception as e:
+                yield activityId, e
+        return
+
+    pool = getExportPool()
+    pending = collections.deque()
+
+    def wait():
+        activityId, result = pending.popleft()
+        try:
+            return activityId, result.get()
+        except Exception as e:
+            return activityId, e
+
+    for activityId in activityIds:
+        if len(pending) >= settings.AUDIT_EXPORT_MAX_PENDING:
+            yield wait()
+        pending.append((activityId, pool.apply_async(renderAuditDoc, (activityId,))))
+
+    while pending:
+        yield wait()
+
+
+class ZipStream:
+    '''
+    ZipFile 写入的数据先放在内存里，每写完一个文件取出来返回给客户端
+    '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def streamAuditDocs(activityIds):
+    stream = ZipStream()
+    zipf = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+
+    names = set()
+    failed = []
+    for activityId, result in renderAuditDocs(activityIds):
+        if isinstance(result, Exception):
+            logger.error('fail to export audit activity {}: {}'.format(activityId, result))
+            failed.append(str(activityId))
+            continue
 
+        name, data = result
+        # 同一秒创建的同类审批单，文件名加上序号
+        base, index = name[:-len('.xlsx')], 1
+        while name in names:
+            index = index + 1
+            name = '{}-{}.xlsx'.format(base, index)
+        names.add(name)
+
+        zipf.writestr(name, data)
+        yield stream.drain()
+
+    if len(failed) > 0:
+        zipf.writestr('导出失败.txt', '\n'.join(failed))
 
-@require_http_methods(['GET'])
-def batchExport(request):
-    idx = request.GET.get('idx')
-    idx = idx.split(',')
-
-    dir = '/tmp/archive-' + str(uuid.uuid4())
-    os.makedirs(dir)
-
-    activities = AuditActivity.objects.filter(pk__in=idx)
-    for activity in activities:
-        path, filename = _export(activity)
-        name = filename.split('.')[0]
-        time_str = activity.created_at.strftime('%Y%m%d%H%M%S')
-        copyfile(path, dir + '/{}-{}.xlsx'.format(name, time_str))
-
-    path = '/tmp/审批单-{}.zip'.format(str(uuid.uuid4()))
-    zipf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
-    zipdir(dir, zipf)
     zipf.close()
+    yield stream.drain()
 
-    return sendfile(request, path,
-                    attachment=True,
-                    attachment_filename='审批单.zip')
+
+@require_http_methods(['GET'])
+def batchExport(request):
+    idx = request.GET.get('idx', '')
+    idx = [i for i in idx.split(',') if i != '']
+
+    activityIds = list(AuditActivity.objects
+                       .filter(pk__in=idx)
+                       .order_by('created_at')
+                       .values_list('pk', flat=True))
+
+    response = StreamingHttpResponse(streamAuditDocs(activityIds), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="audit.zip"; filename*=UTF-8\'\'{}' \
+        .format(urlquote('审批单.zip'))
+    return response
@@ -5,6 +5,7 @@ import pandas
 import xlwt
 import xlrd
 from decimal import Decimal
+from collections import OrderedDict
 
 from django.db.models import Q
 from django.db import transaction
@@ -22,33 +23,64 @@ from core.exception import *
 
 @require_http_methods(['GET'])
 @validateToken
+@cacheStats('taizhang')
 def taizhang_companies(request):
-    companies = TaizhangStat.objects.all().values('company').distinct()
+    companies = TaizhangStat.active().values('company').distinct()
     companies = [c['company'] for c in companies]
 
     return JsonResponse(companies, safe=False)
 
 
+TAIZHANG_PROPS = ['xiaoshoue', 'lirune', 'kuchun_liang', 'zijin_zhanya']
+
+
+def pivotStats(records, index, column, value, indexes, columns, carry=False):
+    '''
+    把 (index, column, value) 的记录转成 indexes x columns 的二维列表，没有数据的格子补 0；
+    carry 为 True 时（比如余额）沿用同一行前一个有数据的格子
+    '''
+    df = pandas.DataFrame.from_records(records, columns=[index, column, value])
+    table = df.pivot(index=index, columns=column, values=value)
+    table = table.reindex(index=indexes, columns=columns).astype(object)
+    if carry:
+        table = table.fillna(method='ffill', axis=1)
+    return table.fillna(Decimal('0.00')).values.tolist()
+
+
+def parseDateRange(request):
+    '''
+    可选的 date_start/date_end（YYYY-MM-DD，包含两端），格式不对时抛出 ValueError
+    '''
+    dateStart = request.GET.get('date_start', None)
+    dateEnd = request.GET.get('date_end', None)
+    dateStart = dateStart if dateStart else None
+    dateEnd = dateEnd if dateEnd else None
+    for date in [dateStart, dateEnd]:
+        if date is not None:
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+    return dateStart, dateEnd
+
+
 @require_http_methods(['GET', 'POST'])
 @validateToken
+@cacheStats('taizhang')
 def taizhang_line(request):
     company = request.GET.get('company', None)
     prop = request.GET.get('prop', None)
+    if prop not in TAIZHANG_PROPS:
+        return JsonResponse({'errorId': 'invalid-parameters'}, status=400)
 
-    tss = TaizhangStat.objects.filter(category='month', company=company)
+    # 一次查出每个货物每个月的数据，再在内存里转成 货物 x 月份
+    records = TaizhangStat.active() \
+        .filter(category='month', company=company) \
+        .values('asset', 'month') \
+        .annotate(value=Sum(prop)) \
+        .order_by()
+    records = list(records)
 
-    months = tss.values('month').distinct().order_by('month')
-    months = [w['month'] for w in months]
-
-    assets = tss.values('asset').distinct()
-    assets = [a['asset'] for a in assets]
-
-    series = []
-    for asset in assets:
-        tss_by_asset = tss.filter(asset=asset)
-        tss_by_asset = tss_by_asset.order_by('month')
-        s = [getattr(t, prop) for t in tss_by_asset]
-        series.append(s)
+    months = sorted(set(r['month'] for r in records))
+    assets = sorted(set(r['asset'] for r in records))
+    series = pivotStats(records, 'asset', 'month', 'value', assets, months)
 
     return JsonResponse({
         'months': months,
@@ -59,22 +91,20 @@ def taizhang_line(request):
 
 @require_http_methods(['GET'])
 @validateToken
+@cacheStats('taizhang')
 def taizhang_bar(request):
     company = request.GET.get('company', None)
 
-    tss = TaizhangStat.objects.filter(category='month', company=company)
+    d = {'sum_' + prop: Sum(prop) for prop in TAIZHANG_PROPS}
+    records = TaizhangStat.active() \
+        .filter(category='month', company=company) \
+        .values('month') \
+        .annotate(**d) \
+        .order_by('month')
+    records = list(records)
 
-    months = tss.values('month').distinct().order_by('month')
-    months = [w['month'] for w in months]
-
-    series = []
-    for prop in ['xiaoshoue', 'lirune', 'kuchun_liang', 'zijin_zhanya']:
-        p = 'sum_' + prop
-        d = {p: Sum(prop)}
-        tss_by_prop = tss.values('month').annotate(**d)
-        tss_by_prop = tss_by_prop.order_by('month')
-        s = [t.get(p, '0.00') for t in tss_by_prop]
-        series.append(s)
+    months = [r['month'] for r in records]
+    series = [[r['sum_' + prop] for r in records] for prop in TAIZHANG_PROPS]
 
     return JsonResponse({
         'months': months,
@@ -84,73 +114,83 @@ def taizhang_bar(request):
 
 @require_http_methods(['GET'])
 @validateToken
+@cacheStats('taizhang')
 def taizhang_pie(request):
     company = request.GET.get('company', None)
 
-    tss = TaizhangStat.objects.filter(category='month', company=company)
-    assets = tss.values('asset').distinct()
-    assets = [a['asset'] for a in assets]
-
-    total = Decimal(0.0)
-    assetData = []
-    for asset in assets:
-        t = tss \
-            .filter(asset=asset) \
-            .values('asset') \
-            .annotate(sum_xiaoshoue=Sum('xiaoshoue'))[0]
-        assetData.append({'name': asset, 'value': t['sum_xiaoshoue']})
-        total = total + t['sum_xiaoshoue']
+    records = TaizhangStat.active() \
+        .filter(category='month', company=company) \
+        .values('asset') \
+        .annotate(sum_xiaoshoue=Sum('xiaoshoue')) \
+        .order_by('asset')
 
-    for index, asset in enumerate(assets):
-        value = assetData[index]['value']
-        assetData[index]['percent'] = value / total * 100
+    assetData = [{'name': r['asset'], 'value': r['sum_xiaoshoue']} for r in records]
+    total = sum([d['value'] for d in assetData], Decimal(0))
+    for d in assetData:
+        # 销售额都为 0 时没有占比
+        d['percent'] = d['value'] / total * 100 if total != 0 else Decimal(0)
 
     return JsonResponse(assetData, safe=False)
 
 
 @require_http_methods(['GET'])
 @validateToken
+@cacheStats('funds')
 def funds_line(request):
     name = request.GET.get('name', None)
     number = request.GET.get('number', None)
+    try:
+        dateStart, dateEnd = parseDateRange(request)
+    except ValueError:
+        return JsonResponse({'errorId': 'invalid-parameters'}, status=400)
 
-    tss = TransactionStat.objects.filter(category='week')
+    tss = TransactionStat.active().filter(category='week')
     if name is not None and name != '':
         tss = tss.filter(account__name__contains=name)
     if number is not None and number != '':
         tss = tss.filter(account__number__contains=number)
+    if dateStart is not None:
+        tss = tss.filter(startDayOfWeek__gte=dateStart)
+    if dateEnd is not None:
+        tss = tss.filter(startDayOfWeek__lte=dateEnd)
 
-    accounts = tss.values('account__pk', 'account__name').distinct()
-    accountNames = [a['account__name'] for a in accounts]
-    accounts = [a['account__pk'] for a in accounts]
+    # 一次按账户、周查出所有数据，再在内存里转成 账户 x 周，缺少的周补 0
+    records = tss \
+        .values('account__pk', 'account__name', 'startDayOfWeek') \
+        .annotate(income=Sum('income'), outcome=Sum('outcome'), balance=Sum('balance')) \
+        .order_by('account__name', 'account__pk', 'startDayOfWeek')
+    records = list(records)
 
-    weeks = tss.values('startDayOfWeek').distinct().order_by('startDayOfWeek')
-    weeks = [w['startDayOfWeek'] for w in weeks]
+    accounts = OrderedDict((r['account__pk'], r['account__name']) for r in records)
+    weeks = sorted(set(r['startDayOfWeek'] for r in records))
+
+    def pivot(value, carry=False):
+        return pivotStats(records, 'account__pk', 'startDayOfWeek', value, list(accounts), weeks, carry=carry)
 
     series = []
-    for account in accounts:
-        tss_by_account = tss.filter(account__pk=account)
-        s = [{
-            'income': t.income,
-            'outcome': t.outcome,
-            'balance': t.balance
-        } for t in tss_by_account]
-        series.append(s)
+    # 没有流水的周余额不变
+    for income, outcome, balance in zip(pivot('income'), pivot('outcome'), pivot('balance', carry=True)):
+        series.append([{
+            'income': i,
+            'outcome': o,
+            'balance': b
+        } for i, o, b in zip(income, outcome, balance)])
 
     return JsonResponse({
         'weeks': weeks,
-        'accounts': accountNames,
+        'accounts': list(accounts.values()),
         'series': series
     })
 
 
 @require_http_methods(['GET'])
 @validateToken
+@cacheStats('funds')
 def funds_bar(request):
     name = request.GET.get('name', None)
     number = request.GET.get('number', None)
 
-    tss = TransactionStat.objects.filter(category='week')
+    tss = TransactionStat.active().filter(category='week')
     if name is not None and name != '':
         tss = tss.filter(account__name__contains=name)
     if number is not None and number != '':
@@ -180,37 +220,46 @@ def funds_bar(request):
 
 @require_http_methods(['GET'])
 @validateToken
+@cacheStats('customer')
 def customers_line(request):
-    css = CustomerStat.objects.filter(category='month')
-
-    months = css.values('month').distinct().order_by('month')
-    months = [w['month'] for w in months]
-
-    customers = css.values('customer__pk', 'customer__name').distinct()
-    customerNames = [c['customer__name'] for c in customers]
-    customers = [c['customer__pk'] for c in customers]
-
-    series = []
-    for c in customers:
-        css_by_customer = css.filter(customer=c)
-        css_by_customer = css_by_customer.order_by('month')
-        s = [{
-            'yewuliang': c.yewuliang,
-            'avg_price': '0.00'
-        } for c in css_by_customer]
-        series.append(s)
+    try:
+        dateStart, dateEnd = parseDateRange(request)
+    except ValueError:
+        return JsonResponse({'errorId': 'invalid-parameters'}, status=400)
+
+    css = CustomerStat.active().filter(category='month', customer__isnull=False)
+    if dateStart is not None:
+        css = css.filter(month__gte=dateStart[:7])
+    if dateEnd is not None:
+        css = css.filter(month__lte=dateEnd[:7])
+
+    records = css \
+        .values('customer__pk', 'customer__name', 'month') \
+        .annotate(yewuliang=Sum('yewuliang')) \
+        .order_by('customer__name', 'customer__pk', 'month')
+    records = list(records)
+
+    customers = OrderedDict((r['customer__pk'], r['customer__name']) for r in records)
+    months = sorted(set(r['month'] for r in records))
+
+    rows = pivotStats(records, 'customer__pk', 'month', 'yewuliang', list(customers), months)
+    series = [[{
+        'yewuliang': yewuliang,
+        'avg_price': '0.00'
+    } for yewuliang in row] for row in rows]
 
     return JsonResponse({
         'months': months,
-        'customers': customerNames,
+        'customers': list(customers.values()),
         'series': series
     })
 
 
 @require_http_methods(['GET'])
 @validateToken
+@cacheStats('customer')
 def customers_bar(request):
-    css = CustomerStat.objects.filter(category='month')
+    css = CustomerStat.active().filter(category='month')
 
     months = css.values('month').distinct().order_by('month')
     months = [w['month'] for w in months]
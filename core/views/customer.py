@@ -16,27 +16,35 @@ from sendfile import sendfile
 from core.models import *
 from core.auth import validateToken
 from core.common import *
+from core.importer import *
+from core.exporter import exportRows, iterateRows
 from core.exception import *
 
 logger = logging.getLogger('app.core.views.emps')
 
 
+def filterCustomers(request, customers):
+    name = request.GET.get('name', None)
+    rating = request.GET.get('rating', None)
+
+    if name is not None and name != '':
+        customers = customers.filter(name__contains=name)
+    if rating is not None and rating != '':
+        customers = customers.filter(rating=rating)
+    return customers
+
+
 @require_http_methods(['GET', 'POST'])
 @validateToken
 def index(request):
     if request.method == 'GET':
-        name = request.GET.get('name', None)
-        rating = request.GET.get('rating', None)
         start = int(request.GET.get('start', '0'))
         limit = int(request.GET.get('limit', '20'))
 
-        customers = Customer.objects.all()
-        if name is not None and name != '':
-            customers = customers.filter(name__contains=name)
-        if rating is not None and rating != '':
-            customers = customers.filter(rating=rating)
-
-        customers = customers.order_by('-id')
+        customers = filterCustomers(request, Customer.objects.all())
+        customers = customers \
+            .select_related('creator__department', 'creator__position') \
+            .order_by('-id')
         total = customers.count()
         customers = customers[start:start + limit]
         return JsonResponse({
@@ -48,6 +56,7 @@ def index(request):
         data = json.loads(request.body.decode('utf-8'))
         data['creator'] = profile
         Customer.objects.create(**data)
+        createStatsEvent('customer')
         return JsonResponse({'ok': True})
 
 
@@ -56,10 +65,13 @@ def index(request):
 def customer(request, customerId):
     if request.method == 'DELETE':
         Customer.objects.filter(pk=customerId).delete()
+        createStatsEvent('customer')
         return JsonResponse({'ok': True})
     elif request.method == 'GET':
         try:
-            customer = Customer.objects.get(pk=customerId)
+            customer = Customer.objects \
+                .select_related('creator__department', 'creator__position') \
+                .get(pk=customerId)
         except:
             customer = None
         return JsonResponse(resolve_customer(customer))
@@ -68,116 +80,93 @@ def customer(request, customerId):
         del data['id']
         del data['creator']
         Customer.objects.filter(pk=customerId).update(**data)
+        createStatsEvent('customer')
         return JsonResponse({'ok': True})
 
 
-def createCustomerByTuple(tuple, profile):
-    logger.info(tuple)
-
-    name = tuple[1]
-    rating = tuple[2]
-    shareholder = tuple[3]
-    faren = tuple[4]
-    capital = tuple[5]
-    year = int(tuple[6])
-    category = tuple[8]
-    nature = tuple[9]
-    address = tuple[10]
-    desc = tuple[11]
-    creator = profile
-
-    if rating not in ['A+', 'A', 'B', 'C']:
-        raise Exception('invalid rating')
-
+def validateCustomers(df):
     now = datetime.datetime.now(tz=timezone.utc)
-    if year > now.year or year < 1949:
-        raise Exception('invalid year')
-
-    validNatures = [cn[1] for cn in CustomerNatures]
-    if nature not in validNatures:
-        raise Exception('invalid nature')
-    cni = validNatures.index(nature)
-    nature = CustomerNatures[cni][0]
-
-    validCategories = [cc[1] for cc in CustomerCatgetories]
-    if category not in validCategories:
-        raise Exception('invalid category')
-    cci = validCategories.index(category)
-    category = CustomerCatgetories[cci][0]
-
-    Customer.objects.create(
-        creator=creator,
-        name=name,
-        rating=rating,
-        shareholder=shareholder,
-        faren=faren,
-        capital=capital,
-        year=year,
-        category=category,
-        nature=nature,
-        address=address,
-        desc=desc
-    )
+    df['year'] = numberColumn(df['year'])
+    df['capital'] = numberColumn(df['capital'])
+    df['category'] = choiceColumn(df['category'], CustomerCatgetories)
+    df['nature'] = choiceColumn(df['nature'], CustomerNatures)
+
+    return validateRows(df, [
+        (df['rating'].isin(['A+', 'A', 'B', 'C']), 'invalid-rating'),
+        (df['year'].notnull() & (df['year'] <= now.year) & (df['year'] >= 1949), 'invalid-year'),
+        (df['capital'].notnull(), 'invalid-capital'),
+        (df['nature'].notnull(), 'invalid-nature'),
+        (df['category'].notnull(), 'invalid-category'),
+    ])
+
+
+@registerImporter('customers', ['name', 'rating', 'shareholder', 'faren', 'capital',
+                                'year', 'nianxian', 'category', 'nature', 'address', 'desc'])
+def importCustomersFromFrame(df, profile, progress):
+    for column in ['name', 'shareholder', 'faren', 'address', 'desc']:
+        df[column] = textColumn(df[column])
+
+    rows, errors = validateCustomers(df)
+    bulkImport(Customer, [Customer(creator=profile,
+                                   name=r.name,
+                                   rating=r.rating,
+                                   shareholder=r.shareholder,
+                                   faren=r.faren,
+                                   capital=r.capital,
+                                   year=str(int(r.year)),
+                                   category=r.category,
+                                   nature=r.nature,
+                                   address=r.address,
+                                   desc=r.desc) for r in rows.itertuples()],
+               progress=lambda count: progress(len(errors) + count))
+    return len(rows), errors
 
 
 @require_http_methods(['POST'])
 @validateToken
 def importCustomers(request):
-    profile = request.profile
     data = json.loads(request.body.decode('utf-8'))
-    fileId = data['file']
-    f = File.objects.get(pk=fileId)
-    ex_data = pandas.read_excel('{}/{}'.format(settings.DATA_DIR, f.path))
-    total, success = 0, 0
-    for t in ex_data.itertuples():
-        total = total + 1
-        try:
-            createCustomerByTuple(t, profile)
-            success = success + 1
-        except:
-            logger.exception("fail to import customer")
-            pass
-
-    return JsonResponse({'success': success, 'fail': total - success})
+    job = createImportJob(request.profile, 'customers', data['file'])
+    return JsonResponse(resolve_import_job(job))
 
 
 @require_http_methods(['GET'])
 def exportCustomers(request):
-    customers = Customer.objects.all()
-
-    f = '/tmp/{}.xls'.format(str(uuid.uuid4()))
-    xf = xlwt.Workbook()
-    sheet = xf.add_sheet('sheet1')
+    customers = filterCustomers(request, Customer.objects.all()).order_by('-id')
 
     titles = ['客户名称', '评级', '主要股东信息', '法人',
               '注册资本(万元)', '成立年份', '成立年限', '公司类型', '公司性质', '地址信息', '备注']
-    for index, title in enumerate(titles):
-        sheet.write(0, index, title)
-
     props = ['name', 'rating', 'shareholder', 'faren', 'capital',
-             'year', 'nianxian', 'displayCategory', 'displayNature', 'address', 'desc']
-    for row, customer in enumerate(customers):
-        for col, prop in enumerate(props):
-            sheet.write(row + 1, col, getattr(customer, prop))
+             'year', 'category', 'nature', 'address', 'desc']
+    year = datetime.datetime.now(tz=timezone.utc).year
+    categories = dict(CustomerCatgetories)
+    natures = dict(CustomerNatures)
+
+    def resolveRow(row):
+        name, rating, shareholder, faren, capital, founded, category, nature, address, desc = row
+        return [name, rating, shareholder, faren, capital, founded, year - int(founded),
+                categories[category], natures[nature], address, desc]
 
-    xf.save(f)
-    return sendfile(request, f, attachment=True, attachment_filename='export.xls')
+    return exportRows(request, titles, (resolveRow(row) for row in iterateRows(customers, props)))
 
 
 @require_http_methods(['GET'])
+@cacheStats('customer')
 def stats(request):
     name = request.GET.get('name', None)
     rating = request.GET.get('rating', None)
     start = int(request.GET.get('start', '0'))
     limit = int(request.GET.get('limit', '20'))
 
-    stats = CustomerStat.objects.filter(category='total')
+    stats = CustomerStat.active().filter(category='total')
     if name is not None and name != '':
         stats = stats.filter(customer__name__contains=name)
     if rating is not None and rating != '':
         stats = stats.filter(customer__rating=rating)
 
-    stats = stats.order_by('customer__name')
+    stats = stats \
+        .select_related('customer__creator__department', 'customer__creator__position') \
+        .order_by('customer__name')
     total = stats.count()
     stats = stats[start:start + limit]
 
@@ -7,7 +7,7 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 
 from core.models import *
-from core.auth import validateToken
+from core.auth import validateToken, evictProfiles
 from core.common import *
 from core.exception import *
 
@@ -60,6 +60,7 @@ def index(request):
                                position=position,
                                phone=data['phone'],
                                desc=data.get('desc', None))
+        invalidateAssignees()
         return JsonResponse({'ok': True})
 
 
@@ -75,6 +76,9 @@ def detail(request, empId):
         Profile.objects \
             .filter(pk=empId) \
             .update(phone=None, archived=True, name='已删除-{}'.format(profile.name))
+        AuditActivity.updateSearchIndexForCreator(Profile.objects.get(pk=empId))
+        invalidateAssignees()
+        evictProfiles([empId])
         return JsonResponse({'ok': True})
     elif request.method == 'PUT':
         data = json.loads(request.body.decode('utf-8'))
@@ -90,6 +94,8 @@ def detail(request, empId):
                 partial[prop] = data.get(prop)
         partial['updated_at'] = timezone.now()
         Profile.objects.filter(pk=empId).update(**partial)
+        invalidateAssignees()
+        evictProfiles([empId])
         if 'password' in prop:
             user = emp.user
             user.set_password(prop['password'])
@@ -108,6 +114,7 @@ def detail(request, empId):
 def updateState(request, empId):
     data = json.loads(request.body.decode('utf-8'))
     Profile.objects.filter(pk=empId).update(blocked=data['blocked'])
+    evictProfiles([empId])
     return JsonResponse({'ok': True})
 
 
@@ -14,29 +14,37 @@ from sendfile import sendfile
 from core.models import *
 from core.auth import validateToken
 from core.common import *
+from core.importer import *
+from core.exporter import exportRows, iterateRows
 from core.exception import *
 
 logger = logging.getLogger('app.core.views.finAccounts')
 
 
+def filterAccounts(request, accounts):
+    name = request.GET.get('name', None)
+    number = request.GET.get('number', None)
+
+    if name is not None and name != '':
+        accounts = accounts.filter(name__contains=name)
+    if number is not None and number != '':
+        accounts = accounts.filter(number__contains=number)
+    return accounts
+
+
 @require_http_methods(['GET', 'POST'])
 @validateToken
 def index(request):
     profile = request.profile
 
     if request.method == 'GET':
-        name = request.GET.get('name', None)
-        number = request.GET.get('number', None)
         start = int(request.GET.get('start', '0'))
         limit = int(request.GET.get('limit', '20'))
 
-        accounts = FinAccount.objects.all()
-        if name is not None and name != '':
-            accounts = accounts.filter(name__contains=name)
-        if number is not None and number != '':
-            accounts = accounts.filter(number__contains=number)
-
-        accounts = accounts.order_by('-id')
+        accounts = filterAccounts(request, FinAccount.objects.all())
+        accounts = accounts \
+            .select_related('creator__department', 'creator__position') \
+            .order_by('-id')
         total = accounts.count()
         accounts = accounts[start:start + limit]
         return JsonResponse({
@@ -55,10 +63,13 @@ def index(request):
 def account(request, accountId):
     if request.method == 'DELETE':
         FinAccount.objects.filter(pk=accountId).delete()
+        invalidateStats('funds')
         return JsonResponse({'ok': True})
     elif request.method == 'GET':
         try:
-            account = FinAccount.objects.get(pk=accountId)
+            account = FinAccount.objects \
+                .select_related('creator__department', 'creator__position') \
+                .get(pk=accountId)
         except:
             account = None
         return JsonResponse(resolve_account(account))
@@ -68,73 +79,53 @@ def account(request, accountId):
         del data['creator']
         del data['created_at']
         del data['updated_at']
+        account = FinAccount.objects.get(pk=accountId)
         FinAccount.objects.filter(pk=accountId).update(**data)
+        if 'number' in data and data['number'] != account.number:
+            # 账号变化之后，对应的资金信息统计需要重新计算
+            createStatsEvent('funds', extra={'numbers': [account.number, data['number']]})
+        else:
+            # 统计接口里有账户名称等信息
+            invalidateStats('funds')
         return JsonResponse({'ok': True})
 
 
-def createAccountByTuple(tuple, profile):
-    logger.info(tuple)
+def validateAccounts(df):
+    df['currency'] = df['currency'].map({'人民币': 'rmb', '港币': 'hkd', '美元': 'dollar'})
+    return validateRows(df, [
+        (df['currency'].notnull(), 'invalid-currency'),
+    ])
 
-    name = tuple[1]
-    number = tuple[2]
-    bank = tuple[3]
-    currency = tuple[4]
 
-    if currency not in ['人民币', '港币', '美元']:
-        raise Exception('invalid currency')
-    if currency == '人民币':
-        currency = 'rmb'
-    if currency == '港币':
-        currency = 'hkd'
-    if currency == '美元':
-        currency = 'dollar'
+@registerImporter('fin-accounts', ['name', 'number', 'bank', 'currency'])
+def importAccountsFromFrame(df, profile, progress):
+    for column in ['name', 'number', 'bank']:
+        df[column] = textColumn(df[column])
 
-    FinAccount.objects.create(
-        creator=profile,
-        name=name,
-        number=number,
-        currency=currency,
-        bank=bank
-    )
+    rows, errors = validateAccounts(df)
+    bulkImport(FinAccount, [FinAccount(creator=profile,
+                                       name=r.name,
+                                       number=r.number,
+                                       currency=r.currency,
+                                       bank=r.bank) for r in rows.itertuples()],
+               progress=lambda count: progress(len(errors) + count))
+    return len(rows), errors
 
 
 @require_http_methods(['POST'])
 @validateToken
 def importAccounts(request):
-    profile = request.profile
     data = json.loads(request.body.decode('utf-8'))
-    fileId = data['file']
-    f = File.objects.get(pk=fileId)
-    ex_data = pandas.read_excel('{}/{}'.format(settings.DATA_DIR, f.path))
-    total, success = 0, 0
-    for t in ex_data.itertuples():
-        total = total + 1
-        try:
-            createAccountByTuple(t, profile)
-            success = success + 1
-        except:
-            logger.exception("fail to import customer")
-            pass
-
-    return JsonResponse({'success': success, 'fail': total - success})
+    job = createImportJob(request.profile, 'fin-accounts', data['file'])
+    return JsonResponse(resolve_import_job(job))
 
 
 @require_http_methods(['GET'])
 def exportAccounts(request):
-    accounts = FinAccount.objects.all()
-
-    f = '/tmp/{}.xls'.format(str(uuid.uuid4()))
-    xf = xlwt.Workbook()
-    sheet = xf.add_sheet('sheet1')
+    accounts = filterAccounts(request, FinAccount.objects.all()).order_by('-id')
 
     titles = ['账户名称', '账号', '开户机构', '币种']
-    for index, title in enumerate(titles):
-        sheet.write(0, index, title)
-
-    props = ['name', 'number', 'bank', 'displayCurrency']
-    for row, account in enumerate(accounts):
-        for col, prop in enumerate(props):
-            sheet.write(row + 1, col, getattr(account, prop))
-
-    xf.save(f)
-    return sendfile(request, f, attachment=True, attachment_filename='export.xls')
+    currencies = {'rmb': '人民币', 'hkd': '港币'}
+    rows = ([name, number, bank, currencies.get(currency, '美元')]
+            for name, number, bank, currency in iterateRows(accounts, ['name', 'number', 'bank', 'currency']))
+    return exportRows(request, titles, rows)
@@ -0,0 +1,25 @@
+import logging
+
+from django.http import JsonResponse
+from django.views.decorators.http import require_http_methods
+
+from core.auth import validateToken
+from core.common import *
+from core.importer import resolve_import_job, failStaleImportJobs
+
+logger = logging.getLogger('app.core.views.importJob')
+
+
+@require_http_methods(['GET'])
+@validateToken
+def job(request, jobId):
+    try:
+        job = ImportJob.objects.get(pk=jobId, profile=request.profile)
+    except ImportJob.DoesNotExist:
+        return JsonResponse({'errorId': 'job-not-found'}, status=400)
+
+    if job.state == ImportJob.StateRunning and \
+            failStaleImportJobs(ImportJob.objects.filter(pk=job.pk)) > 0:
+        job.refresh_from_db()
+
+    return JsonResponse(resolve_import_job(job))
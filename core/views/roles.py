@@ -7,7 +7,7 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
 
 from core.models import *
-from core.auth import validateToken
+from core.auth import validateToken, evictProfiles
 from core.common import *
 from core.exception import *
 
@@ -50,6 +50,7 @@ def detail(request, roleId):
     if request.method == 'DELETE':
         # TODO: check whether some user has this role
         Role.objects.filter(pk=roleId).update(archived=True)
+        evictProfiles()
         return JsonResponse({'ok': True})
     elif request.method == 'PUT':
         data = json.loads(request.body.decode('utf-8'))
@@ -58,6 +59,8 @@ def detail(request, roleId):
             if data.get(prop, None) != None:
                 partial[prop] = data.get(prop)
         Role.objects.filter(pk=roleId).update(**partial)
+        # 缓存的 profile 里包含角色
+        evictProfiles()
         return JsonResponse({'ok': True})
     else:
         try:
@@ -9,6 +9,7 @@ from django.core.cache import cache
 
 from core.auth import generateToken
 from core.auth import validateToken
+from core.auth import evictProfiles, revokeToken
 from core.common import *
 
 logger = logging.getLogger('app.core.views.session')
@@ -74,6 +75,13 @@ def loginWithCode(request):
         }, status=401)
 
 
+@require_http_methods(["POST"])
+@validateToken
+def logout(request):
+    revokeToken(request.META['HTTP_AUTHORIZATION'])
+    return JsonResponse({'ok': True})
+
+
 @require_http_methods(["POST"])
 @transaction.atomic
 def sendCode(request):
@@ -96,6 +104,7 @@ def changePhone(request):
     if checkCode(phone, code):
         profile.phone = phone
         profile.save()
+        evictProfiles([profile.pk])
         return JsonResponse({'ok': True})
     else:
         return JsonResponse({'errorId': 'invalid-code'}, status=400)
@@ -106,7 +115,9 @@ def changePhone(request):
 @validateToken
 def profile(request):
     profile = request.profile
-    return JsonResponse(resolve_profile(profile))
+    # 客户端可以带上次返回的 memoCursor，只获取新增的账户/公司/记忆数据
+    since = request.GET.get('since', None)
+    return JsonResponse(resolve_profile(profile, memo_since=since))
 
 
 @require_http_methods(['POST'])
@@ -117,6 +128,7 @@ def bindDeviceId(request):
     profile = request.profile
 
     deviceId = data['deviceId']
+    evictProfiles(list(Profile.objects.filter(deviceId=deviceId).values_list('pk', flat=True)) + [profile.pk])
     Profile.objects.filter(deviceId=deviceId).update(deviceId=None)
     profile.deviceId = deviceId
     profile.save()
@@ -134,5 +146,6 @@ def unbindDeviceId(request):
     if profile.deviceId == deviceId:
         profile.deviceId = None
         profile.save()
+        evictProfiles([profile.pk])
 
     return JsonResponse({'ok': True})
@@ -1,6 +1,7 @@
 from decimal import Decimal
 import re
 import json
+import uuid
 import logging
 import random
 import pandas
@@ -16,6 +17,8 @@ from sendfile import sendfile
 from core.auth import generateToken
 from core.auth import validateToken
 from core.common import *
+from core.importer import *
+from core.exporter import exportRows, iterateRows
 
 logger = logging.getLogger('app.core.views.stats')
 
@@ -33,23 +36,28 @@ def resolve_transaction_record(record):
     }
 
 
+def filterTransactionRecords(request, records):
+    number = request.GET.get('number', None)
+    date = request.GET.get('date', None)
+    other = request.GET.get('other', None)
+
+    if number is not None and number != '':
+        records = records.filter(number=number)
+    if date is not None and date != '':
+        records = records.filter(date=date)
+    if other is not None and other != '':
+        records = records.filter(other=other)
+    return records
+
+
 @require_http_methods(["GET", "DELETE"])
 def transactionRecords(request):
     if request.method == 'GET':
-        number = request.GET.get('number', None)
-        date = request.GET.get('date', None)
-        other = request.GET.get('other', None)
         start = int(request.GET.get('start', '0'))
         limit = int(request.GET.get('limit', '20'))
 
         records = StatsTransactionRecord.objects.filter(archived=False)
-        if number is not None and number != '':
-            records = records.filter(number=number)
-        if date is not None and date != '':
-            records = records.filter(date=date)
-        if other is not None and other != '':
-            records = records.filter(other=other)
-
+        records = filterTransactionRecords(request, records)
         records = records.order_by('-id')
         total = records.count()
         records = records[start:start + limit]
@@ -61,7 +69,9 @@ def transactionRecords(request):
         # delete
         data = json.loads(request.body.decode('utf-8'))
         idx = data['idx']
-        StatsTransactionRecord.objects.filter(pk__in=idx).update(archived=True)
+        records = StatsTransactionRecord.objects.filter(pk__in=idx)
+        createFundsStatsEvent(records)
+        records.update(archived=True)
         return JsonResponse({
             'ok': True
         })
@@ -72,70 +82,75 @@ def transactionRecords(request):
 # 2. 修改
 # 3. 删除
 
-def createTransactionRecordByTuple(tuple, profile):
-    logger.info(tuple)
-
-    date = str(tuple[1]).strip()
-    if re.match('^\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d$', date):
-        date = date.split(' ')[0]
-
-    if not re.match('^\d\d\d\d-\d\d-\d\d$', date):
-        raise Exception('invalid date')
-
-    number = tuple[2]
-    income = tuple[3]
-    outcome = tuple[4]
-
-    balance = tuple[5]
-    desc = tuple[6]
-    other = tuple[7]
-
-    if desc == '' or desc is None:
-        raise Exception('balance should not be empty')
-
-    if other == '':
-        raise Exception('other should not be empty')
+def createFundsStatsEvent(records):
+    '''
+    资金信息统计只需要更新记录涉及的账号，以及最早的记录所在的那一周之后的数据
+    '''
+    records = list(records)
+    if len(records) == 0:
+        return
+
+    createStatsEvent('funds', extra={
+        'numbers': list(set([r.number for r in records])),
+        'since': min([r.date for r in records])
+    })
 
-    r = StatsTransactionRecord.objects.create(
-        creator=profile,
-        date=date,
-        number=number,
-        income=income,
-        outcome=outcome,
-        balance=balance,
-        desc=desc,
-        other=other,
-    )
 
-    SRO = StatsTransactionRecordOps
-    SRO.objects.create(record=r, profile=profile, op='create')
+def validateTransactionRecords(df):
+    dates = textColumn(df['date']).str.strip()
+    df['date'] = dates.str.replace(r'^(\d\d\d\d-\d\d-\d\d) \d\d:\d\d:\d\d$', r'\1')
+    df['income'] = numberColumn(df['income'])
+    df['outcome'] = numberColumn(df['outcome'])
+    df['balance'] = numberColumn(df['balance'])
+    for column in ['number', 'desc', 'other']:
+        df[column] = textColumn(df[column])
+
+    return validateRows(df, [
+        (df['date'].str.match(r'^\d\d\d\d-\d\d-\d\d$'), 'invalid-date'),
+        (df['balance'].notnull(), 'invalid-balance'),
+        (df['desc'] != '', 'invalid-desc'),
+        (df['other'] != '', 'invalid-other'),
+    ])
+
+
+@registerImporter('transaction-records', ['date', 'number', 'income', 'outcome', 'balance', 'desc', 'other'])
+def importTransactionRecordsFromFrame(df, profile, progress):
+    rows, errors = validateTransactionRecords(df)
+    if len(errors) > 0:
+        # 流水的余额是连续的，有错误的时候整个文件都不导入
+        return 0, errors
+
+    batch = uuid.uuid4()
+    records = [StatsTransactionRecord(creator=profile,
+                                      importBatch=batch,
+                                      date=r.date,
+                                      number=r.number,
+                                      income=optional(r.income),
+                                      outcome=optional(r.outcome),
+                                      balance=r.balance,
+                                      desc=r.desc,
+                                      other=r.other) for r in rows.itertuples()]
+    with transaction.atomic():
+        # bulk_create 不会返回主键，通过这次导入的 batch 找到新导入的记录
+        bulkImport(StatsTransactionRecord, records, progress=progress)
+
+        created = StatsTransactionRecord.objects \
+            .filter(importBatch=batch) \
+            .values_list('pk', flat=True)
+        SRO = StatsTransactionRecordOps
+        bulkImport(SRO, [SRO(record_id=pk, profile=profile, op='create') for pk in created])
+
+        createFundsStatsEvent(records)
+
+    return len(records), []
 
 
 @require_http_methods(['POST'])
 @validateToken
 def importTransactionRecords(request):
-    profile = request.profile
     data = json.loads(request.body.decode('utf-8'))
-    fileId = data['file']
-    f = File.objects.get(pk=fileId)
-    ex_data = pandas.read_excel('{}/{}'.format(settings.DATA_DIR, f.path))
-    total, success = 0, 0
-    for t in ex_data.itertuples():
-        total = total + 1
-        try:
-            createTransactionRecordByTuple(t, profile)
-            success = success + 1
-        except:
-            # TODO
-            # 导入数据的时候，如果中间出问题应该中断才对吧，而且必须提示用户从哪一条开始出问题的
-            # 要和产品经理确认
-            logger.exception("fail to import customer, stop")
-            break
-
-    if success > 0:
-        StatsEvent.objects.create(source='funds', event='invalidate')
-
-    return JsonResponse({'success': success, 'fail': total - success})
+    job = createImportJob(request.profile, 'transaction-records', data['file'])
+    return JsonResponse(resolve_import_job(job))
 
 
 @require_http_methods(['GET', 'PUT'])
@@ -157,6 +172,7 @@ def transactionRecord(request, recordId):
 
         try:
             r = StatsTransactionRecord.objects.get(pk=recordId)
+            prevRecord = StatsTransactionRecord(number=r.number, date=r.date)
 
             props = ['date', 'number', 'income', 'outcome', 'desc', 'balance', 'other']
             partial = {}
@@ -182,7 +198,7 @@ def transactionRecord(request, recordId):
                                    profile=request.profile,
                                    op='modify')
             if len(modifiedProps) > 0:
-                StatsEvent.objects.create(source='funds', event='invalidate')
+                createFundsStatsEvent([prevRecord, r])
         except:
             logger.exception("fail to modify record")
             return JsonResponse({'errorId': 'internal-server-error'}, status=500)
@@ -192,23 +208,12 @@ def transactionRecord(request, recordId):
 
 @require_http_methods(['GET'])
 def exportRecords(request):
-    records = StatsTransactionRecord.objects.all()
-
-    f = '/tmp/{}.xls'.format(str(uuid.uuid4()))
-    xf = xlwt.Workbook()
-    sheet = xf.add_sheet('sheet1')
+    records = filterTransactionRecords(request, StatsTransactionRecord.objects.filter(archived=False))
+    records = records.order_by('-id')
 
     titles = ['交易日期', '账号', '收款', '支出', '账号余额', '摘要', '对方账户名称']
-    for index, title in enumerate(titles):
-        sheet.write(0, index, title)
-
     props = ['date', 'number', 'income', 'outcome', 'balance', 'desc', 'other']
-    for row, r in enumerate(records):
-        for col, prop in enumerate(props):
-            sheet.write(row + 1, col, getattr(r, prop, ''))
-
-    xf.save(f)
-    return sendfile(request, f, attachment=True, attachment_filename='export.xls')
+    return exportRows(request, titles, iterateRows(records, props))
 
 
 def resolve_op(op):
@@ -270,11 +275,12 @@ def resolve_ts(r):
 
 
 @require_http_methods(['GET'])
+@cacheStats('funds')
 def stats(request):
     name = request.GET.get('name', None)
     number = request.GET.get('number', None)
 
-    tss = TransactionStat.objects.filter(category='total')
+    tss = TransactionStat.active().filter(category='total')
     if name is not None and name != '':
         tss = tss.filter(account__name__contains=name)
     if number is not None and number != '':
@@ -290,3 +296,12 @@ def stats(request):
         'records': records,
         'total': total
     })
+
+
+@require_http_methods(['GET'])
+@validateToken
+def cacheCounters(request):
+    '''
+    各类统计数据的版本和接口缓存的命中/未命中次数
+    '''
+    return JsonResponse(statsCacheCounters())
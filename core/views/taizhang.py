@@ -116,7 +116,7 @@ def taizhangDetail(request, id):
                                        profile=request.profile,
                                        op='modify')
         if len(modifiedProps) > 0:
-            StatsEvent.objects.create(source='taizhang', event='invalidate')
+            createStatsEvent('taizhang')
     except:
         logger.exception("fail to modify record")
         return JsonResponse({'errorId': 'internal-server-error'}, status=500)
@@ -172,6 +172,7 @@ def ops(request):
 
 
 @require_http_methods(['GET'])
+@cacheStats('taizhang')
 def stats(request):
     start = int(request.GET.get('start', '0'))
     limit = int(request.GET.get('limit', '20'))
@@ -179,7 +180,7 @@ def stats(request):
     company_param = request.GET.get('company', '')
     asset_param = request.GET.get('asset', '')
 
-    records = TaizhangStat.objects.filter(category='total')
+    records = TaizhangStat.active().filter(category='total')
     if company_param is not None and company_param != '':
         records = records.filter(company__contains=company_param)
     if asset_param:
@@ -0,0 +1,218 @@
+import uuid
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import *
+from core.common import createStatsEvent
+
+
+class WorkflowError(Exception):
+    '''
+    审批步骤的状态不允许当前操作，data 直接返回给客户端
+    '''
+
+    def __init__(self, data):
+        super().__init__(data['errorId'])
+        self.data = data
+
+
+def validateStepState(step, profile):
+    if step.state != AuditStep.StatePending:
+        return {
+            'errorId': 'invalid-step-state',
+            'errorMsg': 'Current step state is {}. Can not change current step state.'.format(step.state)
+        }
+
+    if step.active is not True:
+        return {
+            'errorId': 'invalid-step-state',
+            'errorMsg': 'not current step'
+        }
+
+    if step.assignee_id != profile.pk:
+        return {
+            'errorId': 'invalid-assignee'
+        }
+
+    return None
+
+
+def lockSteps(stepIds, profile):
+    '''
+    锁住审批步骤和所属的审批单，同一个审批单的流转依次执行；
+    返回可以操作的审批步骤和每个审批步骤的错误
+    '''
+    ids = {}
+    errors = {}
+    for stepId in stepIds:
+        try:
+            ids[uuid.UUID(str(stepId))] = stepId
+        except ValueError:
+            errors[stepId] = {'errorId': 'step-not-found'}
+
+    # 按主键顺序加锁，两个批量操作之间不会死锁
+    steps = AuditStep.objects \
+        .select_for_update() \
+        .select_related('activity') \
+        .filter(pk__in=list(ids)) \
+        .order_by('pk')
+    steps = {step.pk: step for step in steps}
+
+    valid = []
+    for pk, stepId in ids.items():
+        step = steps.get(pk)
+        if step is None:
+            errors[stepId] = {'errorId': 'step-not-found'}
+            continue
+        err = validateStepState(step, profile)
+        if err is not None:
+            errors[stepId] = err
+        else:
+            valid.append(step)
+    return valid, errors
+
+
+def finishSteps(steps, state, desc, now):
+    AuditStep.objects \
+        .filter(pk__in=[step.pk for step in steps]) \
+        .update(state=state, active=False, finished_at=now, desc=desc, updated_at=now)
+
+    # 审批人的催办和待审批消息已经没有用了
+    Message.objects \
+        .filter(activity_id__in=[step.activity_id for step in steps],
+                profile_id=steps[0].assignee_id,
+                category__in=['hurryup', 'progress']) \
+        .delete()
+
+
+def finishActivities(activities, now):
+    '''
+    最后一步审批通过，审批单通过；合同审批单记录到台账
+    '''
+    configs = AuditActivityConfig.objects.in_bulk({activity.config_id for activity in activities})
+    withTask = [a.pk for a in activities if configs[a.config_id].hasTask]
+    withoutTask = [a.pk for a in activities if not configs[a.config_id].hasTask]
+    if withTask:
+        AuditActivity.objects \
+            .filter(pk__in=withTask) \
+            .update(state=AuditActivity.StateApproved, taskState='pending', updated_at=now)
+    if withoutTask:
+        AuditActivity.objects \
+            .filter(pk__in=withoutTask) \
+            .update(state=AuditActivity.StateApproved, updated_at=now)
+
+    taizhang = []
+    for activity in activities:
+        if configs[activity.config_id].subtype != 'biz_contract':
+            continue
+        info = activity.extra['info']
+        taizhang.append(Taizhang(
+            auditId=activity.pk,
+            date=activity.created_at.strftime('%Y-%m'),
+            asset=info['asset'],
+            upstream=info['upstream'],
+            upstream_dunwei=info['tonnage'],
+            buyPrice=info['buyPrice'],
+
+            downstream=info.get('downstream', ''),
+            downstream_dunwei=info['tonnage'],
+            sellPrice=info['sellPrice'],
+        ))
+    if taizhang:
+        Taizhang.objects.bulk_create(taizhang)
+        createStatsEvent('taizhang')
+
+    return [Message(profile_id=activity.creator_id,
+                    activity=activity,
+                    category='finish',
+                    extra={'state': 'approved'}) for activity in activities]
+
+
+def approveSteps(steps, now):
+    nextSteps = {}
+    candidates = AuditStep.objects \
+        .filter(activity_id__in=[step.activity_id for step in steps]) \
+        .only('id', 'activity_id', 'position', 'assignee_id')
+    for candidate in candidates:
+        nextSteps[(candidate.activity_id, candidate.position)] = candidate
+
+    activated = []
+    finished = []
+    messages = []
+    for step in steps:
+        nextStep = nextSteps.get((step.activity_id, step.position + 1))
+        if nextStep is None:
+            finished.append(step.activity)
+        else:
+            activated.append(nextStep.pk)
+            messages.append(Message(activity_id=step.activity_id,
+                                    category='progress',
+                                    extra={},
+                                    profile_id=nextStep.assignee_id))
+
+    if activated:
+        AuditStep.objects \
+            .filter(pk__in=activated) \
+            .update(active=True, activated_at=now, updated_at=now)
+    if finished:
+        messages.extend(finishActivities(finished, now))
+    # 新的审批步骤还没有催办过
+    AuditActivity.updateActiveStep([step.activity_id for step in steps], hurried_at=None)
+    return messages
+
+
+def rejectSteps(steps, now):
+    activities = [step.activity for step in steps]
+    AuditActivity.objects \
+        .filter(pk__in=[activity.pk for activity in activities]) \
+        .update(state=AuditActivity.StateRejected, finished_at=now, updated_at=now,
+                activeStep=None, activeAssignee=None, stepDecided=True, hurried_at=None)
+    return [Message(profile_id=activity.creator_id,
+                    activity=activity,
+                    category='finish',
+                    extra={'state': 'rejected'}) for activity in activities]
+
+
+@transaction.atomic
+def transitionSteps(stepIds, profile, action, desc=None):
+    '''
+    批量审批通过（action=approve）或者拒绝（action=reject），在同一个事务里完成；
+    返回每个审批步骤的错误（以传入的 id 为 key），操作成功的审批步骤不出现在结果里
+    '''
+    now = datetime.datetime.now(tz=timezone.utc)
+    steps, errors = lockSteps(stepIds, profile)
+    if not steps:
+        return errors
+
+    if action == 'approve':
+        state, transition = AuditStep.StateApproved, approveSteps
+    else:
+        state, transition = AuditStep.StateRejected, rejectSteps
+    finishSteps(steps, state, desc, now)
+    messages = transition(steps, now)
+    Message.objects.bulk_create(messages)
+    return errors
+
+
+def transitionStep(stepId, profile, action, desc=None):
+    errors = transitionSteps([stepId], profile, action, desc=desc)
+    for err in errors.values():
+        if err['errorId'] == 'step-not-found':
+            raise AuditStep.DoesNotExist()
+        raise WorkflowError(err)
+
+
+def approveStep(stepId, profile, desc=None):
+    '''
+    审批通过，激活下一步；没有下一步时审批单通过
+    '''
+    transitionStep(stepId, profile, 'approve', desc=desc)
+
+
+def rejectStep(stepId, profile, desc=None):
+    '''
+    审批拒绝，审批单直接结束
+    '''
+    transitionStep(stepId, profile, 'reject', desc=desc)
@@ -5,5 +5,6 @@ set -x
 #sh resetData.sh
 
 ./manage.py migrate && \
+	./manage.py createcachetable && \
 	./manage.py runserver 0.0.0.0:8000
 